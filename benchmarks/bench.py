@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from common import (ROOT, load_baseline, measure, measure_async,
+                    print_results, summarize, write_results)
+from fake_webui import FakeWebUI, png_base64
+
+os.chdir(ROOT)
+
+from api_access import Singleton, StableDiffusionAccess  # noqa: E402
+from config import LoadConfig  # noqa: E402
+from database_access import Database  # noqa: E402
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = f'user{user_id}'
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.body = json.dumps(data).encode()
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+def make_api(backend_url: str, temp_dir: Path) -> StableDiffusionAccess:
+    # the bot keeps a single instance, benchmarks need their own backend
+    Singleton._instances.pop(StableDiffusionAccess, None)
+    return StableDiffusionAccess(
+        temp_dir=temp_dir,
+        model_config_obj=LoadConfig(ROOT / 'configs' / 'models.yml'),
+        backends_config=[backend_url],
+        lanes_config=LoadConfig(ROOT / 'configs' / 'usage_modes.yml').data.get(
+            'available_generations'))
+
+
+def clean_dir(path: Path):
+    for item in path.iterdir():
+        item.unlink()
+
+
+def bench_hot_paths(temp_dir: Path, repeat: int) -> dict:
+    results = {}
+    api = make_api('http://127.0.0.1:9', temp_dir)
+    out_dir = temp_dir / 'out'
+    out_dir.mkdir()
+    api.temp_dir = out_dir
+
+    response = FakeResponse({
+        'images': [png_base64(512, 512, i) for i in range(4)],
+        'info': '{"seed": 1}',
+    })
+    results['pack_images_4x512'] = measure(
+        lambda: api._pack_images(response, 'bench'), repeat=repeat,
+        setup=lambda: clean_dir(out_dir))
+
+    img_path = temp_dir / 'input.png'
+    shutil.copyfile(api._pack_images(response, 'input')[0], img_path)
+    results['get_image_repr_512'] = measure(
+        lambda: api.get_image_repr(img_path), repeat=repeat)
+
+    database = Database(temp_dir / 'bench.db')
+    users = [FakeUser(i) for i in range(100)]
+
+    def insert():
+        with database as db:
+            db.insert('txt2img', random.choice(users), model=0,
+                      orientation=0, prompt='a cat in a hat')
+
+    for _ in range(10_000):
+        insert()
+    results['database_insert'] = measure(insert, repeat=repeat * 10)
+
+    def update_for_user():
+        with database as db:
+            db.update_for_user(random.choice(users))
+
+    results['database_update_for_user'] = measure(update_for_user,
+                                                  repeat=repeat * 10)
+
+    from bot import check_for_banned_words
+    banned = [f'word{i}' for i in range(2000)]
+    prompt = ' '.join(f'token{i}' for i in range(60))
+    results['check_for_banned_words'] = measure(
+        lambda: check_for_banned_words(prompt, banned), repeat=repeat * 10)
+
+    # building the /artist menu from the dialogs against reusing the
+    # rendered one
+    from bot import models_menu
+    from tenants import Tenant
+    dialogs = Tenant('bench').dialogs
+    results['render_models_menu'] = measure(
+        lambda: models_menu.__wrapped__(dialogs, 0), repeat=repeat * 10)
+    results['rendered_models_menu'] = measure(
+        lambda: models_menu(dialogs, 0), repeat=repeat * 10)
+    return results
+
+
+def bench_end_to_end(temp_dir: Path, repeat: int, latency: float) -> dict:
+    results = {}
+    out_dir = temp_dir / 'e2e'
+    out_dir.mkdir()
+    with FakeWebUI(latency=latency, upscale_latency=latency) as server:
+        api = make_api(server.url, out_dir)
+        model_name = api.model_config['available_models'][0]
+        loop = asyncio.new_event_loop()
+
+        def fresh_input():
+            path = out_dir / f'input_{random.random()}.png'
+            img = api._decode_image(png_base64(512, 512))
+            img.save(path)
+            return path
+
+        async def txt2img():
+            paths = await api.txt2img('a cat in a hat', model_name,
+                                      '512x512', 'bench')
+            for path in paths:
+                path.unlink()
+
+        async def img2img():
+            paths = await api.img2img('a cat in a hat', model_name,
+                                      '512x512', fresh_input(), 'bench')
+            for path in paths:
+                path.unlink()
+
+        async def upscale_img():
+            paths = await api.upscale_img(2, 'ESRGAN_4x', None, 0.5,
+                                          '512x512', fresh_input(),
+                                          file_prefix='bench')
+            for path in paths:
+                path.unlink()
+
+        async def txt2img_identical(n=4):
+            # n users sending the same prompt at once
+            results = await asyncio.gather(*[
+                api.txt2img('a cat in a hat', model_name, '512x512',
+                            f'bench{i}') for i in range(n)])
+            for paths in results:
+                for path in paths:
+                    path.unlink()
+
+        async def first_image(images_per_call):
+            # seconds until the first images of a batch of 4 are on disk
+            start = time.perf_counter()
+            first = None
+            async for paths in api.txt2img_parts(
+                    'a cat in a hat', model_name, '512x512', 'bench',
+                    images_per_call=images_per_call):
+                first = first or time.perf_counter() - start
+                for path in paths:
+                    path.unlink()
+            return first
+
+        async def upscale_behind_txt2img(n=4):
+            # seconds an upscale takes while n diffusion jobs are queued
+            jobs = [asyncio.ensure_future(api.txt2img(
+                f'a cat number {i}', model_name, '512x512', f'bench{i}'))
+                for i in range(n)]
+            # one of them runs, the others wait for the backend
+            while api.pool.queue_depth < n - 1:
+                await asyncio.sleep(0.001)
+            start = time.perf_counter()
+            await upscale_img()
+            elapsed = time.perf_counter() - start
+            for paths in await asyncio.gather(*jobs):
+                for path in paths:
+                    path.unlink()
+            return elapsed
+
+        results['txt2img_e2e'] = measure_async(txt2img, repeat, loop=loop)
+        for images_per_call in (0, 1, 2):
+            samples = [loop.run_until_complete(first_image(images_per_call))
+                       for _ in range(repeat)]
+            name = f'{images_per_call}_per_call' if images_per_call \
+                else 'whole_batch'
+            results[f'first_image_{name}_e2e'] = summarize(samples)
+        results['txt2img_identical_x4_e2e'] = measure_async(
+            txt2img_identical, repeat, loop=loop)
+        api.deduplicate = False
+        results['txt2img_identical_x4_no_dedup_e2e'] = measure_async(
+            txt2img_identical, repeat, loop=loop)
+        api.deduplicate = True
+        results['img2img_e2e'] = measure_async(img2img, repeat, loop=loop)
+        results['upscale_img_e2e'] = measure_async(upscale_img, repeat,
+                                                   loop=loop)
+        results['upscale_behind_txt2img_x4_e2e'] = summarize([
+            loop.run_until_complete(upscale_behind_txt2img())
+            for _ in range(repeat)])
+        loop.close()
+    return results
+
+
+@contextlib.contextmanager
+def webui_process(latency: float):
+    # a separate process, so its allocations don't count towards the bot's
+    proc = subprocess.Popen(
+        [sys.executable, str(ROOT / 'benchmarks' / 'fake_webui.py'),
+         '--port', '0', '--latency', str(latency), '--swap-latency', '0'],
+        stdout=subprocess.PIPE, text=True)
+    try:
+        yield proc.stdout.readline().split()[-1]
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def bench_memory(temp_dir: Path, repeat: int, latency: float) -> dict:
+    results = {}
+    out_dir = temp_dir / 'memory'
+    out_dir.mkdir()
+    with webui_process(latency) as url:
+        api = make_api(url, out_dir)
+        model_name = api.model_config['available_models'][0]
+        loop = asyncio.new_event_loop()
+
+        async def generate(n_requests, size):
+            results = await asyncio.gather(*[
+                api.txt2img(f'a cat number {i}', model_name, size,
+                            f'bench{i}') for i in range(n_requests)])
+            for paths in results:
+                for path in paths:
+                    path.unlink()
+
+        for n_requests, size in ((1, '512x512'), (1, '1024x1024'),
+                                 (4, '1024x1024')):
+            samples = []
+            loop.run_until_complete(generate(n_requests, size))
+            for _ in range(repeat):
+                tracemalloc.start()
+                loop.run_until_complete(generate(n_requests, size))
+                samples.append(tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            results[f'txt2img_peak_memory_{n_requests}x{size}'] = \
+                summarize(samples) | {'unit': 'bytes'}
+        loop.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bot micro-benchmarks')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Fake WebUI seconds per generated image')
+    parser.add_argument('--only', choices=['hot', 'e2e', 'memory'])
+    parser.add_argument('--output', help='Where to write the JSON report')
+    parser.add_argument('--compare', help='Earlier JSON report to compare to')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp:
+        temp_dir = Path(temp)
+        if args.only in (None, 'hot'):
+            results |= bench_hot_paths(temp_dir, args.repeat)
+        if args.only in (None, 'e2e'):
+            results |= bench_end_to_end(temp_dir, max(args.repeat // 4, 3),
+                                        args.latency)
+        if args.only in (None, 'memory'):
+            results |= bench_memory(temp_dir, max(args.repeat // 4, 3),
+                                    args.latency)
+
+    print_results(results, load_baseline(args.compare))
+    path = write_results('bench', results, args.output,
+                         extra={'latency': args.latency})
+    print(f'Results written to {path}')
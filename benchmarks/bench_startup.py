@@ -0,0 +1,83 @@
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from common import (ROOT, load_baseline, print_results, summarize,
+                    write_results)
+from fake_webui import FakeWebUI
+
+# Cold start of the bot, measured in a fresh interpreter per run so import
+# caches don't carry over. Each run works in a scratch directory that
+# links the real configs, so databases and logs never touch the repo
+
+CHILD = '''
+import asyncio, json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {src!r})
+import bot
+timings = {{'import_bot': time.perf_counter() - start}}
+
+bot.modes_config.data['webui_backends'] = [{{'url': {url!r}}}]
+bot.modes_config.data.setdefault('startup', {{}})['warm_up_translator'] = False
+mark = time.perf_counter()
+bot.init_resources()
+timings['init_resources'] = time.perf_counter() - mark
+
+mark = time.perf_counter()
+application = bot.build_application(whitelist_filter=False)
+timings['build_application'] = time.perf_counter() - mark
+
+mark = time.perf_counter()
+asyncio.run(bot.check_readiness(application))
+timings['readiness'] = time.perf_counter() - mark
+timings['total'] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def prepare_workdir(workdir: Path):
+    (workdir / 'configs').symlink_to(ROOT / 'configs')
+    info = workdir / 'info'
+    info.mkdir()
+    for name in ('word_blacklist.txt', 'whitelist.txt', 'blacklist.txt',
+                 'possible_actions.txt'):
+        if (ROOT / 'info' / name).exists():
+            shutil.copy(ROOT / 'info' / name, info / name)
+    # build_application only checks that a token is set
+    (info / 'tg_token.txt').write_text('123456:benchmark')
+
+
+def run_once(url: str) -> dict:
+    with tempfile.TemporaryDirectory() as temp:
+        workdir = Path(temp)
+        prepare_workdir(workdir)
+        code = CHILD.format(src=str(ROOT / 'src'), url=url)
+        out = subprocess.run([sys.executable, '-c', code], cwd=workdir,
+                             capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f'Startup run failed:\n{out.stderr}')
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bot startup benchmark')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Where to write the JSON report')
+    parser.add_argument('--compare', help='Earlier JSON report to compare to')
+    args = parser.parse_args()
+
+    samples = {}
+    with FakeWebUI() as server:
+        for _ in range(args.repeat):
+            for phase, value in run_once(server.url).items():
+                samples.setdefault(phase, []).append(value)
+
+    results = {f'startup.{phase}': summarize(values)
+               for phase, values in samples.items()}
+    print_results(results, load_baseline(args.compare))
+    path = write_results('startup', results, args.output)
+    print(f'Results written to {path}')
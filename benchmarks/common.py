@@ -0,0 +1,121 @@
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / 'benchmarks' / 'results'
+
+if str(ROOT / 'src') not in sys.path:
+    sys.path.insert(0, str(ROOT / 'src'))
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    pos = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[pos]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        'unit': 's',
+        'runs': len(samples),
+        'mean': statistics.fmean(samples),
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'max': max(samples),
+        'p95': percentile(samples, 95),
+        'stdev': statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+
+def measure(fn, repeat=20, warmup=2, setup=None) -> dict:
+    for _ in range(warmup):
+        if setup:
+            setup()
+        fn()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def measure_async(coro_fn, repeat=10, warmup=1, loop=None) -> dict:
+    loop = loop or asyncio.new_event_loop()
+    return measure(lambda: loop.run_until_complete(coro_fn()),
+                   repeat=repeat, warmup=warmup)
+
+
+def git_commit() -> tuple[str, bool]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '-uno'],
+                                    cwd=ROOT, capture_output=True, text=True,
+                                    check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return commit, dirty
+
+
+def write_results(suite: str, results: dict, output=None, extra=None) -> Path:
+    commit, dirty = git_commit()
+    report = {
+        'suite': suite,
+        'commit': commit,
+        'dirty': dirty,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if extra:
+        report |= extra
+
+    if output is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = RESULTS_DIR / f'{suite}_{stamp}_{commit}.json'
+    output = Path(output)
+    output.write_text(json.dumps(report, indent=2))
+    return output
+
+
+def print_results(results: dict, baseline: dict | None = None):
+    header = f'{"benchmark":<34}{"median":>12}{"p95":>12}{"min":>12}'
+    if baseline:
+        header += f'{"vs base":>10}'
+    print(header)
+    for name, stats in results.items():
+        if 'median' not in stats:
+            continue
+        if stats.get('unit') == 'bytes':
+            line = f'{name:<34}' + ''.join(
+                f'{stats[key] / 2**20:>10.2f}MB'
+                for key in ('median', 'p95', 'min'))
+        else:
+            line = f'{name:<34}' + ''.join(
+                f'{stats[key] * 1e3:>10.3f}ms'
+                for key in ('median', 'p95', 'min'))
+        if baseline and name in baseline and baseline[name].get('median'):
+            ratio = stats['median'] / baseline[name]['median']
+            line += f'{ratio:>9.2f}x'
+        print(line)
+
+
+def load_baseline(path) -> dict | None:
+    if path is None:
+        return None
+    return json.loads(Path(path).read_text())['results']
@@ -0,0 +1,193 @@
+import argparse
+import base64
+import io
+import json
+import random
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+# Stand-in for the Stable Diffusion WebUI API. Answers the endpoints the
+# bot uses with base64 PNGs close in size to real generations, after a
+# configurable delay
+
+
+@lru_cache(maxsize=16)
+def render_png(width: int, height: int, seed: int = 0) -> bytes:
+    # noise over a gradient compresses about as badly as real outputs
+    noise = Image.effect_noise((width, height), 64).convert('RGB')
+    gradient = Image.linear_gradient('L').resize((width, height))
+    image = Image.merge('RGB', (noise.getchannel(0), gradient,
+                                noise.rotate(90 * (seed % 4)).getchannel(0)))
+    buffered = io.BytesIO()
+    image.save(buffered, format='PNG')
+    return buffered.getvalue()
+
+
+def png_base64(width, height, seed=0) -> str:
+    return base64.b64encode(render_png(width, height, seed % 4)).decode()
+
+
+def decode_size(img_base64: str) -> tuple[int, int]:
+    data = base64.b64decode(img_base64.split(',', 1)[-1])
+    with Image.open(io.BytesIO(data)) as image:
+        return image.size
+
+
+class FakeWebUIHandler(BaseHTTPRequestHandler):
+    server: 'FakeWebUI'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.count(self.path)
+        if self.path == '/user':
+            self._reply({})
+        elif self.path == '/sdapi/v1/options':
+            self._reply({'sd_model_checkpoint': self.server.loaded})
+        elif self.path == '/sdapi/v1/sd-models':
+            self._reply([{'title': title, 'model_name': title.split('.')[0]}
+                         for title in self.server.checkpoints])
+        else:
+            self._reply({'detail': 'Not Found'}, status=404)
+
+    def do_POST(self):
+        self.server.count(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+
+        if self.path == '/sdapi/v1/options':
+            time.sleep(self.server.swap_latency)
+            self.server.loaded = payload.get('sd_model_checkpoint',
+                                             self.server.loaded)
+            self._reply(None)
+        elif self.path in ('/sdapi/v1/txt2img', '/sdapi/v1/img2img'):
+            self._reply(self._generate(payload))
+        elif self.path == '/sdapi/v1/extra-single-image':
+            width, height = decode_size(payload['image'])
+            scale = payload.get('upscaling_resize', 2)
+            time.sleep(self.server.upscale_latency)
+            self._reply({'image': png_base64(int(width * scale),
+                                             int(height * scale)),
+                         'html_info': '<p>fake upscale</p>'})
+        elif self.path == '/sdapi/v1/extra-batch-images':
+            scale = payload.get('upscaling_resize', 2)
+            images = []
+            for item in payload['imageList']:
+                width, height = decode_size(item['data'])
+                time.sleep(self.server.upscale_latency)
+                images.append(png_base64(int(width * scale),
+                                         int(height * scale)))
+            self._reply({'images': images,
+                         'html_info': '<p>fake upscale</p>'})
+        else:
+            self._reply({'detail': 'Not Found'}, status=404)
+
+    def _generate(self, payload):
+        n_images = payload.get('n_iter', 1) * payload.get('batch_size', 1)
+        steps = payload.get('steps', 20)
+        time.sleep(self.server.latency * n_images * steps / 25)
+
+        seed = payload.get('seed', -1)
+        if seed is None or seed < 0:
+            seed = random.randint(0, 2**32 - 1)
+        seeds = [seed + i for i in range(n_images)]
+        width = payload.get('width', 512)
+        height = payload.get('height', 512)
+        if payload.get('enable_hr'):
+            width = int(width * payload.get('hr_scale', 2))
+            height = int(height * payload.get('hr_scale', 2))
+
+        info = {
+            'prompt': payload.get('prompt', ''),
+            'all_prompts': [payload.get('prompt', '')] * n_images,
+            'seed': seeds[0],
+            'all_seeds': seeds,
+            'width': width,
+            'height': height,
+            'sampler_name': payload.get('sampler_name', 'Euler a'),
+            'steps': steps,
+        }
+        return {
+            'images': [png_base64(width, height, s) for s in seeds],
+            'parameters': payload | {'init_images': None},
+            'info': json.dumps(info),
+        }
+
+
+class FakeWebUI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 swap_latency=0.0, upscale_latency=0.0, checkpoints=None):
+        super().__init__((host, port), FakeWebUIHandler)
+        # seconds per 25-step image, per checkpoint swap and per upscale
+        self.latency = latency
+        self.swap_latency = swap_latency
+        self.upscale_latency = upscale_latency
+        self.checkpoints = checkpoints or [
+            'v1-5-pruned-emaonly.safetensors [6ce0161689]',
+            'pastelmix-better-vae-fp16.safetensors [d01a68ae76]',
+        ]
+        self.loaded = self.checkpoints[0]
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Stable Diffusion WebUI')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7860)
+    parser.add_argument('--latency', type=float, default=1.0,
+                        help='Seconds per generated 25-step image')
+    parser.add_argument('--swap-latency', type=float, default=3.0,
+                        help='Seconds per checkpoint swap')
+    parser.add_argument('--upscale-latency', type=float, default=0.5,
+                        help='Seconds per upscaled image')
+    args = parser.parse_args()
+
+    server = FakeWebUI(args.host, args.port, args.latency,
+                       args.swap_latency, args.upscale_latency)
+    print(f'Fake WebUI listening on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
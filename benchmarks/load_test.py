@@ -0,0 +1,411 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from common import ROOT, percentile, write_results
+from fake_webui import FakeWebUI, render_png
+
+os.chdir(ROOT)
+
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import bot  # noqa: E402
+import metrics  # noqa: E402
+from api_access import Singleton, StableDiffusionAccess  # noqa: E402
+from database_access import AsyncDatabase, Database  # noqa: E402
+from file_id_cache import FileIdCache  # noqa: E402
+from job_journal import JobJournal  # noqa: E402
+from tenants import Tenant  # noqa: E402
+
+# Drives the full handler stack in-process with synthetic updates. The
+# Telegram Bot API is replaced by MockTelegramTransport, the WebUI by
+# FakeWebUI and prompt translation by a delay, so nothing leaves the host
+
+PROMPTS = [
+    'a cat in a hat',
+    'portrait of an old sailor, oil painting',
+    'futuristic city at night, neon lights, rain',
+    'кот в шляпе',
+    'watercolor landscape with mountains and a lake',
+    'a bowl of ramen, studio photo',
+]
+
+SCENARIOS = {
+    'text': 0.45,
+    'photo_caption': 0.12,
+    'photo': 0.10,
+    'album_caption': 0.03,
+    'set_model': 0.10,
+    'orientation': 0.05,
+    'retry': 0.10,
+    'cancel': 0.05,
+}
+
+
+class MockTelegramTransport(BaseRequest):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.replies = Counter()
+        self.uploaded_photos = 0
+        self.referenced_photos = 0
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None,
+                         read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if '/file/bot' in url:
+            return 200, render_png(640, 480)
+
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        result = self._result(endpoint, params)
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def _message(self, params, **extra):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': params.get('chat_id', 1), 'type': 'private'},
+        } | extra
+
+    def _photo(self, media):
+        if str(media).startswith('attach://'):
+            self.uploaded_photos += 1
+            file_id = f'photo{next(self._file_ids)}'
+        else:
+            self.referenced_photos += 1
+            file_id = media
+        return [{'file_id': file_id, 'file_unique_id': file_id,
+                 'width': 512, 'height': 512}]
+
+    def _result(self, endpoint, params):
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Load',
+                    'username': 'load_test_bot'}
+        if endpoint in ('sendMessage', 'editMessageText'):
+            self.replies[params.get('text', '')] += 1
+            return self._message(params, text=params.get('text', ''))
+        if endpoint == 'sendMediaGroup':
+            return [self._message(params, photo=self._photo(item['media']))
+                    for item in params['media']]
+        if endpoint == 'sendPhoto':
+            # uploaded files travel as multipart data, not as a parameter
+            photo = params.get('photo', 'attach://photo')
+            return self._message(params, photo=self._photo(photo))
+        if endpoint == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': 'u1',
+                    'file_size': 1, 'file_path': 'photos/file_1.png'}
+        return True
+
+
+class UpdateFactory:
+    def __init__(self, tg_bot):
+        self.bot = tg_bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'vu{user_id}',
+                'username': f'vu{user_id}', 'language_code': 'en'}
+
+    def _message(self, user_id, **extra):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+        } | extra
+
+    def _update(self, **kwargs):
+        data = {'update_id': next(self._update_ids)} | kwargs
+        return Update.de_json(data, self.bot)
+
+    def text(self, user_id, text):
+        return self._update(message=self._message(user_id, text=text))
+
+    def command(self, user_id, command):
+        return self._update(message=self._message(
+            user_id, text=command,
+            entities=[{'type': 'bot_command', 'offset': 0,
+                       'length': len(command.split()[0])}]))
+
+    def photo(self, user_id, caption=None):
+        photo = [{'file_id': f'in{user_id}', 'file_unique_id': f'in{user_id}',
+                  'width': 640, 'height': 480, 'file_size': 1}]
+        extra = {'caption': caption} if caption else {}
+        return self._update(message=self._message(user_id, photo=photo,
+                                                  **extra))
+
+    def album(self, user_id, size, caption=None):
+        # one update per photo, the caption comes with the first one
+        group = f'album{next(self._update_ids)}'
+        updates = []
+        for number in range(size):
+            photo = [{'file_id': f'in{user_id}_{number}',
+                      'file_unique_id': f'in{user_id}_{number}',
+                      'width': 640, 'height': 480, 'file_size': 1}]
+            extra = {'caption': caption} if caption and not number else {}
+            updates.append(self._update(message=self._message(
+                user_id, photo=photo, media_group_id=group, **extra)))
+        return updates
+
+    def callback(self, user_id, data):
+        return self._update(callback_query={
+            'id': str(next(self._update_ids)),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': self._message(user_id, text='menu'),
+        })
+
+
+class StageStats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.exceptions = 0
+
+    def all_latencies(self):
+        return [x for samples in self.latencies.values() for x in samples]
+
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def monitor_loop_lag(samples: list, interval=0.05):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+async def run_scenario(application, factory, user_id, name, stats):
+    model_keys = bot.models_config['available_models']
+    orientations = list(bot.modes_config['orientation'].keys())
+    if name == 'text':
+        update = factory.text(user_id, random.choice(PROMPTS))
+    elif name == 'photo_caption':
+        update = factory.photo(user_id, random.choice(PROMPTS))
+    elif name == 'photo':
+        update = factory.photo(user_id)
+    elif name == 'album_caption':
+        updates = factory.album(user_id, random.randint(2, 4),
+                                random.choice(PROMPTS))
+        start = time.perf_counter()
+        await asyncio.gather(*map(application.process_update, updates))
+        stats.latencies[name].append(time.perf_counter() - start)
+        return
+    elif name == 'set_model':
+        update = factory.callback(user_id,
+                                  f'set_model|{random.choice(model_keys)}')
+    elif name == 'orientation':
+        update = factory.callback(user_id,
+                                  f'orientation|{random.choice(orientations)}')
+    elif name == 'retry':
+        update = factory.command(user_id, '/retry')
+    else:
+        # start a generation and cancel it while it runs
+        generation = asyncio.create_task(application.process_update(
+            factory.text(user_id, random.choice(PROMPTS))))
+        await asyncio.sleep(random.uniform(0.0, 0.2))
+        update = factory.command(user_id, '/cancel')
+        start = time.perf_counter()
+        await application.process_update(update)
+        stats.latencies[name].append(time.perf_counter() - start)
+        await generation
+        return
+
+    start = time.perf_counter()
+    await application.process_update(update)
+    stats.latencies[name].append(time.perf_counter() - start)
+
+
+async def virtual_user(application, factory, user_id, start_delay,
+                       stop_at, think_time, stats):
+    await asyncio.sleep(start_delay)
+    names, weights = zip(*SCENARIOS.items())
+    while time.perf_counter() < stop_at:
+        name = random.choices(names, weights)[0]
+        try:
+            await run_scenario(application, factory, user_id, name, stats)
+        except Exception:
+            stats.exceptions += 1
+        await asyncio.sleep(random.expovariate(1 / think_time))
+
+
+def summarize_stage(users, duration, stats, lag, rss_start, rss_end,
+                    transport, replies_before) -> dict:
+    latencies = stats.all_latencies()
+    replies = transport.replies - replies_before
+    dialogs = bot.dialogs_config
+    return {
+        'users': users,
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / duration,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'per_scenario': {
+            name: {'requests': len(samples),
+                   'p50': percentile(samples, 50),
+                   'p95': percentile(samples, 95),
+                   'p99': percentile(samples, 99)}
+            for name, samples in stats.latencies.items()
+        },
+        'exceptions': stats.exceptions,
+        'generation_errors': replies[dialogs['error']['generation_error']],
+        'busy_rejections': replies[dialogs['warning']['wait_or_cancel']],
+        'loop_lag_p99': percentile(lag, 99),
+        'loop_lag_max': max(lag, default=0.0),
+        'rss_start_mb': rss_start / 2**20,
+        'rss_end_mb': rss_end / 2**20,
+        'rss_growth_mb': (rss_end - rss_start) / 2**20,
+    }
+
+
+def print_stage(stage):
+    print(f'{stage["users"]:>6}{stage["requests"]:>9}'
+          f'{stage["throughput_rps"]:>9.2f}'
+          f'{stage["p50"]:>9.2f}{stage["p95"]:>9.2f}{stage["p99"]:>9.2f}'
+          f'{stage["loop_lag_p99"] * 1e3:>10.1f}'
+          f'{stage["rss_growth_mb"]:>10.1f}'
+          f'{stage["exceptions"] + stage["generation_errors"]:>8}')
+
+
+def setup_bot(temp_dir: Path, backend_urls: list, translate_latency: float):
+    Singleton._instances.pop(StableDiffusionAccess, None)
+    bot.stable_api = StableDiffusionAccess(
+        temp_dir=temp_dir / 'temp', model_config_obj=bot.models_config,
+        backends_config=backend_urls,
+        load_control_config=bot.modes_config.data.get('load_control'),
+        lanes_config=bot.modes_config.data.get('available_generations'))
+    tenant = Tenant('load', data_dir=temp_dir)
+    tenant.database = AsyncDatabase(Database(temp_dir / 'db.db'))
+    tenant.file_id_cache = FileIdCache(temp_dir / 'file_ids.db',
+                                       thread=tenant.database.thread)
+    tenant.job_journal = JobJournal(temp_dir / 'jobs.db',
+                                    thread=tenant.database.thread)
+    bot.tenants[:] = [tenant]
+
+    async def translate_prompt(prompt):
+        await asyncio.sleep(translate_latency)
+        return prompt
+
+    bot.translate_prompt = translate_prompt
+
+
+async def main(args):
+    servers = [FakeWebUI(latency=args.webui_latency,
+                         swap_latency=args.swap_latency,
+                         upscale_latency=args.webui_latency / 4).start()
+               for _ in range(args.backends)]
+    transport = MockTelegramTransport(latency=args.tg_latency)
+    stages = []
+    if args.target_latency is not None:
+        bot.modes_config.data['load_control'] = {
+            'enabled': True, 'target_latency': args.target_latency}
+    with tempfile.TemporaryDirectory() as temp:
+        setup_bot(Path(temp), [s.url for s in servers],
+                  args.translate_latency)
+        application = bot.build_application(
+            whitelist_filter=False, request=transport,
+            rate_limiter=not args.no_rate_limiter)
+        await application.initialize()
+        factory = UpdateFactory(application.bot)
+
+        print(f'{"users":>6}{"reqs":>9}{"rps":>9}{"p50 s":>9}{"p95 s":>9}'
+              f'{"p99 s":>9}{"lag ms":>10}{"rss +MB":>10}{"errors":>8}')
+        user_ids = itertools.count(1000)
+        for users in args.users:
+            stats = StageStats()
+            lag = []
+            monitor = asyncio.create_task(monitor_loop_lag(lag))
+            replies_before = transport.replies.copy()
+            rss_start = rss_bytes()
+            start = time.perf_counter()
+            stop_at = start + args.ramp + args.duration
+            await asyncio.gather(*[
+                virtual_user(application, factory, next(user_ids),
+                             args.ramp * i / users, stop_at,
+                             args.think_time, stats)
+                for i in range(users)])
+            elapsed = time.perf_counter() - start
+            monitor.cancel()
+            stage = summarize_stage(users, elapsed, stats, lag, rss_start,
+                                    rss_bytes(), transport, replies_before)
+            stages.append(stage)
+            print_stage(stage)
+
+        await application.shutdown()
+        for tenant in bot.tenants:
+            tenant.database.close()
+    for server in servers:
+        server.stop()
+
+    profiles = {f'{model}/{profile}': int(count) for (model, profile), count
+                in metrics.GENERATION_PROFILE._values.items()}
+    print('Generation profiles:', profiles)
+
+    path = write_results('load', {'stages': stages}, args.output, extra={
+        'settings': vars(args),
+        'generation_profiles': profiles,
+        'telegram_calls': dict(transport.calls),
+        'uploaded_photos': transport.uploaded_photos,
+        'referenced_photos': transport.referenced_photos,
+    })
+    print(f'Results written to {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulated-user load test for the bot handlers')
+    parser.add_argument('--users', type=lambda s: [int(x) for x in s.split(',')],
+                        default=[1, 5, 10, 25],
+                        help='Comma separated virtual user counts, one stage each')
+    parser.add_argument('--duration', type=float, default=20.0,
+                        help='Seconds each stage runs after ramp-up')
+    parser.add_argument('--ramp', type=float, default=5.0,
+                        help='Seconds over which a stage starts its users')
+    parser.add_argument('--think-time', type=float, default=2.0,
+                        help='Mean pause between one user\'s requests')
+    parser.add_argument('--backends', type=int, default=1)
+    parser.add_argument('--webui-latency', type=float, default=0.2,
+                        help='Fake WebUI seconds per generated image')
+    parser.add_argument('--swap-latency', type=float, default=1.0)
+    parser.add_argument('--tg-latency', type=float, default=0.05,
+                        help='Mean Telegram API round trip')
+    parser.add_argument('--translate-latency', type=float, default=0.1)
+    parser.add_argument('--no-rate-limiter', action='store_true')
+    parser.add_argument('--target-latency', type=float,
+                        help='Enable load control with this latency target')
+    parser.add_argument('--output', help='Where to write the JSON report')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,106 @@
+import logging
+
+import metrics
+from backend_pool import BackendPool
+
+logger = logging.getLogger(__name__)
+
+# Generation profiles from the model's full settings down to the floor set
+# in the model's `adaptive` section of models.yml
+PROFILES = ['full', 'lean', 'fast', 'minimal']
+
+
+def job_cost(payload: dict) -> float:
+    # image steps, a hires pass costs roughly hr_scale^2 more per step
+    cost = payload.get('n_iter', 1) * payload.get('batch_size', 1) * \
+        payload.get('steps', 20)
+    if payload.get('enable_hr'):
+        cost *= 1 + payload.get('hr_scale', 2) ** 2
+    return cost
+
+
+# Picks a profile for every generation so the expected time from request to
+# result stays under target_latency. The estimate is the queue wait plus the
+# job cost times the smoothed seconds per image step. Under load it drops
+# straight to the first profile that fits, and recovers one profile at a time
+# once there is headroom
+class LoadController:
+    def __init__(self, pool: BackendPool, model_config,
+                 config: dict | None = None):
+        config = config or {}
+        self.pool = pool
+        self.model_config = model_config
+        self.enabled = config.get('enabled', False)
+        self.target_latency = config.get('target_latency', 60)
+        self.step_up_margin = config.get('step_up_margin', 0.7)
+        self.smoothing = config.get('smoothing', 0.3)
+
+        self.step_time = None
+        self.job_time = None
+        self.levels = {}
+
+    def apply(self, model_name: str, payload: dict, level: int) -> dict:
+        bounds = self.model_config[model_name].get('adaptive') or {}
+        min_n_iter = bounds.get('min_n_iter', payload['n_iter'])
+        min_steps = bounds.get('min_steps', payload['steps'])
+
+        out = dict(payload)
+        if level >= 1:
+            out['n_iter'] = max(min_n_iter, payload['n_iter'] // 2)
+            if bounds.get('disable_hr', False):
+                out['enable_hr'] = False
+        if level >= 2:
+            out['steps'] = max(min_steps, round(payload['steps'] * 0.7))
+            if bounds.get('fast_sampler'):
+                out['sampler_name'] = bounds['fast_sampler']
+        if level >= 3:
+            out['n_iter'] = min_n_iter
+            out['steps'] = min_steps
+        return out
+
+    def expected_wait(self) -> float:
+        if any(not b.busy for b in self.pool.backends):
+            return 0.0
+        # on average the running jobs are half done
+        jobs_ahead = self.pool.queue_depth + 0.5 * len(self.pool)
+        return jobs_ahead * self.job_time / len(self.pool)
+
+    def choose(self, model_name: str, payload: dict) -> tuple[str, dict]:
+        if not self.enabled or self.step_time is None:
+            return PROFILES[0], payload
+
+        wait = self.expected_wait()
+
+        def predicted(level):
+            return wait + job_cost(self.apply(model_name, payload, level)) \
+                * self.step_time
+
+        desired = len(PROFILES) - 1
+        for level in range(len(PROFILES)):
+            if predicted(level) <= self.target_latency:
+                desired = level
+                break
+
+        current = self.levels.get(model_name, 0)
+        if desired < current:
+            step_up = current - 1
+            if predicted(step_up) <= self.target_latency * self.step_up_margin:
+                desired = step_up
+            else:
+                desired = current
+
+        if desired != current:
+            logger.info('Load profile for %s: %s -> %s (expected wait %.1fs)',
+                        model_name, PROFILES[current], PROFILES[desired], wait)
+        self.levels[model_name] = desired
+        metrics.LOAD_LEVEL.set(desired, model=model_name)
+        return PROFILES[desired], self.apply(model_name, payload, desired)
+
+    def observe(self, payload: dict, generation_time: float, job_time: float):
+        step_time = generation_time / job_cost(payload)
+        if self.step_time is None:
+            self.step_time, self.job_time = step_time, job_time
+            return
+        a = self.smoothing
+        self.step_time = a * step_time + (1 - a) * self.step_time
+        self.job_time = a * job_time + (1 - a) * self.job_time
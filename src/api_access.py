@@ -1,16 +1,46 @@
+import asyncio
 import base64
+import contextlib
+import hashlib
 import io
+import itertools
+import json
 import logging
+import os
+import random
+import shutil
+import threading
+import time
 from difflib import get_close_matches
 from pathlib import Path
 from typing import List
 
 import requests
-from PIL import Image, PngImagePlugin
+from PIL import Image, ImageChops, PngImagePlugin
 
-from setup_handler import get_handler
+import metrics
+from adaptive import LoadController
+from backend_pool import Backend, BackendPool
+from response_stream import (Base64FileWriter, ImageStreamParser,
+                             png_text_chunk)
 
-URL = "http://127.0.0.1:7860"
+
+# connection failures and timeouts, plus HTTP 5xx, count against a backend
+def is_backend_failure(error: Exception) -> bool:
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(error, requests.HTTPError) and \
+        error.response is not None and error.response.status_code >= 500
+
+
+# images per generation request unless the caller overrides n_iter
+DEFAULT_N_ITER = 4
+
+
+def prompt_slug(prompt: str) -> str:
+    # first words of the prompt, safe to put into a file name
+    words = ''.join(c if c.isalnum() else ' ' for c in prompt).split()
+    return '_'.join(words[:5])[:80]
 
 
 class Singleton(type):
@@ -23,42 +53,106 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class GenerationResult(list):
+    # paths of the generated images, their seeds and the load profile
+    def __init__(self, paths, profile='full', seeds=None, total=None):
+        super().__init__(paths)
+        self.profile = profile
+        self.seeds = seeds or []
+        # images the whole generation makes once load control has chosen
+        # its settings, the parts of it included. None if not known
+        self.total = total
+
+
+# One in-flight WebUI job shared by every request with the same payload
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.refs = 0
+
+
 class StableDiffusionAccess(metaclass=Singleton):
     def __init__(self,
                  api_url="http://127.0.0.1:7860",
                  temp_dir='./temp/',
-                 model_config_obj=None):
-        self.model = ''
+                 model_config_obj=None,
+                 backends_config=None,
+                 load_control_config=None,
+                 deduplicate=True,
+                 health_config=None,
+                 lanes_config=None,
+                 tenant_weights=None):
         self.temp_dir = Path(temp_dir)
+        self.temp_dir.mkdir(parents=True, exist_ok=True)
         self.api_url = api_url
         if model_config_obj:
             self.model_config = model_config_obj
         else:
             raise KeyError('Please provide model_config class')
+        health_config = health_config or {}
+        self.pool = BackendPool(backends_config or [api_url], health_config,
+                                lanes_config, tenant_weights)
+        self.probe_timeout = health_config.get('probe_timeout', 3)
+        # the WebUI sends nothing until a job is done, so the read timeout
+        # bounds the whole generation
+        self.timeout = (health_config.get('connect_timeout', 5),
+                        health_config.get('read_timeout', 300))
+        self.retries = health_config.get('retries', 2)
+        self.retry_backoff = health_config.get('retry_backoff', 0.5)
+        self.load_control = LoadController(self.pool, self.model_config,
+                                           load_control_config)
+        self.deduplicate = deduplicate
+        self._flights = {}
+        self._job_ids = itertools.count(1)
 
         self.logger = logging.getLogger(__name__)
-        self.logger.addHandler(get_handler())
-        self.logger.setLevel(logging.DEBUG)
 
-    def is_connected(self):
+    def is_connected(self, backend: Backend | None = None, timeout=10):
         self.logger.debug('Call: is_connected')
-        r = requests.get(url=f"{self.api_url}/user")
+        url = backend.url if backend else self.api_url
+        r = requests.get(url=f"{url}/user", timeout=timeout)
         if r.status_code != 200:
             return False
         return True
 
-    def change_model(self, model_name):
+    def resolve_checkpoints(self, backend: Backend, timeout=None) -> dict:
+        self.logger.debug('Call: resolve_checkpoints')
+        model_checkpoints = self._retrying(self.get_sd_models, backend,
+                                           timeout or self.timeout)
+        resolved = {}
+        for model_name in self.model_config['available_models']:
+            checkpoint = self.model_config[model_name]['checkpoint']
+            matches = get_close_matches(checkpoint, model_checkpoints, n=1)
+            if matches:
+                resolved[model_name] = matches[0]
+            else:
+                self.logger.warning('No checkpoint on %s matches %s',
+                                    backend.url, checkpoint)
+        backend.checkpoints = resolved
+
+        # skip the first swap if the backend already has a model loaded
+        options = self._retrying(requests.get,
+                                 url=f'{backend.url}/sdapi/v1/options',
+                                 timeout=timeout or self.timeout).json()
+        for model_name, checkpoint in resolved.items():
+            if checkpoint == options.get('sd_model_checkpoint'):
+                backend.model = model_name
+        return resolved
+
+    def change_model(self, model_name, backend: Backend):
         self.logger.debug('Call: change_model')
-        params_dict = self.get_model_params(model_name)
-        model_checkpoints = self.get_sd_models()
-        my_checkpoint = get_close_matches(params_dict['checkpoint'],
-                                          model_checkpoints, n=1)[0]
-        self._set_model(my_checkpoint)
-        self.model = model_name
-
-    def get_sd_models(self):
+        if model_name not in backend.checkpoints:
+            self.resolve_checkpoints(backend)
+        self._retrying(self._set_model, backend.checkpoints[model_name],
+                       backend)
+        backend.model = model_name
+        backend.last_swap = time.monotonic()
+
+    def get_sd_models(self, backend: Backend | None = None, timeout=None):
         self.logger.debug('Call: get_sd_models')
-        response = requests.get(url=f'{self.api_url}/sdapi/v1/sd-models')
+        url = backend.url if backend else self.api_url
+        response = requests.get(url=f'{url}/sdapi/v1/sd-models',
+                                timeout=timeout)
         response = response.json()
         return [x['title'] for x in response]
 
@@ -66,56 +160,312 @@ class StableDiffusionAccess(metaclass=Singleton):
         self.logger.debug('Call: get_model_params')
 
         assert model_name in self.model_config['available_models']
-        out_dict = self.model_config[model_name]
-        out_dict.update(self.model_config[model_name]['default_params'])
+        # a copy, so img2img settings don't leak into later txt2img calls
+        out_dict = dict(self.model_config[model_name]['default_params'])
         if specific == 'img2img':
             out_dict.update(self.model_config[model_name]['img2img_params'])
         return out_dict
 
     def get_image_repr(self, img_path: Path):
         self.logger.debug('Call: get_image_repr')
+        with metrics.stage_timer('encode'):
+            return self._encode_image(Image.open(img_path))
+
+    @staticmethod
+    def _encode_image(image: Image.Image) -> str:
         buffered = io.BytesIO()
-        image = Image.open(img_path)
         image.save(buffered, format="PNG")
         img_base64 = 'data:image/png;base64,' + \
             str(base64.b64encode(buffered.getvalue()), 'utf-8')
         return img_base64
 
-    def _set_model(self, model_chk):
+    @staticmethod
+    def _encode_bytes(img_bytes: bytes) -> str:
+        # the WebUI opens anything PIL can, so downloaded photos go out as
+        # they came instead of being decoded and saved as PNG again
+        with Image.open(io.BytesIO(img_bytes)) as image:
+            mime = Image.MIME.get(image.format, 'image/png')
+        return f'data:{mime};base64,' + \
+            str(base64.b64encode(img_bytes), 'utf-8')
+
+    @staticmethod
+    def _image_size(source) -> tuple[int, int]:
+        with Image.open(source) as image:
+            return image.size
+
+    @staticmethod
+    def _decode_image(img_bytes: str) -> Image.Image:
+        return Image.open(io.BytesIO(
+            base64.b64decode(img_bytes.split(",", 1)[-1])))
+
+    def _set_model(self, model_chk, backend: Backend):
         options = {
             'sd_model_checkpoint': model_chk,
         }
-        requests.post(url=f'{self.api_url}/sdapi/v1/options', json=options)
-
-    def _pack_images(self, response, file_prefix, single_image=False) -> list[Path]:
-        r = response.json()
+        response = requests.post(url=f'{backend.url}/sdapi/v1/options',
+                                 json=options, timeout=self.timeout)
+        response.raise_for_status()
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter, so retries from many requests don't line up
+        return random.uniform(0, self.retry_backoff * 2 ** attempt)
+
+    def _retrying(self, fn, *args, **kwargs):
+        # only for idempotent calls, which are safe to repeat
+        for attempt in itertools.count():
+            try:
+                return fn(*args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = self._backoff(attempt)
+                self.logger.warning('%s failed with %r, retrying in %.2fs',
+                                    getattr(fn, '__name__', fn), e, delay)
+                time.sleep(delay)
+
+    @contextlib.contextmanager
+    def _health(self, backend: Backend):
+        # feeds the outcome of a backend call to its circuit breaker
+        try:
+            yield
+        except Exception as e:
+            if is_backend_failure(e):
+                self.pool.record_failure(backend)
+            raise
+        self.pool.record_success(backend)
+
+    async def probe(self, backend: Backend) -> bool:
+        try:
+            ok = await asyncio.to_thread(self.is_connected, backend,
+                                         self.probe_timeout)
+        except Exception:
+            ok = False
+        metrics.BACKEND_UP.set(int(ok), backend=backend.url)
+        self.pool.record_probe(backend, ok)
+        return ok
+
+    async def monitor_health(self, interval=5.0):
+        while True:
+            await asyncio.gather(*(self.probe(backend)
+                                   for backend in self.pool.backends))
+            await asyncio.sleep(interval)
+
+    async def _post(self, backend: Backend, endpoint: str, payload: dict):
+        # requests is blocking, keep it off the event loop
+        with metrics.stage_timer('webui_generation'):
+            return await asyncio.to_thread(self._request, backend, endpoint,
+                                           payload)
+
+    def _request(self, backend: Backend, endpoint: str, payload: dict):
+        # the WebUI answers once the job is done, the body is only read
+        # when the images get unpacked
+        response = requests.post(url=f'{backend.url}{endpoint}', json=payload,
+                                 stream=True, timeout=self.timeout)
+        if response.status_code != 200:
+            detail = response.text[:500]
+            response.close()
+            raise requests.HTTPError(
+                f'{endpoint} returned {response.status_code}: {detail}',
+                response=response)
+        return response
+
+    async def _prepare_backend(self, backend: Backend, model_name: str):
+        if backend.model != model_name:
+            with metrics.stage_timer('checkpoint_swap'):
+                await asyncio.to_thread(self.change_model, model_name, backend)
+
+    async def _generate(self, endpoint, model_name, payload, file_prefix,
+                        adaptive=True) -> GenerationResult:
+        profile = 'full'
+        if adaptive:
+            profile, payload = self.load_control.choose(model_name, payload)
+        images = await self._dispatch(endpoint, model_name, payload,
+                                      file_prefix, profile)
+        images.total = payload.get('n_iter', 1) * payload.get('batch_size', 1)
+        return images
+
+    async def _generate_parts(self, endpoint, model_name, payload, file_prefix,
+                              images_per_call=0, adaptive=True):
+        # Splits the batch into WebUI calls of images_per_call iterations and
+        # yields each part as soon as its files are written. Parts get
+        # consecutive seeds, so they are the same images the whole batch
+        # would have given
+        if not images_per_call or images_per_call >= payload['n_iter']:
+            yield await self._generate(endpoint, model_name, payload,
+                                       file_prefix, adaptive)
+            return
+
+        profile = 'full'
+        if adaptive:
+            profile, payload = self.load_control.choose(model_name, payload)
+        seed = payload.get('seed', -1)
+        if seed is None or seed < 0:
+            seed = random.randrange(2**32 - payload['n_iter'] *
+                                    payload.get('batch_size', 1))
+
+        total = payload['n_iter'] * payload.get('batch_size', 1)
+        tasks = []
+        for start in range(0, payload['n_iter'], images_per_call):
+            part = payload | {
+                'n_iter': min(images_per_call, payload['n_iter'] - start),
+                'seed': seed + start * payload.get('batch_size', 1),
+            }
+            # identical requests share parts by the payload they asked for,
+            # not by the seed picked here
+            tasks.append(asyncio.ensure_future(self._dispatch(
+                endpoint, model_name, part, f'{file_prefix}_{start}', profile,
+                key_data=[payload, start])))
+
+        delivered = set()
+        try:
+            for next_part in asyncio.as_completed(tasks):
+                images = await next_part
+                images.total = total
+                delivered.update(images)
+                yield images
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    for path in task.result():
+                        if path not in delivered:
+                            path.unlink(missing_ok=True)
+
+    async def _dispatch(self, endpoint, model_name, payload, file_prefix,
+                        profile, key_data=None) -> GenerationResult:
+        if not self.deduplicate:
+            job = await self._run_job(endpoint, model_name, payload, profile)
+            return self._claim_files(job, file_prefix, move=True)
+
+        key_data = payload if key_data is None else key_data
+        key = hashlib.sha256(json.dumps(
+            [endpoint, model_name, key_data], sort_keys=True).encode()).digest()
+        return await self._single_flight(
+            key, endpoint, file_prefix,
+            lambda: self._run_job(endpoint, model_name, payload, profile))
+
+    async def _single_flight(self, key, endpoint, file_prefix, job_factory):
+        # Requests with the same resolved payload share one WebUI job.
+        # Every caller links the job's files under its own names; the job
+        # is cancelled only when all its callers are cancelled
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(job_factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(
+                lambda _: self._drop_flight(key, flight))
+        else:
+            self.logger.debug('Joined an in-flight %s job', endpoint)
+            metrics.DEDUPLICATED.inc(endpoint=endpoint)
+
+        flight.refs += 1
+        try:
+            job = await asyncio.shield(flight.task)
+            return self._claim_files(job, file_prefix)
+        finally:
+            flight.refs -= 1
+            if flight.refs == 0:
+                if not flight.task.done():
+                    self._drop_flight(key, flight)
+                    flight.task.cancel()
+                elif not flight.task.cancelled() and \
+                        flight.task.exception() is None:
+                    for path in flight.task.result():
+                        path.unlink(missing_ok=True)
+
+    def _drop_flight(self, key, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _run_job(self, endpoint, model_name, payload, profile):
+        for attempt in itertools.count():
+            try:
+                return await self._run_job_once(endpoint, model_name,
+                                                payload, profile)
+            except requests.ConnectionError as e:
+                # the job never reached the WebUI, or died with it. Read
+                # timeouts are not retried, the WebUI may still be busy
+                if attempt >= self.retries:
+                    raise
+                delay = self._backoff(attempt)
+                self.logger.warning('%s failed with %r, retrying in %.2fs',
+                                    endpoint, e, delay)
+                await asyncio.sleep(delay)
+
+    async def _run_job_once(self, endpoint, model_name, payload, profile):
+        # diffusion lanes are named after their endpoints
+        lane = endpoint.rsplit('/', 1)[-1]
+        async with self.pool.use(model_name, lane) as backend:
+            with self._health(backend):
+                start = time.monotonic()
+                await self._prepare_backend(backend, model_name)
+                generation_start = time.monotonic()
+                response = await self._post(backend, endpoint, payload)
+                end = time.monotonic()
+        self.load_control.observe(payload, end - generation_start, end - start)
+        metrics.GENERATION_PROFILE.inc(model=model_name, profile=profile)
+
+        job = await asyncio.to_thread(self._pack_images, response,
+                                      f'job{next(self._job_ids)}')
+        job.profile = profile
+        return job
+
+    def _claim_files(self, job: GenerationResult, file_prefix,
+                     move=False) -> GenerationResult:
         paths_list = []
-
-        def save_img(number, img_bytes, img_info=None):
-            image = Image.open(io.BytesIO(
-                base64.b64decode(img_bytes.split(",", 1)[0])))
-
+        for number, path in enumerate(job):
+            file_path = self.temp_dir / f'{file_prefix}_gen_{number}.png'
+            if move:
+                os.replace(path, file_path)
+            else:
+                file_path.unlink(missing_ok=True)
+                try:
+                    os.link(path, file_path)
+                except OSError:
+                    shutil.copyfile(path, file_path)
+            paths_list.append(file_path)
+        return GenerationResult(paths_list, job.profile, job.seeds)
+
+    def _pack_images(self, response, file_prefix, single_image=False) -> GenerationResult:
+        with metrics.stage_timer('decode'):
+            return self._save_images(response, file_prefix, single_image)
+
+    def _save_images(self, response, file_prefix, single_image=False) -> GenerationResult:
+        # images are decoded into their files while the body streams in
+        parser = ImageStreamParser(lambda number: Base64FileWriter(
+            self.temp_dir / f'{file_prefix}_gen_{number}.png'))
+        try:
+            with response:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    parser.feed(chunk)
+            r = parser.result()
+
+            img_info = r['html_info'] if single_image else r['info']
+            text_chunk = png_text_chunk('parameters', img_info)
+            for writer in parser.writers:
+                if not writer.finish(text_chunk):
+                    # the WebUI can be set to answer with jpg or webp
+                    self._convert_to_png(writer.path, img_info)
+        except Exception:
+            # no partial images are left behind in temp
+            for writer in parser.writers:
+                writer.discard()
+            raise
+
+        seeds = [] if single_image else \
+            json.loads(r['info']).get('all_seeds', [])
+        return GenerationResult([w.path for w in parser.writers], seeds=seeds)
+
+    @staticmethod
+    def _convert_to_png(file_path: Path, img_info: str):
+        with Image.open(file_path) as image:
+            image.load()
             pnginfo = PngImagePlugin.PngInfo()
             pnginfo.add_text("parameters", img_info)
-            filename = f'{file_prefix}_gen_{number}.png'
-            file_path = self.temp_dir / filename
-            image.save(file_path, pnginfo=pnginfo)
-            paths_list.append(file_path)
-
-        if single_image:
-            save_img(0, r['image'], r['html_info'])
-        else:
-            for i, img_bytes in enumerate(r['images']):
-                save_img(i, img_bytes, r['info'])
-
-        return paths_list
-
-    async def txt2img(self, prompt: str, model_name: str,
-                      image_size: str, file_prefix='') -> list[Path]:
-        self.logger.debug('Call: txt2img')
-        if self.model != model_name:
-            self.change_model(model_name)
+            image.save(file_path, format='PNG', pnginfo=pnginfo)
 
+    def _txt2img_payload(self, prompt, model_name, image_size, overrides):
         model_payload = self.get_model_params(model_name)
         img_w, img_h = [int(s) for s in image_size.split('x')]
         payload = {
@@ -124,55 +474,100 @@ class StableDiffusionAccess(metaclass=Singleton):
             "height": img_h,
 
             "do_not_save_samples": True,
-            "n_iter": 4,
+            "n_iter": DEFAULT_N_ITER,
         }
         payload |= model_payload
+        payload |= overrides or {}
+        return payload
 
-        response = requests.post(url=f'{URL}/sdapi/v1/txt2img', json=payload)
-        file_prefix = file_prefix + '_' + '_'.join(prompt.split()[:5])
-
-        return self._pack_images(response, file_prefix)
-
-    async def img2img(self, prompt: str, model_name: str, image_size: str,
-                      img_path: str | Path, file_prefix='') -> list[Path]:
-        self.logger.debug('Call: img2img')
-        img_repr = self.get_image_repr(Path(img_path))
-
-        if self.model != model_name:
-            self.change_model(model_name)
-
+    def _img2img_payload(self, prompt, model_name, image_size, init_images,
+                         overrides=None):
         model_payload = self.get_model_params(model_name, specific='img2img')
         img_w, img_h = [int(s) for s in image_size.split('x')]
         payload = {
-            "init_images": [img_repr],
+            "init_images": init_images,
             "prompt": prompt,
             "width": img_w,
             "height": img_h,
 
             "do_not_save_samples": True,
-            "n_iter": 4,
+            "n_iter": DEFAULT_N_ITER,
         }
         payload |= model_payload
+        payload |= overrides or {}
+        return payload
 
-        response = requests.post(
-            url=f'{self.api_url}/sdapi/v1/img2img', json=payload)
-        file_prefix = file_prefix + '_' + '_'.join(prompt.split()[:5])
-        Path(img_path).unlink()
-
-        return self._pack_images(response, file_prefix)
-
-    async def upscale_img(self, resize_value: int,
-                          first_upscaler_name: str, second_upscaler_name: str | None, 
-                          second_upscaler_visibility: float,
-                          image_size: str, img_path: str | Path,
-                          other_settings = None, file_prefix='') -> list[Path]:
-        self.logger.debug('Call: upscale_img')
-        img_repr = self.get_image_repr(Path(img_path))
-
-        img_w, img_h = [int(s) for s in image_size.split('x')]
-        if img_w * img_h >= 1.5e6:
-            raise ValueError('Image is too large')
+    async def txt2img(self, prompt: str, model_name: str,
+                      image_size: str, file_prefix='', overrides=None,
+                      adaptive=True) -> GenerationResult:
+        self.logger.debug('Call: txt2img')
+        payload = self._txt2img_payload(prompt, model_name, image_size,
+                                        overrides)
+        file_prefix = file_prefix + '_' + prompt_slug(prompt)
+        return await self._generate('/sdapi/v1/txt2img', model_name, payload,
+                                    file_prefix, adaptive)
+
+    async def txt2img_parts(self, prompt: str, model_name: str,
+                            image_size: str, file_prefix='', overrides=None,
+                            adaptive=True, images_per_call=0):
+        self.logger.debug('Call: txt2img_parts')
+        payload = self._txt2img_payload(prompt, model_name, image_size,
+                                        overrides)
+        file_prefix = file_prefix + '_' + prompt_slug(prompt)
+        async for images in self._generate_parts(
+                '/sdapi/v1/txt2img', model_name, payload, file_prefix,
+                images_per_call, adaptive):
+            yield images
 
+    async def img2img(self, prompt: str, model_name: str, image_size: str,
+                      img_path: str | Path, file_prefix='') -> GenerationResult:
+        self.logger.debug('Call: img2img')
+        init_image = await asyncio.to_thread(self.get_image_repr,
+                                             Path(img_path))
+        payload = self._img2img_payload(
+            prompt, model_name, image_size, [init_image])
+        file_prefix = file_prefix + '_' + prompt_slug(prompt)
+        images = await self._generate('/sdapi/v1/img2img', model_name,
+                                      payload, file_prefix)
+        Path(img_path).unlink()
+        return images
+
+    async def img2img_parts(self, prompt: str, model_name: str,
+                            image_size: str, img_path: str | Path,
+                            file_prefix='', overrides=None,
+                            adaptive=True, images_per_call=0):
+        self.logger.debug('Call: img2img_parts')
+        init_image = await asyncio.to_thread(self.get_image_repr,
+                                             Path(img_path))
+        payload = self._img2img_payload(
+            prompt, model_name, image_size, [init_image], overrides)
+        Path(img_path).unlink()
+        file_prefix = file_prefix + '_' + prompt_slug(prompt)
+        async for images in self._generate_parts(
+                '/sdapi/v1/img2img', model_name, payload, file_prefix,
+                images_per_call, adaptive):
+            yield images
+
+    async def img2img_album(self, prompt: str, model_name: str,
+                            image_size: str, images: list[bytes],
+                            file_prefix='', overrides=None) -> GenerationResult:
+        # All photos of an album go into one batch, one result per photo.
+        # Load control stays off, it would change how many images come back
+        self.logger.debug('Call: img2img_album')
+        with metrics.stage_timer('encode'):
+            init_images = await asyncio.to_thread(
+                lambda: [self._encode_bytes(image) for image in images])
+        payload = self._img2img_payload(prompt, model_name, image_size,
+                                        init_images, overrides)
+        payload |= {'n_iter': 1, 'batch_size': len(images)}
+        file_prefix = file_prefix + '_' + prompt_slug(prompt)
+        return await self._generate('/sdapi/v1/img2img', model_name,
+                                    payload, file_prefix, adaptive=False)
+
+    @staticmethod
+    def _upscale_payload(resize_value, first_upscaler_name,
+                         second_upscaler_name, second_upscaler_visibility,
+                         other_settings=None) -> dict:
         if second_upscaler_name is None:
             second_upscaler_name = 'None'
         payload = {
@@ -182,15 +577,220 @@ class StableDiffusionAccess(metaclass=Singleton):
           "upscaler_2": second_upscaler_name,
           "extras_upscaler_2_visibility": second_upscaler_visibility,
           "upscale_first": False,
-          "image": img_repr,
         }
         if isinstance(other_settings, dict):
             payload |= other_settings
+        return payload
+
+    async def upscale_album(self, resize_value: int,
+                            first_upscaler_name: str,
+                            second_upscaler_name: str | None,
+                            second_upscaler_visibility: float,
+                            image_size: str, images: list[bytes],
+                            other_settings=None,
+                            file_prefix='') -> GenerationResult:
+        # photos small enough for a single pass go out in one
+        # extra-batch-images call, larger ones take the tiled path
+        self.logger.debug('Call: upscale_album')
+        upscaler = (resize_value, first_upscaler_name, second_upscaler_name,
+                    second_upscaler_visibility)
+        payload = self._upscale_payload(*upscaler, other_settings)
+        max_pixels = self.model_config['upscaler'].get('tiling', {}).get(
+            'max_single_pixels', 1.5e6)
+
+        sizes = await asyncio.to_thread(lambda: [
+            self._image_size(io.BytesIO(image)) for image in images])
+        batch, large = [], []
+        for index, (img_w, img_h) in enumerate(sizes):
+            (batch if img_w * img_h < max_pixels else large).append(index)
+
+        results = {}
+        if batch:
+            with metrics.stage_timer('encode'):
+                payload['imageList'] = await asyncio.to_thread(lambda: [
+                    {'data': self._encode_bytes(images[index]),
+                     'name': f'{index}.png'} for index in batch])
+            async with self.pool.use(lane='rescale') as backend:
+                with self._health(backend):
+                    response = await self._post(
+                        backend, '/sdapi/v1/extra-batch-images', payload)
+            paths = await asyncio.to_thread(self._pack_images, response,
+                                            file_prefix, True)
+            results |= zip(batch, paths)
+        for index in large:
+            img_path = self.temp_dir / f'{file_prefix}_album_{index}.png'
+            img_path.write_bytes(images[index])
+            results[index], = await self.upscale_img(
+                *upscaler, image_size, img_path,
+                other_settings=other_settings,
+                file_prefix=f'{file_prefix}_{index}')
+        return GenerationResult([results[index] for index in sorted(results)])
 
-        response = requests.post(
-            url=f'{self.api_url}/sdapi/v1/extra-single-image', json=payload)
+    async def upscale_img(self, resize_value: int,
+                          first_upscaler_name: str, second_upscaler_name: str | None,
+                          second_upscaler_visibility: float,
+                          image_size: str, img_path: str | Path,
+                          other_settings=None, file_prefix='') -> list[Path]:
+        self.logger.debug('Call: upscale_img')
+        payload = self._upscale_payload(
+            resize_value, first_upscaler_name, second_upscaler_name,
+            second_upscaler_visibility, other_settings)
+
+        tiling = self.model_config['upscaler'].get('tiling', {})
+        max_pixels = tiling.get('max_single_pixels', 1.5e6)
+        img_w, img_h = await asyncio.to_thread(self._image_size, img_path)
+
+        if img_w * img_h < max_pixels:
+            payload['image'] = await asyncio.to_thread(self.get_image_repr,
+                                                       Path(img_path))
+            async with self.pool.use(lane='rescale') as backend:
+                with self._health(backend):
+                    response = await self._post(
+                        backend, '/sdapi/v1/extra-single-image', payload)
+            Path(img_path).unlink()
+            return await asyncio.to_thread(self._pack_images, response,
+                                           file_prefix, True)
+
+        file_path = await self._upscale_tiled(
+            Path(img_path), payload, resize_value, file_prefix,
+            tile_size=tiling.get('tile_size', 768),
+            overlap=tiling.get('overlap', 32),
+            batch_size=tiling.get('batch_size', 4))
         Path(img_path).unlink()
-
-        return self._pack_images(response, file_prefix, single_image=True)
-
-
+        return GenerationResult([file_path])
+
+    @staticmethod
+    def _tile_boxes(img_w, img_h, tile_size, overlap) -> list[tuple]:
+        def starts(length):
+            if length <= tile_size:
+                return [0]
+            step = tile_size - overlap
+            out = list(range(0, length - tile_size, step))
+            out.append(length - tile_size)
+            return out
+
+        return [(x, y, min(x + tile_size, img_w), min(y + tile_size, img_h))
+                for y in starts(img_h) for x in starts(img_w)]
+
+    @staticmethod
+    def _seam_mask(size, ramp_left, ramp_top) -> Image.Image:
+        # linear alpha ramp over the overlap shared with the tiles
+        # to the left and above, which are always pasted earlier
+        width, height = size
+        mask = Image.new('L', size, 255)
+        if ramp_left:
+            left = Image.new('L', size, 255)
+            left.paste(Image.linear_gradient('L').rotate(90).resize(
+                (ramp_left, height)), (0, 0))
+            mask = ImageChops.darker(mask, left)
+        if ramp_top:
+            top = Image.new('L', size, 255)
+            top.paste(Image.linear_gradient('L').resize(
+                (width, ramp_top)), (0, 0))
+            mask = ImageChops.darker(mask, top)
+        return mask
+
+    async def _upscale_tiled(self, img_path: Path, payload: dict,
+                             resize_value: int, file_prefix: str,
+                             tile_size=768, overlap=32, batch_size=4) -> Path:
+        self.logger.debug('Call: _upscale_tiled')
+        source = await asyncio.to_thread(
+            lambda: Image.open(img_path).convert('RGB'))
+        img_w, img_h = source.size
+        boxes = self._tile_boxes(img_w, img_h, tile_size, overlap)
+        self.logger.debug('Upscaling %dx%d in %d tiles', img_w, img_h, len(boxes))
+
+        # the source and the upscaled result are held whole, the tiles
+        # in between are bounded below
+        result = Image.new(
+            'RGB', (int(img_w * resize_value), int(img_h * resize_value)))
+        batches = [list(range(i, min(i + batch_size, len(boxes))))
+                   for i in range(0, len(boxes), batch_size)]
+        # tiles are blended in raster order, so finished batches wait
+        # here until every tile before them has been pasted
+        ready = {}
+        next_tile = 0
+        html_info = ''
+        # a batch starts only once the one a window earlier is pasted, so
+        # at most a window of batches waits in ready. The window is what
+        # the rescale lane can run at once
+        lane = self.pool.lanes['rescale']
+        window = len(self.pool.available_backends('rescale')) or 1
+        if lane.concurrency:
+            window = min(window, lane.concurrency)
+        pasted = [asyncio.Event() for _ in batches]
+
+        paste_lock = threading.Lock()
+
+        def paste_ready():
+            nonlocal next_tile
+            with paste_lock:
+                while next_tile in ready:
+                    tile = ready.pop(next_tile)
+                    x0, y0, _, _ = boxes[next_tile]
+                    ramp_left = overlap if x0 > 0 else 0
+                    ramp_top = overlap if y0 > 0 else 0
+                    mask = self._seam_mask(
+                        tile.size, int(ramp_left * resize_value),
+                        int(ramp_top * resize_value))
+                    result.paste(tile, (int(x0 * resize_value),
+                                        int(y0 * resize_value)), mask)
+                    next_tile += 1
+
+        def mark_pasted():
+            for number, indexes in enumerate(batches):
+                if indexes[-1] < next_tile:
+                    pasted[number].set()
+
+        async def run_batch(number, indexes):
+            nonlocal html_info
+            if number >= window:
+                await pasted[number - window].wait()
+            async with self.pool.use(lane='rescale') as backend:
+                # encode only once a backend is free, so at most one
+                # batch per backend is held in memory as base64
+                with metrics.stage_timer('encode'):
+                    image_list = await asyncio.to_thread(lambda: [
+                        {'data': self._encode_image(source.crop(boxes[i])),
+                         'name': f'tile_{i}.png'} for i in indexes])
+                batch_payload = payload | {'imageList': image_list}
+                del image_list
+                with self._health(backend):
+                    response = await self._post(
+                        backend, '/sdapi/v1/extra-batch-images',
+                        batch_payload)
+
+            def decode_tiles():
+                r = response.json()
+                for i, img_bytes in zip(indexes, r['images']):
+                    x0, y0, x1, y1 = boxes[i]
+                    expected = (int((x1 - x0) * resize_value),
+                                int((y1 - y0) * resize_value))
+                    tile = self._decode_image(img_bytes).convert('RGB')
+                    if tile.size != expected:
+                        tile = tile.resize(expected, Image.LANCZOS)
+                    ready[i] = tile
+                return r.get('html_info', '')
+
+            with metrics.stage_timer('decode'):
+                html_info = await asyncio.to_thread(decode_tiles) or html_info
+                await asyncio.to_thread(paste_ready)
+            mark_pasted()
+
+        tasks = [asyncio.create_task(run_batch(number, indexes))
+                 for number, indexes in enumerate(batches)]
+        try:
+            await asyncio.gather(*tasks)
+        except Exception:
+            # the image is lost with one tile, so the other batches give
+            # back their backends instead of upscaling for nothing
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text("parameters", html_info)
+        file_path = self.temp_dir / f'{file_prefix}_gen_0.png'
+        await asyncio.to_thread(result.save, file_path, pnginfo=pnginfo)
+        return file_path
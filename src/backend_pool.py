@@ -0,0 +1,346 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import time
+from collections import deque
+
+import metrics
+from tenants import current_tenant_name
+
+
+class BackendUnavailable(Exception):
+    pass
+
+
+# Takes a backend out after failure_threshold consecutive failed requests
+# or probes. Once open_seconds pass, or a probe answers, it is half-open
+# and gets one trial job: a success closes it, a failure opens it again
+# for twice as long, up to max_open_seconds
+class CircuitBreaker:
+    def __init__(self, failure_threshold=3, open_seconds=10,
+                 max_open_seconds=120):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.failure_threshold:
+            return 'closed'
+        if time.monotonic() < self.open_until:
+            return 'open'
+        return 'half_open'
+
+    def allows(self) -> bool:
+        return self.state != 'open'
+
+    def success(self) -> bool:
+        # True if this closed an open or half-open circuit
+        recovered = self.failures >= self.failure_threshold
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        return recovered
+
+    def failure(self) -> bool:
+        # True if this opened the circuit
+        was_open = self.state == 'open'
+        self.failures += 1
+        if self.failures < self.failure_threshold or was_open:
+            return False
+        self.trips += 1
+        self.open_until = time.monotonic() + min(
+            self.max_open_seconds, self.open_seconds * 2 ** (self.trips - 1))
+        return True
+
+    def probe_ok(self) -> bool:
+        # a probe only lets an open circuit try a job, it doesn't close it,
+        # since a wedged WebUI still answers probes
+        if self.state != 'open':
+            return False
+        self.open_until = time.monotonic()
+        return True
+
+
+# Actions with their own queue and concurrency limit. Diffusion lanes run
+# checkpoints, rescale only needs the upscalers every WebUI has
+LANES = ('txt2img', 'img2img', 'rescale')
+DIFFUSION_LANES = ('txt2img', 'img2img')
+
+
+class Lane:
+    def __init__(self, name: str, concurrency=0, priority=0, long_queue=0):
+        self.name = name
+        # backends the lane may hold at once, 0 for no limit
+        self.concurrency = concurrency
+        # a freed backend goes to the waiting lane with the lowest priority
+        self.priority = priority
+        # queue depth from which users are told they have to wait
+        self.long_queue = long_queue
+        self.active = 0
+        self.waiters = deque()
+
+    def has_room(self) -> bool:
+        return not self.concurrency or self.active < self.concurrency
+
+    def is_long(self) -> bool:
+        return bool(self.long_queue) and len(self.waiters) >= self.long_queue
+
+    def __repr__(self):
+        return f'Lane({self.name})'
+
+
+class Backend:
+    def __init__(self, url: str, breaker: CircuitBreaker | None = None,
+                 capabilities=LANES):
+        self.url = url.rstrip('/')
+        self.model = ''
+        self.checkpoints = {}
+        self.busy = False
+        self.lane = None
+        self.tenant = None
+        self.acquired_at = 0.0
+        self.idle_since = time.monotonic()
+        self.last_swap = 0.0
+        self.breaker = breaker or CircuitBreaker()
+        self.capabilities = frozenset(capabilities)
+
+    @property
+    def runs_diffusion(self) -> bool:
+        return any(lane in self.capabilities for lane in DIFFUSION_LANES)
+
+    def __repr__(self):
+        return f'Backend({self.url})'
+
+
+# Hands out WebUI backends one job at a time. A backend runs a single
+# job, so checkpoint swaps and generations never interleave on it.
+# Every action waits in its own lane, so a quick rescale doesn't queue
+# behind diffusion jobs: a freed backend goes to the lane with the lowest
+# priority value that has room. Within a lane the tenants share the
+# backends by weight: the waiter whose tenant used the least backend time
+# per unit of weight goes first, FIFO among one tenant's jobs
+class BackendPool:
+    def __init__(self, backends_config: list, health_config: dict | None = None,
+                 lanes_config: dict | None = None,
+                 weights: dict | None = None):
+        health_config = health_config or {}
+        self.backends = []
+        for item in backends_config:
+            url = item['url'] if isinstance(item, dict) else item
+            capabilities = (item.get('capabilities') or LANES) \
+                if isinstance(item, dict) else LANES
+            if set(capabilities) - set(LANES):
+                raise ValueError(f'Unknown capabilities of {url}: '
+                                 f'{set(capabilities) - set(LANES)}')
+            breaker = CircuitBreaker(
+                health_config.get('failure_threshold', 3),
+                health_config.get('open_seconds', 10),
+                health_config.get('max_open_seconds', 120))
+            self.backends.append(Backend(url, breaker, capabilities))
+        if not self.backends:
+            raise ValueError('At least one WebUI backend is required')
+
+        lanes_config = lanes_config or {}
+        self.lanes = {}
+        for name in LANES:
+            unknown = set(lanes_config.get(name) or {}) - \
+                {'concurrency', 'priority', 'long_queue'}
+            if unknown:
+                raise ValueError(f'Unknown settings of lane {name}: {unknown}')
+            self.lanes[name] = Lane(name, **(lanes_config.get(name) or {}))
+        self._order = itertools.count()
+        self.weights = weights or {}
+        # backend seconds used by every tenant, divided by its weight
+        self._usage = {}
+
+        self.logger = logging.getLogger(__name__)
+        for name in LANES:
+            if not any(name in b.capabilities for b in self.backends):
+                self.logger.warning('No WebUI backend can run %s', name)
+
+    def __len__(self):
+        return len(self.backends)
+
+    def available_backends(self, lane=None) -> list[Backend]:
+        return [b for b in self.backends if b.breaker.allows()
+                and (lane is None or lane in b.capabilities)]
+
+    def _pick_idle(self, lane: str, model_name=None):
+        idle = [b for b in self.backends if not b.busy and
+                b.breaker.allows() and lane in b.capabilities]
+        if not idle:
+            return None
+        for backend in idle:
+            if model_name is not None and backend.model == model_name:
+                return backend
+        # keep the backends that can run everything for jobs that need them
+        return min(idle, key=lambda b: len(b.capabilities))
+
+    @property
+    def queue_depth(self):
+        return sum(len(lane.waiters) for lane in self.lanes.values())
+
+    def _update_queue_metrics(self, lane: Lane):
+        metrics.BACKEND_QUEUE.set(len(lane.waiters), lane=lane.name)
+
+    def waiting_models(self) -> list:
+        return [model_name for lane in self.lanes.values()
+                for future, model_name, _, _ in lane.waiters
+                if model_name is not None and not future.done()]
+
+    def try_acquire(self, backend: Backend) -> bool:
+        # takes a specific backend only if nobody is using or waiting for it.
+        # Jobs queued in lanes the backend can't serve right now don't count
+        if backend.busy or not backend.breaker.allows() or \
+                self._next_waiter(backend) is not None:
+            return False
+        backend.busy = True
+        return True
+
+    def _assign(self, backend: Backend, lane: Lane, tenant: str):
+        backend.busy = True
+        backend.lane = lane
+        backend.tenant = tenant
+        backend.acquired_at = time.monotonic()
+        lane.active += 1
+
+    def _active_tenants(self) -> set:
+        waiting = {tenant for lane in self.lanes.values()
+                   for future, _, _, tenant in lane.waiters
+                   if not future.done()}
+        return waiting | {b.tenant for b in self.backends
+                          if b.busy and b.tenant is not None}
+
+    def _catch_up(self, tenant: str):
+        # a tenant that was idle starts level with the busy ones instead of
+        # cashing in the time it didn't use
+        active = self._active_tenants()
+        if tenant in active or not active:
+            return
+        floor = min(self._usage.get(other, 0.0) for other in active)
+        self._usage[tenant] = max(self._usage.get(tenant, 0.0), floor)
+
+    async def acquire(self, model_name=None, lane='txt2img') -> Backend:
+        lane = self.lanes[lane]
+        tenant = current_tenant_name()
+        if not self.available_backends(lane.name):
+            raise BackendUnavailable(f'No healthy WebUI backend for {lane.name}')
+        with metrics.stage_timer('queue_wait'):
+            self._catch_up(tenant)
+            if lane.has_room() and not lane.waiters:
+                backend = self._pick_idle(lane.name, model_name)
+                if backend is not None:
+                    self._assign(backend, lane, tenant)
+                    return backend
+
+            future = asyncio.get_running_loop().create_future()
+            waiter = (future, model_name, next(self._order), tenant)
+            lane.waiters.append(waiter)
+            self._update_queue_metrics(lane)
+            try:
+                return await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled() and \
+                        future.exception() is None:
+                    self.release(future.result())
+                else:
+                    # _next_waiter skips and drops waiters cancelled meanwhile
+                    with contextlib.suppress(ValueError):
+                        lane.waiters.remove(waiter)
+                    self._update_queue_metrics(lane)
+                raise
+
+    def release(self, backend: Backend):
+        if backend.lane is not None:
+            backend.lane.active -= 1
+            backend.lane = None
+        if backend.tenant is not None:
+            tenant = backend.tenant
+            held = time.monotonic() - backend.acquired_at
+            self._usage[tenant] = self._usage.get(tenant, 0.0) + \
+                held / self.weights.get(tenant, 1.0)
+            backend.tenant = None
+        backend.busy = False
+        if backend.breaker.allows():
+            self._hand_over(backend)
+        # a lane that just got room may be waiting while other backends idle
+        for other in self.backends:
+            if not other.busy and other.breaker.allows():
+                self._hand_over(other)
+        if not backend.busy:
+            backend.idle_since = time.monotonic()
+
+    def _next_waiter(self, backend: Backend):
+        best = None
+        for lane in self.lanes.values():
+            if lane.name not in backend.capabilities or not lane.has_room():
+                continue
+            # drop the waiters cancelled meanwhile
+            for waiter in [w for w in lane.waiters if w[0].done()]:
+                lane.waiters.remove(waiter)
+            for waiter in lane.waiters:
+                _, _, order, tenant = waiter
+                rank = (lane.priority, self._usage.get(tenant, 0.0), order)
+                if best is None or rank < best[0]:
+                    best = (rank, lane, waiter)
+        return best and best[1:]
+
+    def _hand_over(self, backend: Backend) -> bool:
+        picked = self._next_waiter(backend)
+        if picked is None:
+            return False
+        lane, waiter = picked
+        lane.waiters.remove(waiter)
+        self._update_queue_metrics(lane)
+        future, _, _, tenant = waiter
+        # the backend stays busy and goes straight to the waiter
+        self._assign(backend, lane, tenant)
+        future.set_result(backend)
+        return True
+
+    def record_success(self, backend: Backend):
+        if backend.breaker.success():
+            self.logger.info('WebUI backend %s recovered', backend.url)
+            metrics.BACKEND_CIRCUIT_OPEN.set(0, backend=backend.url)
+
+    def record_failure(self, backend: Backend):
+        if not backend.breaker.failure():
+            return
+        self.logger.warning(
+            'WebUI backend %s taken out for %.0fs after %d failures',
+            backend.url, backend.breaker.open_until - time.monotonic(),
+            backend.breaker.failures)
+        metrics.BACKEND_CIRCUIT_OPEN.set(1, backend=backend.url)
+        for lane in self.lanes.values():
+            if self.available_backends(lane.name):
+                continue
+            # nobody in this queue would get a backend any time soon
+            while lane.waiters:
+                future, _, _, _ = lane.waiters.popleft()
+                if not future.done():
+                    future.set_exception(BackendUnavailable(
+                        f'No healthy WebUI backend for {lane.name}'))
+            self._update_queue_metrics(lane)
+
+    def record_probe(self, backend: Backend, ok: bool):
+        if not ok:
+            self.record_failure(backend)
+        elif backend.breaker.probe_ok():
+            self.logger.info('WebUI backend %s answers again, trying a job',
+                             backend.url)
+            metrics.BACKEND_CIRCUIT_OPEN.set(0, backend=backend.url)
+            if not backend.busy:
+                self._hand_over(backend)
+
+    @contextlib.asynccontextmanager
+    async def use(self, model_name=None, lane='txt2img'):
+        backend = await self.acquire(model_name, lane)
+        try:
+            yield backend
+        finally:
+            self.release(backend)
@@ -1,45 +1,146 @@
 import asyncio
 import argparse
+import contextlib
+import functools
 import html
 import json
 import logging
 import logging.handlers
+import signal
+import time
 import traceback
-from io import BytesIO
+from datetime import datetime
 from pathlib import Path
 from typing import List
 
 import telegram
-import translators as ts
-from PIL import Image
 from telegram import (BotCommand, InlineKeyboardButton, InlineKeyboardMarkup,
                       InputMediaPhoto, Update, User, InputMediaDocument)
-from telegram.constants import ChatAction, ParseMode
+from telegram.constants import ChatAction, ChatType, ParseMode
 from telegram.ext import (AIORateLimiter, Application, ApplicationBuilder,
                           CallbackContext, CallbackQueryHandler,
-                          CommandHandler, MessageHandler, filters)
-
-from api_access import StableDiffusionAccess
-from config import LoadConfig, SecretsAccess
-from database_access import Database
-from setup_handler import get_handler
-
-# ts.preaccelerate()
+                          CommandHandler, MessageHandler, TypeHandler,
+                          filters)
+
+from api_access import (DEFAULT_N_ITER, GenerationResult,
+                        StableDiffusionAccess)
+from backend_pool import BackendUnavailable
+from config import load_config, reload_configs
+import metrics
+import tracing
+from database_access import AsyncDatabase, Database
+from file_id_cache import FileIdCache
+from generation_store import GenerationStore
+from job_journal import JobJournal
+from prewarm import CheckpointPrewarmer
+from setup_handler import setup_logging
+import tenants as tenant_module
+from tenants import TenantLocal, load_tenants
 
 logger = logging.getLogger(__name__)
-logger.addHandler(get_handler())
-logger.setLevel(logging.DEBUG)
-
-user_semaphores = {}
-user_tasks = {}
-
-modes_config = LoadConfig('./configs/usage_modes.yml')
-models_config = LoadConfig('./configs/models.yml')
-dialogs_config = LoadConfig('./configs/dialogs.yml')
-secrets_config = SecretsAccess('./info')
 
-database = Database('./info/db.db')
-stable_api = StableDiffusionAccess(model_config_obj=models_config)
+modes_config = load_config('./configs/usage_modes.yml')
+models_config = load_config('./configs/models.yml')
+tracing_config = modes_config.data.get('tracing', {})
+store_config = modes_config.data.get('generation_store', {})
+
+# every bot of the process, loaded from ./configs/tenants.yml
+tenants = []
+
+# per-tenant state, resolved to the bot handling the current update
+dialogs_config = TenantLocal('dialogs')
+secrets_config = TenantLocal('secrets')
+database = TenantLocal('database')
+file_id_cache = TenantLocal('file_id_cache')
+job_journal = TenantLocal('job_journal')
+generation_store = TenantLocal('generation_store')
+user_semaphores = TenantLocal('user_semaphores')
+user_tasks = TenantLocal('user_tasks')
+# photos of albums still arriving, by user and media group
+albums = TenantLocal('albums')
+
+# created by init_resources, so importing the module stays cheap
+stable_api = None
+
+
+def init_resources():
+    global stable_api
+    setup_logging(modes_config.data.get('logging'))
+    tracing.TRACER.configure(
+        keep_last=tracing_config.get('keep_last', 200),
+        slow_threshold=tracing_config.get('slow_threshold'),
+        slow_log_path=tracing_config.get('slow_log', './traces/slow.jsonl'))
+
+    # anything already set (e.g. by the load test) is kept
+    if not tenants:
+        tenants.extend(load_tenants('./configs/tenants.yml'))
+    for tenant in tenants:
+        tenant.data_dir.mkdir(parents=True, exist_ok=True)
+        if tenant.database is None:
+            tenant.database = AsyncDatabase(
+                Database(tenant.data_dir / 'db.db'))
+        if tenant.file_id_cache is None:
+            tenant.file_id_cache = FileIdCache(
+                tenant.data_dir / 'file_ids.db',
+                max_items=modes_config['bot_settings'].get(
+                    'file_id_cache_size', 5000),
+                thread=tenant.database.thread)
+        if tenant.job_journal is None:
+            tenant.job_journal = JobJournal(
+                tenant.data_dir / 'jobs.db',
+                keep_finished=modes_config.data.get('job_journal', {}).get(
+                    'keep_finished', 86400),
+                thread=tenant.database.thread)
+        if tenant.generation_store is None and store_config.get('enabled'):
+            tenant.generation_store = GenerationStore(
+                tenant.data_dir / 'store',
+                max_bytes=int(store_config.get('max_size_mb', 1024) * 2 ** 20),
+                thumbnail_size=store_config.get('thumbnail_size', 160),
+                thread=tenant.database.thread)
+    # code running outside of an update, like the load test, gets the first
+    tenant_module.enter(tenants[0])
+
+    if stable_api is None:
+        stable_api = StableDiffusionAccess(
+            model_config_obj=models_config,
+            backends_config=modes_config.data.get('webui_backends'),
+            load_control_config=modes_config.data.get('load_control'),
+            deduplicate=modes_config['bot_settings'].get(
+                'deduplicate_generations', True),
+            health_config=modes_config.data.get('webui_health'),
+            lanes_config=modes_config.data.get('available_generations'),
+            tenant_weights={tenant.name: tenant.weight
+                            for tenant in tenants})
+    render_responses()
+
+
+@functools.cache
+def get_translator():
+    # translators reaches out to the network on import, so it is loaded on
+    # the first translation or by the warm-up task after startup
+    import translators
+    return translators
+
+
+def traced(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        # handlers calling each other stay inside the outer trace
+        if tracing.current_trace() is not None:
+            return await handler(update, context, *args, **kwargs)
+
+        user = update.effective_user if isinstance(update, Update) else None
+        with tracing.start_trace(getattr(update, 'update_id', '-'),
+                                 handler.__name__,
+                                 user_id=user.id if user else None):
+            return await handler(update, context, *args, **kwargs)
+
+    return wrapper
+
+
+def is_admin(user: User) -> bool:
+    admins = [str(x) for x in modes_config['bot_settings'].get('admins') or []]
+    return str(user.id) in admins or (user.username or '') in admins
 
 
 def split_text_into_chunks(text, chunk_size):
@@ -48,76 +149,444 @@ def split_text_into_chunks(text, chunk_size):
 
 
 def check_for_banned_words(text: str, banned_words: List):
-    for word in text.split():
-        if word in banned_words:
-            return True
+    with metrics.stage_timer('banned_words'):
+        for word in text.split():
+            if word in banned_words:
+                return True
 
     return False
 
 
+def model_label(model_pos: int) -> str:
+    available_models = models_config['available_models']
+    if 0 <= model_pos < len(available_models):
+        return available_models[model_pos]
+    return str(model_pos)
+
+
 async def translate_prompt(prompt) -> str:
     logger.debug('Call: translate_prompt')
 
-    tr_out = ts.translate_text(prompt,
-                               if_use_preacceleration=False,
-                               )
+    with metrics.stage_timer('translation'):
+        ts = await asyncio.to_thread(get_translator)
+        tr_out = await asyncio.to_thread(ts.translate_text, prompt,
+                                         if_use_preacceleration=False)
     assert isinstance(tr_out, str)
     return tr_out
 
 
+def images_per_call() -> int:
+    # 0 generates and sends the whole batch at once
+    return modes_config['bot_settings'].get('progressive_delivery', 0)
+
+
+def profile_caption(img_paths) -> str | None:
+    # tell the user when the bot was too busy for the full settings
+    if img_paths.profile == 'full':
+        return None
+    return dialogs_config['info']['reduced_profile'].format(
+        profile=img_paths.profile)
+
+
+async def send_images(message: telegram.Message, img_paths: List[Path],
+                      caption=None):
+    logger.debug('Call: send_images')
+    with metrics.stage_timer('telegram_upload'):
+        return await _send_images(message, img_paths, caption)
+
+
+async def _reply_photos(message: telegram.Message, photos: list, caption=None):
+    # media groups need at least two items
+    if len(photos) == 1:
+        return [await message.reply_photo(photos[0], caption=caption)]
+    return await message.reply_media_group(
+        [InputMediaPhoto(photo) for photo in photos], caption=caption)
+
+
+def _read_images(img_paths: List[Path]) -> tuple[list, list]:
+    images = [Path(path).read_bytes() for path in img_paths]
+    return images, [FileIdCache.digest(data) for data in images]
+
+
+async def _send_images(message: telegram.Message, img_paths: List[Path],
+                       caption=None):
+    # reading and hashing stay off the event loop, the cache is asked once
+    # for all images of the message
+    images, digests = await asyncio.to_thread(_read_images, img_paths)
+    cached = await file_id_cache.lookup(digests)
+    photos = [cached.get(digest) or data
+              for digest, data in zip(digests, images)]
+
+    try:
+        sent_messages = await _reply_photos(message, photos, caption)
+    except telegram.error.BadRequest:
+        if not cached:
+            raise
+        # one of the stored file_ids is no longer valid, upload everything
+        logger.warning('Stale file_id in cache, uploading images again')
+        await file_id_cache.discard(list(cached))
+        cached = {}
+        sent_messages = await _reply_photos(message, images, caption)
+
+    await file_id_cache.store({
+        digest: sent.photo[-1].file_id
+        for digest, sent in zip(digests, sent_messages)
+        if digest not in cached and sent.photo})
+
+    return sent_messages
+
+
+async def send_parts(message: telegram.Message, parts, action: str,
+                     job: dict | None = None,
+                     sent: GenerationResult | None = None) -> GenerationResult:
+    # Sends every part of a generation as soon as it is ready. Returns the
+    # images of all parts in the order they were sent, the files are gone
+    sent = GenerationResult([]) if sent is None else sent
+    start = time.perf_counter()
+    async with contextlib.aclosing(parts):
+        async for images in parts:
+            if job is not None:
+                await job_journal.generated(job, images, images.seeds,
+                                            images.profile, images.total)
+            try:
+                sent_messages = await send_images(
+                    message, images, None if sent else profile_caption(images))
+                if job is not None and generation_store:
+                    await keep_results(job, images, sent_messages)
+            finally:
+                for path in images:
+                    Path(path).unlink(missing_ok=True)
+            if job is not None:
+                await job_journal.delivered(job, images.seeds, len(images))
+            if not sent:
+                metrics.FIRST_IMAGE.observe(time.perf_counter() - start,
+                                            action=action)
+            sent.extend(images)
+            sent.seeds.extend(images.seeds)
+            sent.profile = images.profile
+    return sent
+
+
+async def keep_results(job: dict, images: GenerationResult, sent_messages):
+    # Moves sent images into the generation store for /history, with the
+    # file_ids they were sent under. A failure here only costs the history
+    params = job['params'] | {'profile': images.profile}
+
+    try:
+        with metrics.stage_timer('store'):
+            for i, path in enumerate(images):
+                seed = images.seeds[i] if i < len(images.seeds) else None
+                photo = sent_messages[i].photo \
+                    if i < len(sent_messages) else None
+                await generation_store.put(
+                    path, job['user_id'], params, seed,
+                    photo[-1].file_id if photo else None)
+    except Exception:
+        logger.exception('Could not store generated images')
+
+
+async def _as_parts(*results):
+    for images in results:
+        yield images
+
+
+async def download_photos(tg_bot: telegram.Bot, file_ids: list) -> list[bytes]:
+    async def download(file_id):
+        photo = await tg_bot.get_file(file_id)
+        return bytes(await photo.download_as_bytearray())
+
+    with metrics.stage_timer('download'):
+        return await asyncio.gather(*map(download, file_ids))
+
+
+async def album_parts(message: telegram.Message, params: dict,
+                      overrides: dict):
+    images = await download_photos(message.get_bot(), params['photos'])
+    if params['action'] == 'img2img':
+        yield await stable_api.img2img_album(params['prompt'],
+                                             params['model_name'],
+                                             params['image_size'],
+                                             images,
+                                             params['file_prefix'],
+                                             overrides=overrides)
+        return
+
+    upscaler = models_config['upscaler']
+    yield await stable_api.upscale_album(
+        upscaler['upscaling_resize'],
+        upscaler['upscaler_1'],
+        upscaler['upscaler_2'],
+        upscaler['upscaler_2_strength'],
+        params['image_size'],
+        images,
+        other_settings=upscaler.get('other_settings'),
+        file_prefix=params['file_prefix'])
+
+
+async def job_parts(message: telegram.Message, job: dict, overrides: dict,
+                    adaptive: bool = True):
+    params = job['params']
+    adaptive = adaptive and params.get('adaptive', True)
+    if 'photos' in params:
+        return album_parts(message, params, overrides)
+    if params['action'] in ('txt2img', 'refine'):
+        return stable_api.txt2img_parts(params['prompt'],
+                                        params['model_name'],
+                                        params['image_size'],
+                                        params['file_prefix'],
+                                        overrides=overrides,
+                                        adaptive=adaptive,
+                                        images_per_call=images_per_call())
+
+    # photos are fetched again by file_id, so resumed jobs have them too
+    img_path = stable_api.temp_dir / f'{job["user_id"]}_{job["id"]}.png'
+    photo = await message.get_bot().get_file(params['photo'])
+    await photo.download_to_drive(img_path)
+
+    if params['action'] == 'img2img':
+        return stable_api.img2img_parts(params['prompt'],
+                                        params['model_name'],
+                                        params['image_size'],
+                                        img_path,
+                                        params['file_prefix'],
+                                        overrides=overrides,
+                                        adaptive=adaptive,
+                                        images_per_call=images_per_call())
+
+    upscaler = models_config['upscaler']
+    img_paths = await stable_api.upscale_img(
+        upscaler['upscaling_resize'],
+        upscaler['upscaler_1'],
+        upscaler['upscaler_2'],
+        upscaler['upscaler_2_strength'],
+        params['image_size'],
+        img_path,
+        other_settings=upscaler.get('other_settings'),
+        file_prefix=params['file_prefix'])
+    return _as_parts(img_paths)
+
+
+async def run_job(message: telegram.Message, job: dict) -> GenerationResult:
+    # Generates and sends a journaled job, fresh or resumed after a restart.
+    # A resumed job first sends what was generated before the restart and
+    # then makes only the images that are still missing
+    params = job['params']
+    action = params['action']
+    await job_journal.start(job)
+
+    sent = GenerationResult([], seeds=list(job['delivered']))
+    pending = job['pending']
+    if pending and all(Path(path).exists() for path in pending['paths']):
+        images = GenerationResult([Path(path) for path in pending['paths']],
+                                  pending['profile'], pending['seeds'])
+        await send_parts(message, _as_parts(images), action, job, sent)
+
+    overrides = dict(params.get('overrides') or {})
+    delivered = job['delivered_count']
+    adaptive = True
+    if action == 'rescale' or 'photos' in params:
+        # rescales and albums come back from a single WebUI call
+        missing = 0 if delivered else 1
+    else:
+        # counted against what load control chose for the first run
+        total = job['n_images'] or overrides.get('n_iter', DEFAULT_N_ITER)
+        missing = total - delivered
+        if delivered:
+            overrides['n_iter'] = missing
+            # load control would change how many of the rest are made
+            adaptive = False
+    if missing > 0:
+        parts = await job_parts(message, job, overrides, adaptive)
+        await send_parts(message, parts, action, job, sent)
+
+    row_id = await database.insert(action,
+                                   job['user_id'],
+                                   model=params['model'],
+                                   orientation=params['orientation'],
+                                   prompt=params['prompt'],
+                                   profile=sent.profile,
+                                   gen_mode=params.get('gen_mode', -1),
+                                   seeds=','.join(map(str, sent.seeds)))
+
+    if params.get('draft'):
+        await message.reply_text(
+            dialogs_config['info']['pick_draft'],
+            reply_markup=get_refine_menu(row_id, len(sent.seeds)))
+    await job_journal.finish(job)
+    metrics.REQUESTS.inc(action=action, model=params['model_name'],
+                         outcome='ok')
+    return sent
+
+
+def action_lane(action: str) -> str:
+    # refining a draft is a txt2img run
+    return 'txt2img' if action == 'refine' else action
+
+
+async def reject_if_unavailable(message: telegram.Message, action: str) -> bool:
+    # tells the user right away while no WebUI backend that can run the
+    # action is healthy, instead of queueing a request that can only fail
+    lane = action_lane(action)
+    if not stable_api.pool.available_backends(lane):
+        metrics.REQUESTS.inc(action=action, model='', outcome='unavailable')
+        await message.reply_text(dialogs_config['error']['backend_unavailable'])
+        return True
+    if stable_api.pool.lanes[lane].is_long():
+        await message.reply_text(dialogs_config['warning']['long_queue'])
+    return False
+
+
 async def register_user_if_not_exists(user_id):
     logger.debug('Call: register_user_if_not_exists')
-    with database as db:
+    def register(db):
         if not db.check_user_exists(user_id):
             db.insert('start', user_id,
                       model=0, orientation=0)
             logger.info('User registered')
+        else:
+            # remembers the user's settings, so their next commands
+            # don't need the database
+            db.update_for_user(user_id)
+
+    if not database.knows_user(user_id):
+        await database.run(register)
 
     if user_id not in user_semaphores:
         user_semaphores[user_id] = asyncio.Semaphore(1)
 
 
-async def start_handle(update: Update, context: CallbackContext):
-    logger.debug('Call: start_handle')
-    await register_user_if_not_exists(update.message.from_user.id)
-    reply_text = dialogs_config['info']['welcome']
+def current_dialogs():
+    # the dialogs bundle itself rather than the proxy, as a cache key
+    return tenant_module.current_tenant().dialogs
+
+
+# Responses made only of config text are rendered once per dialogs bundle,
+# that is per tenant and language, and reused until the configs are reloaded
+@functools.cache
+def start_text(dialogs) -> str:
+    reply_text = dialogs['info']['welcome']
     reply_text += '\n'
-    for msg in dialogs_config['help'].values():
+    for msg in dialogs['help'].values():
         reply_text += msg
         reply_text += '\n'
+    return reply_text
+
+
+@functools.cache
+def help_text(dialogs) -> str:
+    return '\n\n'.join(dialogs['help'].values())
+
+
+@functools.cache
+def modes_menu(dialogs, mode_name: str) -> InlineKeyboardMarkup:
+    keyboard = []
+    for mode in modes_config[mode_name].keys():
+        keyboard.append([InlineKeyboardButton(
+            dialogs[mode_name][mode],
+            callback_data=f"{mode_name}|{mode}")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+@functools.cache
+def models_menu(dialogs, current_model_pos: int) -> tuple[str, InlineKeyboardMarkup]:
+    curr_model_name = models_config['available_models'][current_model_pos]
+    model_config_name = f'model{current_model_pos}'
+
+    text = dialogs[model_config_name]["name"]
+    text += '\n'
+    text += dialogs[model_config_name]["description"]
+    text += "\n\n"
+
+    score_dict = models_config[curr_model_name]["scores"]
+    for score_key, score_value in score_dict.items():
+        text += "🟢" * score_value + "⚪️" * \
+            (5 - score_value) + \
+            f" – {dialogs['info']['scores'][score_key]}\n\n"
 
-    await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
+    text += "\n"
+    text += dialogs['info']['select_model']
+
+    # buttons to choose models
+    buttons = []
+    for model_key in models_config["available_models"]:
+        pos = models_config[model_key]['pos']
+        title = dialogs[f'model{pos}']["name"]
+        if model_key == curr_model_name:
+            title = "✅ " + title
+
+        buttons.append(
+            InlineKeyboardButton(
+                title, callback_data=f"set_model|{model_key}")
+        )
+    reply_markup = InlineKeyboardMarkup([buttons])
+
+    return text, reply_markup
 
 
+def render_responses():
+    # renders everything up front, so the first user doesn't wait for it
+    # and a broken dialogs file shows up on startup
+    for tenant in tenants:
+        for dialogs in tenant.dialog_bundles.values():
+            start_text(dialogs)
+            help_text(dialogs)
+            for mode_name in ('orientation', 'generation'):
+                modes_menu(dialogs, mode_name)
+            for model_pos in range(len(models_config['available_models'])):
+                models_menu(dialogs, model_pos)
+
+
+def reload_dialogs():
+    # Reads the dialogs of every tenant again and renders the responses
+    # from them. usage_modes.yml and models.yml are only read on startup
+    reload_configs()
+    for tenant in tenants:
+        tenant.load_dialogs()
+    for render in (start_text, help_text, modes_menu, models_menu):
+        render.cache_clear()
+    render_responses()
+    logger.info('Dialogs reloaded')
+
+
+@traced
+async def start_handle(update: Update, context: CallbackContext):
+    logger.debug('Call: start_handle')
+    await register_user_if_not_exists(update.message.from_user.id)
+    await update.message.reply_text(start_text(current_dialogs()),
+                                    parse_mode=ParseMode.HTML)
+
+
+@traced
 async def help_handle(update: Update, context: CallbackContext):
     logger.debug('Call: help_handle')
     await register_user_if_not_exists(update.message.from_user.id)
-    reply_text = '\n\n'.join(dialogs_config['help'].values())
-    await update.message.reply_text(reply_text, parse_mode=ParseMode.HTML)
+    await update.message.reply_text(help_text(current_dialogs()),
+                                    parse_mode=ParseMode.HTML)
 
 
+@traced
 async def retry_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update.message.from_user.id)
     if await is_previous_message_not_answered_yet(update, context):
         return
 
     user = update.message.from_user
-    with database as db:
-        db.update_for_user(user)
-        last_action = db.last_action
+    settings = await database.user_settings(user)
+    last_action = settings['action']
 
     if last_action is None:
         pass
     elif last_action == 'txt2img':
         await text_message_handle(update, context,
-                                  message=database.last_prompt,
+                                  message=settings['prompt'],
                                   use_new_dialog_timeout=False)
     else:
         await photo_message_handle(update, context,
-                                   message=database.last_prompt,
+                                   message=settings['prompt'],
                                    use_new_dialog_timeout=False)
 
 
+@traced
 async def text_message_handle(update: Update, context: CallbackContext,
                               message=None, use_new_dialog_timeout=True):
     logger.debug('Call: text_message_handle')
@@ -130,15 +599,18 @@ async def text_message_handle(update: Update, context: CallbackContext,
     await register_user_if_not_exists(update.message.from_user.id)
     if await is_previous_message_not_answered_yet(update, context):
         return
+    if await reject_if_unavailable(update.message, 'txt2img'):
+        return
 
     user = update.message.from_user
 
     async def message_handle_fn():
-        with database as db:
-            db.update_for_user(user)
-            model = db.last_model
-            orientation = db.last_orientation
+        settings = await database.user_settings(user)
+        model = settings['model']
+        orientation = settings['orientation']
+        gen_mode = settings['gen_mode']
 
+        job = None
         try:
             placeholder_message = await update.message.reply_text(dialogs_config['info']['in_progress_text'])
 
@@ -149,14 +621,14 @@ async def text_message_handle(update: Update, context: CallbackContext,
 
             if check_for_banned_words(translated_msg,
                                       secrets_config.get_banwords()):
-                with database as db:
-                    db.insert(generation_mode,
-                              user,
-                              gen_mode=generation_index,
-                              model=model,
-                              orientation=orientation,
-                              prompt=_message,
-                              blocked=True)
+                await database.insert('txt2img',
+                                      user,
+                                      model=model,
+                                      orientation=orientation,
+                                      prompt=_message,
+                                      blocked=True)
+                metrics.REQUESTS.inc(action='txt2img', model=model_label(model),
+                                     outcome='blocked')
 
                 text = dialogs_config["error"]['bad_message']
                 await update.message.reply_text(text, reply_to_message_id=update.message.id,
@@ -170,35 +642,50 @@ async def text_message_handle(update: Update, context: CallbackContext,
 
             image_size = models_config[model_name][orient_name]
 
-            img_paths = await stable_api.txt2img(translated_msg,
-                                                 model_name,
-                                                 image_size,
-                                                 f'gen_txt2img_{user.username}'
-                                                 )
-
-            with database as db:
-                db.insert('txt2img',
-                          user,
-                          model=model,
-                          orientation=orientation,
-                          prompt=translated_msg)
-
-            media = [InputMediaPhoto(open(image_path, 'rb'))
-                     for image_path in img_paths]
-
-            # Send the message with the images
-            await update.message.reply_media_group(media)
-
-            for path in img_paths:
-                Path(path).unlink()
+            params = {
+                'action': 'txt2img',
+                'model': model,
+                'orientation': orientation,
+                'gen_mode': gen_mode,
+                'prompt': translated_msg,
+                'model_name': model_name,
+                'image_size': image_size,
+                'file_prefix': f'gen_txt2img_{user.username}',
+            }
+            draft_config = modes_config['generation']['draft']
+            if gen_mode == draft_config['pos']:
+                params |= {
+                    'image_size': draft_size(image_size),
+                    'file_prefix': f'gen_draft_{user.username}',
+                    'overrides': {'steps': draft_config['steps']},
+                    'adaptive': False,
+                    'draft': True,
+                }
+            job = await job_journal.add(user.id, update.message.chat_id,
+                                        update.message.message_id, params)
+
+            # Send the images as they are generated
+            await run_job(update.message, job)
 
         except asyncio.CancelledError:
-            pass
+            metrics.REQUESTS.inc(action='txt2img', model=model_label(model),
+                                 outcome='canceled')
+
+        except BackendUnavailable:
+            metrics.REQUESTS.inc(action='txt2img', model=model_label(model),
+                                 outcome='unavailable')
+            if job is not None:
+                await job_journal.finish(job, 'failed')
+            await update.message.reply_text(
+                dialogs_config['error']['backend_unavailable'])
 
         except Exception as e:
+            metrics.REQUESTS.inc(action='txt2img', model=model_label(model),
+                                 outcome='error')
+            if job is not None:
+                await job_journal.finish(job, 'failed')
             error_text = dialogs_config["error"]['generation_error']
-            trb = traceback.format_exc()
-            logger.error('error in text message handler:\n' + trb)
+            logger.exception('error in text message handler')
             await update.message.reply_text(error_text)
             return
 
@@ -217,6 +704,7 @@ async def text_message_handle(update: Update, context: CallbackContext,
                 del user_tasks[user.id]
 
 
+@traced
 async def photo_message_handle(update: Update, context: CallbackContext,
                                message=None, use_new_dialog_timeout=True):
     logger.debug('Call: photo_message_handle')
@@ -225,20 +713,33 @@ async def photo_message_handle(update: Update, context: CallbackContext,
         await edited_message_handle(update, context)
         return
 
+    album = [update.message]
+    if update.message.media_group_id and message is None:
+        album = await collect_album(update.message)
+        if album is None:
+            return
+    # the caption of an album is on one of its photos
+    caption = next((item.caption for item in album if item.caption), None)
+
     await register_user_if_not_exists(update.message.from_user.id)
     if await is_previous_message_not_answered_yet(update, context):
         return
+    if await reject_if_unavailable(
+            update.message,
+            'img2img' if message or caption else 'rescale'):
+        return
 
     user = update.message.from_user
 
     async def message_handle_fn():
-        with database as db:
-            db.update_for_user(user)
-            model = db.last_model
-            orientation = db.last_orientation
+        settings = await database.user_settings(user)
+        model = settings['model']
+        orientation = settings['orientation']
 
+        _message = message or update.message.text or caption
+        action = 'img2img' if _message else 'rescale'
+        job = None
         try:
-            _message = message or update.message.text or update.message.caption
             answer_msg = dialogs_config['info']['in_progress_img'] if _message else dialogs_config['info']['in_progress_rescale']
             placeholder_message = await update.message.reply_text(answer_msg)
 
@@ -250,13 +751,14 @@ async def photo_message_handle(update: Update, context: CallbackContext,
 
             if check_for_banned_words(translated_msg,
                                       secrets_config.get_banwords()):
-                with database as db:
-                    db.insert('img2img',
-                              user,
-                              model=model,
-                              orientation=orientation,
-                              prompt=_message,
-                              blocked=True)
+                await database.insert('img2img',
+                                      user,
+                                      model=model,
+                                      orientation=orientation,
+                                      prompt=_message,
+                                      blocked=True)
+                metrics.REQUESTS.inc(action=action, model=model_label(model),
+                                     outcome='blocked')
 
                 text = dialogs_config["error"]['bad_message']
                 await update.message.reply_text(text, reply_to_message_id=update.message.id,
@@ -269,80 +771,45 @@ async def photo_message_handle(update: Update, context: CallbackContext,
             orient_name = modes_config["orientation"][orient_name]['config_name']
 
             image_size = models_config[model_name][orient_name]
-            # Get the picture message from the user
-            # if len(update.message.photo) > 1:
-            #     print(update.message.photo)
-            #     print(len(update.message.photo))
-            #     text = dialogs_config["warning"]['too_many_pictures']
-            #     await update.message.reply_text(text, reply_to_message_id=update.message.id,
-            #                                     parse_mode=ParseMode.HTML)
-
-            img_name = f'{user.id}_' + \
-                '_'.join(translated_msg.split()) + '.png'
-            img_path = Path('./temp') / img_name
-            photo = await update.message.photo[-1].get_file()
-            await photo.download_to_drive(img_path)
-
-            if translated_msg:
-                action = 'img2img'
-                img_paths = await stable_api.img2img(translated_msg,
-                                                     model_name,
-                                                     image_size,
-                                                     img_path,
-                                                     f'gen_txt2img_{user.username}',
-                                                     )
 
+            params = {
+                'action': action,
+                'model': model,
+                'orientation': orientation,
+                'prompt': translated_msg,
+                'model_name': model_name,
+                'image_size': image_size,
+                'file_prefix': f'gen_txt2img_{user.username}'
+                if action == 'img2img' else f'upscale_{user.username}',
+            }
+            if len(album) > 1:
+                params['photos'] = [item.photo[-1].file_id for item in album]
             else:
-                action = 'rescale'
-                # text = dialogs_config['error']['bad_action']
-                # await update.message.reply_text(text, reply_to_message_id=update.message.id,
-                #                                 parse_mode=ParseMode.HTML)
-                # raise asyncio.CancelledError()
-                upscaling_resize = models_config['upscaler']['upscaling_resize']
-                upscaler1 = models_config['upscaler']['upscaler_1']
-                upscaler2 = models_config['upscaler']['upscaler_2']
-                upscaler_2_strength = models_config['upscaler']['upscaler_2_strength']
-                if 'other_settings' in models_config.data.keys():
-                    other_settings = models_config['upscaler']['other_settings']
-                else:
-                    other_settings = None
-
-                img_paths = await stable_api.upscale_img(upscaling_resize,
-                                                         upscaler1,
-                                                         upscaler2,
-                                                         upscaler_2_strength,
-                                                         image_size,
-                                                         img_path,
-                                                         other_settings=other_settings,
-                                                         file_prefix='upscale_{user.username}',
-                                                         )
-
-            with database as db:
-                prompt = translated_msg if translated_msg else ''
-                db.insert(action,
-                          user,
-                          model=model,
-                          orientation=orientation,
-                          prompt=prompt
-                          )
-
-            media = [InputMediaPhoto(open(image_path, 'rb'))
-                     for image_path in img_paths]
-
-            # Send the message with the images
-            await update.message.reply_media_group(media)
-
-
-            for path in Path('./temp/').iterdir():
-                path.unlink(missing_ok=True)
+                params['photo'] = update.message.photo[-1].file_id
+            job = await job_journal.add(user.id, update.message.chat_id,
+                                        update.message.message_id, params)
+
+            await run_job(update.message, job)
 
         except asyncio.CancelledError:
-            pass
+            metrics.REQUESTS.inc(action=action, model=model_label(model),
+                                 outcome='canceled')
+
+        except BackendUnavailable:
+            metrics.REQUESTS.inc(action=action, model=model_label(model),
+                                 outcome='unavailable')
+            if job is not None:
+                await job_journal.finish(job, 'failed')
+            await update.message.reply_text(
+                dialogs_config['error']['backend_unavailable'])
 
         except Exception as e:
+            metrics.REQUESTS.inc(action=action, model=model_label(model),
+                                 outcome='error')
+            if job is not None:
+                await job_journal.finish(job, 'failed')
             error_text = dialogs_config["error"]['generation_error']
-            trb = traceback.format_exc()
-            logger.error('error in photo message handler:\n' + trb)
+            logger.exception('error in photo message handler')
             await update.message.reply_text(error_text)
             return
 
@@ -361,6 +828,25 @@ async def photo_message_handle(update: Update, context: CallbackContext,
                 del user_tasks[user.id]
 
 
+async def collect_album(message: telegram.Message) -> list | None:
+    # Every photo of an album comes in its own update. The first one waits
+    # until no new photo arrived for album_window seconds and returns them
+    # all, the updates of the other photos get None
+    key = (message.from_user.id, message.media_group_id)
+    if key in albums:
+        albums[key].append(message)
+        return None
+
+    albums[key] = album = [message]
+    window = modes_config['bot_settings'].get('album_window', 1.0)
+    seen = 0
+    while seen != len(album):
+        seen = len(album)
+        await asyncio.sleep(window)
+    del albums[key]
+    return sorted(album, key=lambda item: item.message_id)
+
+
 async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext):
     logger.debug('Call: is_previous_message_not_answered_yet')
     user_id = update.message.from_user.id
@@ -372,6 +858,7 @@ async def is_previous_message_not_answered_yet(update: Update, context: Callback
         return False
 
 
+@traced
 async def new_dialog_handle(update: Update, context: CallbackContext):
     logger.debug('Call: new_dialog_handle')
     await register_user_if_not_exists(update.message.from_user.id)
@@ -380,10 +867,11 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
 
     user = update.message.from_user
 
-    with database as db:
+    def start_dialog(db):
         db.insert('start', user, 0, 0, '')
-        db.update_for_user(user)
-        gen_mode = db.last_gen_mode
+        return db.user_settings(user)['gen_mode']
+
+    gen_mode = await database.run(start_dialog)
     await update.message.reply_text(dialogs_config["info"]["new_dialog"])
 
     await update.message.reply_text(
@@ -391,12 +879,14 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
         parse_mode=ParseMode.HTML)
 
 
+@traced
 async def cancel_handle(update: Update, context: CallbackContext):
     logger.debug('Call: cancel_handle')
     await register_user_if_not_exists(update.message.from_user.id)
     user_id = update.message.from_user.id
 
     if user_id in user_tasks:
+        await job_journal.cancel_for_user(user_id)
         task = user_tasks[user_id]
         task.cancel()
     else:
@@ -405,24 +895,35 @@ async def cancel_handle(update: Update, context: CallbackContext):
             parse_mode=ParseMode.HTML)
 
 
+@traced
 async def show_orientation_modes_handle(update: Update, context: CallbackContext):
     logger.debug('Call: show_orientation_modes_handle')
     await register_user_if_not_exists(update.message.from_user.id)
     if await is_previous_message_not_answered_yet(update, context):
         return
 
-    keyboard = []
-    for orient_mode in modes_config['orientation'].keys():
-        keyboard.append([InlineKeyboardButton(
-            dialogs_config['orientation'][orient_mode],
-            callback_data=f"orientation|{orient_mode}")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await update.message.reply_text(
         dialogs_config["info"]["select_orientation_mode"],
-        reply_markup=reply_markup)
+        reply_markup=get_modes_menu('orientation'))
+
+
+@traced
+async def show_generation_modes_handle(update: Update, context: CallbackContext):
+    logger.debug('Call: show_generation_modes_handle')
+    await register_user_if_not_exists(update.message.from_user.id)
+    if await is_previous_message_not_answered_yet(update, context):
+        return
+
+    await update.message.reply_text(
+        dialogs_config["info"]["select_generation_mode"],
+        reply_markup=get_modes_menu('generation'))
 
 
+def get_modes_menu(mode_name: str) -> InlineKeyboardMarkup:
+    return modes_menu(current_dialogs(), mode_name)
+
+
+@traced
 async def set_mode_handle(update: Update, context: CallbackContext):
     logger.debug('Call: set_mode_handle')
     user = update.callback_query.from_user
@@ -430,58 +931,139 @@ async def set_mode_handle(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
     mode_name, mode_to_change = query.data.split('|')
-    with database as db:
-        if mode_name == 'orientation':
-            db.insert(f"change_{mode_name}_mode", user,
-                      orientation=modes_config[mode_name][mode_to_change]['pos'])
+    if mode_name == 'orientation':
+        await database.insert(
+            f"change_{mode_name}_mode", user,
+            orientation=modes_config[mode_name][mode_to_change]['pos'])
+    elif mode_name == 'generation':
+        await database.insert(
+            f"change_{mode_name}_mode", user,
+            gen_mode=modes_config[mode_name][mode_to_change]['pos'])
 
     await query.edit_message_text(
         f"{dialogs_config[mode_name][mode_to_change]}",
         parse_mode=ParseMode.HTML)
 
 
-def get_models_menu(user_id: int):
-    logger.debug('Call: get_models_menu')
-    with database as db:
-        db.update_for_user(user_id)
-        current_model_pos = db.last_model
-        if current_model_pos < 0:
-            current_model_pos = 0
+def draft_size(image_size: str) -> str:
+    scale = modes_config['generation']['draft']['scale']
+    img_w, img_h = [int(s) for s in image_size.split('x')]
+    # the WebUI wants sizes in multiples of 8
+    return f'{round(img_w * scale / 8) * 8}x{round(img_h * scale / 8) * 8}'
 
-    curr_model_name = models_config['available_models'][current_model_pos]
-    model_config_name = f'model{current_model_pos}'
 
-    text = dialogs_config[model_config_name]["name"]
-    text += '\n'
-    text += dialogs_config[model_config_name]["description"]
-    text += "\n\n"
+def get_refine_menu(row_id: int, n_images: int) -> InlineKeyboardMarkup:
+    buttons = [InlineKeyboardButton(
+        dialogs_config['info']['refine_button'].format(n=i + 1),
+        callback_data=f'refine|{row_id}|{i}') for i in range(n_images)]
+    return InlineKeyboardMarkup([buttons])
 
-    score_dict = models_config[curr_model_name]["scores"]
-    for score_key, score_value in score_dict.items():
-        text += "🟢" * score_value + "⚪️" * \
-            (5 - score_value) + \
-            f" – {dialogs_config['info']['scores'][score_key]}\n\n"
 
-    text += "\n"
-    text += dialogs_config['info']['select_model']
+@traced
+async def refine_handle(update: Update, context: CallbackContext):
+    logger.debug('Call: refine_handle')
+    query = update.callback_query
+    user = query.from_user
+    await register_user_if_not_exists(user.id)
+    if user_semaphores[user.id].locked():
+        await query.answer(dialogs_config['warning']['wait_or_cancel'])
+        return
+    await query.answer()
 
-    # buttons to choose models
-    buttons = []
-    for model_key in models_config["available_models"]:
-        pos = models_config[model_key]['pos']
-        title = dialogs_config[f'model{pos}']["name"]
-        if model_key == curr_model_name:
-            title = "✅ " + title
+    if await reject_if_unavailable(query.message, 'refine'):
+        return
 
-        buttons.append(
-            InlineKeyboardButton(
-                title, callback_data=f"set_model|{model_key}")
-        )
-    reply_markup = InlineKeyboardMarkup([buttons])
+    _, row_id, idx = query.data.split('|')
+    row = await database.get_row(int(row_id))
+    seeds = row['seeds'].split(',') if row and row['seeds'] else []
+    if row is None or row['user_id'] != user.id or int(idx) >= len(seeds):
+        await query.message.reply_text(dialogs_config['error']['draft_expired'])
+        return
 
-    return text, reply_markup
+    model_name = model_label(row['model'])
+    orient_name = modes_config["available_orientations"][row['orientation']]
+    orient_name = modes_config["orientation"][orient_name]['config_name']
+    image_size = models_config[model_name][orient_name]
+    draft_config = modes_config['generation']['draft']
+
+    # The first pass repeats the draft exactly (same seed, size and steps),
+    # the hires pass then brings it to full size at the model's own steps
+    overrides = {
+        'seed': int(seeds[int(idx)]),
+        'n_iter': 1,
+        'steps': draft_config['steps'],
+        'enable_hr': True,
+        'hr_scale': 1 / draft_config['scale'],
+        'hr_second_pass_steps':
+            models_config[model_name]['default_params']['steps'],
+    }
+
+    params = {
+        'action': 'refine',
+        'model': row['model'],
+        'orientation': row['orientation'],
+        'gen_mode': row['gen_mode'],
+        'prompt': row['prompt'],
+        'model_name': model_name,
+        'image_size': draft_size(image_size),
+        'file_prefix': f'gen_refine_{user.username}',
+        'overrides': overrides,
+        'adaptive': False,
+    }
+
+    async def refine_fn():
+        job = None
+        try:
+            await query.message.reply_text(
+                dialogs_config['info']['in_progress_refine'])
+            job = await job_journal.add(user.id, query.message.chat_id,
+                                        query.message.message_id, params)
+            await run_job(query.message, job)
 
+        except asyncio.CancelledError:
+            metrics.REQUESTS.inc(action='refine', model=model_name,
+                                 outcome='canceled')
+            raise
+
+        except BackendUnavailable:
+            metrics.REQUESTS.inc(action='refine', model=model_name,
+                                 outcome='unavailable')
+            if job is not None:
+                await job_journal.finish(job, 'failed')
+            await query.message.reply_text(
+                dialogs_config['error']['backend_unavailable'])
+
+        except Exception:
+            metrics.REQUESTS.inc(action='refine', model=model_name,
+                                 outcome='error')
+            if job is not None:
+                await job_journal.finish(job, 'failed')
+            logger.exception('error in refine handler')
+            await query.message.reply_text(
+                dialogs_config["error"]['generation_error'])
 
+    async with user_semaphores[user.id]:
+        task = asyncio.create_task(refine_fn())
+        user_tasks[user.id] = task
+        try:
+            await task
+        except asyncio.CancelledError:
+            await query.message.reply_text(dialogs_config["info"]["canceled"],
+                                           parse_mode=ParseMode.HTML)
+        finally:
+            if user.id in user_tasks:
+                del user_tasks[user.id]
+
+
+async def get_models_menu(user_id: int):
+    logger.debug('Call: get_models_menu')
+    current_model_pos = await database.user_model(user_id)
+    if current_model_pos < 0:
+        current_model_pos = 0
+    return models_menu(current_dialogs(), current_model_pos)
+
+
+@traced
 async def models_handle(update: Update, context: CallbackContext):
     logger.debug('Call: models_handle')
     await register_user_if_not_exists(update.message.from_user.id)
@@ -490,11 +1072,12 @@ async def models_handle(update: Update, context: CallbackContext):
 
     user_id = update.message.from_user.id
 
-    text, reply_markup = get_models_menu(user_id)
+    text, reply_markup = await get_models_menu(user_id)
     await update.message.reply_text(text, reply_markup=reply_markup,
                                     parse_mode=ParseMode.HTML)
 
 
+@traced
 async def set_models_handle(update: Update, context: CallbackContext):
     logger.debug('Call: set_model_handle')
     user = update.callback_query.from_user
@@ -504,10 +1087,9 @@ async def set_models_handle(update: Update, context: CallbackContext):
 
     _, model_key = query.data.split("|")
     model_pos = models_config[model_key]['pos']
-    with database as db:
-        db.insert("set_model", user, model=model_pos)
+    await database.insert("set_model", user, model=model_pos)
 
-    text, reply_markup = get_models_menu(user.id)
+    text, reply_markup = await get_models_menu(user.id)
     try:
         await query.edit_message_text(text, reply_markup=reply_markup,
                                       parse_mode=ParseMode.HTML)
@@ -516,14 +1098,156 @@ async def set_models_handle(update: Update, context: CallbackContext):
             pass
 
 
+async def history_page(user_id: int, page: int):
+    # The contact sheet, caption and buttons of a page of the user's
+    # stored images, newest first. None if nothing is stored
+    page_size = store_config.get('page_size', 6)
+    total = await generation_store.count(user_id)
+    if total == 0:
+        return None
+    n_pages = (total + page_size - 1) // page_size
+    page = min(max(page, 0), n_pages - 1)
+    rows = await generation_store.page(user_id, page, page_size)
+    sheet = await asyncio.to_thread(generation_store.contact_sheet, rows)
+
+    caption = dialogs_config['info']['history_page'].format(
+        page=page + 1, pages=n_pages)
+    for i, row in enumerate(rows):
+        created = datetime.fromtimestamp(row['created'])
+        caption += f"\n{i + 1}. {created:%Y-%m-%d %H:%M} " \
+            f"{(row['prompt'] or row['action'])[:60]}"
+
+    keyboard = [[InlineKeyboardButton(
+        str(i + 1), callback_data=f"history_show|{row['id']}")
+        for i, row in enumerate(rows)]]
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton(
+            '‹', callback_data=f'history|{page - 1}'))
+    if page < n_pages - 1:
+        navigation.append(InlineKeyboardButton(
+            '›', callback_data=f'history|{page + 1}'))
+    if navigation:
+        keyboard.append(navigation)
+    return sheet, caption, InlineKeyboardMarkup(keyboard)
+
+
+@traced
+async def history_handle(update: Update, context: CallbackContext):
+    logger.debug('Call: history_handle')
+    user_id = update.message.from_user.id
+    await register_user_if_not_exists(user_id)
+    if not generation_store:
+        await update.message.reply_text(dialogs_config['error']['bad_action'])
+        return
+
+    page = await history_page(user_id, 0)
+    if page is None:
+        await update.message.reply_text(dialogs_config['info']['history_empty'])
+        return
+    sheet, caption, reply_markup = page
+    await update.message.reply_photo(sheet, caption=caption,
+                                     reply_markup=reply_markup)
+
+
+@traced
+async def history_page_handle(update: Update, context: CallbackContext):
+    logger.debug('Call: history_page_handle')
+    query = update.callback_query
+    await query.answer()
+    if not generation_store:
+        return
+
+    page = await history_page(query.from_user.id,
+                              int(query.data.split('|')[1]))
+    if page is None:
+        return
+    sheet, caption, reply_markup = page
+    await query.edit_message_media(InputMediaPhoto(sheet, caption=caption),
+                                   reply_markup=reply_markup)
+
+
+@traced
+async def history_show_handle(update: Update, context: CallbackContext):
+    # Sends a stored image again by its file_id, without the WebUI and
+    # without uploading it. The file is only uploaded if Telegram no
+    # longer knows the file_id
+    logger.debug('Call: history_show_handle')
+    query = update.callback_query
+    _, result_id = query.data.split('|')
+    row = None
+    if generation_store:
+        row = await generation_store.get(int(result_id))
+    if row is None or row['user_id'] != query.from_user.id:
+        await query.answer(dialogs_config['error']['history_expired'])
+        return
+    await query.answer()
+
+    caption = (row['prompt'] or '')[:1024] or None
+    if row['file_id']:
+        try:
+            await query.message.reply_photo(row['file_id'], caption=caption)
+            return
+        except telegram.error.BadRequest:
+            logger.warning('Stale file_id in the generation store, '
+                           'uploading the image again')
+    img_bytes = await asyncio.to_thread(
+        generation_store.image_path(row['hash']).read_bytes)
+    sent = await query.message.reply_photo(img_bytes, caption=caption)
+    await generation_store.set_file_id(row['hash'], sent.photo[-1].file_id)
+
+
 async def edited_message_handle(update: Update, context: CallbackContext):
     logger.debug('Call: edited_message_handle')
     text = dialogs_config["warning"]["message_editing"]
     await update.edited_message.reply_text(text, parse_mode=ParseMode.HTML)
 
 
+@traced
+async def traces_handle(update: Update, context: CallbackContext):
+    logger.debug('Call: traces_handle')
+    if not is_admin(update.message.from_user):
+        await restricted_user_handle(update, context)
+        return
+
+    last = int(context.args[0]) if context.args and context.args[0].isdigit() else None
+    json_path, chrome_path = tracing.TRACER.dump(
+        tracing_config.get('traces_dir', './traces'), last=last)
+    await update.message.reply_text(
+        f"{dialogs_config['info']['traces_written']}\n{json_path}\n{chrome_path}")
+
+
+@traced
+async def profile_handle(update: Update, context: CallbackContext):
+    logger.debug('Call: profile_handle')
+    if not is_admin(update.message.from_user):
+        await restricted_user_handle(update, context)
+        return
+
+    n_requests = int(context.args[0]) if context.args and context.args[0].isdigit() else 10
+    try:
+        tracing.PROFILER.start(n_requests,
+                               tracing_config.get('profiles_dir', './profiles'))
+    except RuntimeError:
+        await update.message.reply_text(dialogs_config['warning']['profiling_running'])
+        return
+    await update.message.reply_text(
+        f"{dialogs_config['info']['profiling_started']}: {n_requests}")
+
+
+@traced
+async def reload_handle(update: Update, context: CallbackContext):
+    logger.debug('Call: reload_handle')
+    if not is_admin(update.message.from_user):
+        await restricted_user_handle(update, context)
+        return
+
+    reload_dialogs()
+    await update.message.reply_text(dialogs_config['info']['dialogs_reloaded'])
+
+
 async def restricted_user_handle(update: Update, context: CallbackContext) -> None:
-    logger.warning(msg=f'Restricted user: {update.effective_user.username}')
+    logger.warning('Restricted user: %s', update.effective_user.username)
     await context.bot.send_message(update.effective_chat.id,
                                    dialogs_config['error']['restricted_access'])
 
@@ -561,13 +1285,231 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
                                        + "\n error in error handler")
 
 
-async def post_init(application: Application):
-    bot_command_list = []
-    for cmd_key in modes_config["bot_commands"]:
-        cmd = modes_config["bot_commands"][cmd_key]["command"]
-        description = dialogs_config["bot_commands"][cmd_key]
-        bot_command_list.append(BotCommand(cmd, description))
-    await application.bot.set_my_commands(bot_command_list)
+async def start_metrics(application: Application):
+    metrics_config = modes_config.data.get('metrics', {})
+    if not metrics_config.get('enabled', False):
+        return
+
+    application.bot_data['metrics_server'] = await metrics.start_server(
+        metrics_config.get('host', '127.0.0.1'),
+        metrics_config.get('port', 9464))
+    application.bot_data['metrics_tasks'] = [
+        asyncio.create_task(metrics.monitor_event_loop(
+            metrics_config.get('loop_lag_interval', 0.5))),
+    ]
+
+
+def start_health_probes(application: Application):
+    health_config = modes_config.data.get('webui_health', {})
+    application.bot_data['health_task'] = asyncio.create_task(
+        stable_api.monitor_health(health_config.get('probe_interval', 5)))
+
+
+async def check_backend(backend, timeout) -> bool:
+    try:
+        if not await asyncio.to_thread(stable_api.is_connected, backend,
+                                       timeout):
+            return False
+        await asyncio.to_thread(stable_api.resolve_checkpoints, backend,
+                                timeout)
+    except Exception as e:
+        logger.error('WebUI backend %s failed the readiness check: %r',
+                     backend.url, e)
+        return False
+    return True
+
+
+async def warm_up_translator():
+    try:
+        await asyncio.to_thread(get_translator)
+    except Exception:
+        logger.exception('Could not load translators')
+
+
+async def check_readiness(application: Application):
+    startup_config = modes_config.data.get('startup', {})
+    timeout = startup_config.get('readiness_timeout', 10)
+    backends = stable_api.pool.backends
+    results = await asyncio.gather(
+        *(check_backend(backend, timeout) for backend in backends))
+
+    ready = [b for b, ok in zip(backends, results) if ok]
+    for backend in ready:
+        logger.info('WebUI backend %s ready, %d checkpoints, loaded: %s',
+                    backend.url, len(backend.checkpoints),
+                    backend.model or 'unknown')
+    if not ready and startup_config.get('require_backend', True):
+        raise RuntimeError('No WebUI backend is reachable. '
+                           'Start the WebUI with the --api flag')
+
+    if startup_config.get('warm_up_translator', True):
+        application.bot_data['translator_warm_up'] = asyncio.create_task(
+            warm_up_translator())
+
+
+def start_prewarm(application: Application):
+    prewarm_config = modes_config.data.get('prewarm', {})
+    if not prewarm_config.get('enabled', False):
+        return
+
+    prewarmer = CheckpointPrewarmer(
+        stable_api, [tenant.database.path for tenant in tenants],
+        prewarm_config)
+    application.bot_data['prewarm_task'] = asyncio.create_task(
+        prewarmer.run())
+
+
+async def resume_job(application: Application, job: dict):
+    user_id = job['user_id']
+    await register_user_if_not_exists(user_id)
+    # replies go to the message that asked for the job
+    message = telegram.Message(job['message_id'], datetime.now(),
+                               telegram.Chat(job['chat_id'], ChatType.PRIVATE))
+    message.set_bot(application.bot)
+    action = job['params']['action']
+    model_name = job['params']['model_name']
+
+    async def resume_fn():
+        try:
+            await message.reply_text(dialogs_config['info']['resumed'])
+            await run_job(message, job)
+        except asyncio.CancelledError:
+            metrics.REQUESTS.inc(action=action, model=model_name,
+                                 outcome='canceled')
+            raise
+        except BackendUnavailable:
+            metrics.REQUESTS.inc(action=action, model=model_name,
+                                 outcome='unavailable')
+            await job_journal.finish(job, 'failed')
+            await message.reply_text(
+                dialogs_config['error']['backend_unavailable'])
+        except Exception:
+            metrics.REQUESTS.inc(action=action, model=model_name,
+                                 outcome='error')
+            await job_journal.finish(job, 'failed')
+            logger.exception('error in resumed job %s', job['id'])
+            await message.reply_text(
+                dialogs_config['error']['generation_error'])
+
+    async with user_semaphores[user_id]:
+        task = asyncio.create_task(resume_fn())
+        user_tasks[user_id] = task
+        try:
+            await task
+        except asyncio.CancelledError:
+            await message.reply_text(dialogs_config["info"]["canceled"],
+                                     parse_mode=ParseMode.HTML)
+        finally:
+            if user_tasks.get(user_id) is task:
+                del user_tasks[user_id]
+
+
+async def resume_jobs(application: Application, jobs: list[dict]):
+    journal_config = modes_config.data.get('job_journal', {})
+    max_attempts = journal_config.get('max_attempts', 3)
+    max_age = journal_config.get('max_age', 3600)
+
+    resumed = []
+    for job in jobs:
+        if job['attempts'] < max_attempts and \
+                time.time() - job['created'] < max_age:
+            resumed.append(resume_job(application, job))
+            continue
+        await job_journal.finish(job, 'expired')
+        try:
+            await application.bot.send_message(
+                job['chat_id'], dialogs_config['error']['job_lost'],
+                reply_to_message_id=job['message_id'],
+                allow_sending_without_reply=True)
+        except telegram.error.TelegramError as e:
+            logger.warning('Could not tell user %s about job %s: %r',
+                           job['user_id'], job['id'], e)
+
+    logger.info('Resuming %d unfinished jobs, %d given up',
+                len(resumed), len(jobs) - len(resumed))
+    await asyncio.gather(*resumed)
+
+
+async def start_resume(application: Application):
+    await job_journal.prune()
+    jobs = await job_journal.unfinished()
+    if not jobs:
+        return
+    if not modes_config.data.get('job_journal', {}).get('resume', True):
+        for job in jobs:
+            await job_journal.finish(job, 'expired')
+        return
+
+    application.bot_data['resume_task'] = asyncio.create_task(
+        resume_jobs(application, jobs))
+
+
+async def start_services(application: Application):
+    # shared by all tenants, started once per process
+    await check_readiness(application)
+    await start_metrics(application)
+    start_health_probes(application)
+    start_prewarm(application)
+
+
+async def start_tenant(application: Application):
+    # the resume task is created here, so it runs as this tenant
+    tenant_module.enter(application.bot_data['tenant'])
+    await start_resume(application)
+
+    # Telegram shows users the command list of their language
+    for language, dialogs in application.bot_data['tenant'].dialog_bundles.items():
+        bot_command_list = []
+        for cmd_key in modes_config["bot_commands"]:
+            if cmd_key == 'history' and not generation_store:
+                continue
+            cmd = modes_config["bot_commands"][cmd_key]["command"]
+            description = dialogs["bot_commands"][cmd_key]
+            bot_command_list.append(BotCommand(cmd, description))
+        await application.bot.set_my_commands(bot_command_list,
+                                              language_code=language or None)
+
+
+async def enter_tenant(update: Update, context: CallbackContext):
+    # runs first for every update, in the task that handles it
+    tenant_module.enter(context.bot_data['tenant'])
+    user = update.effective_user
+    tenant_module.set_language(user.language_code if user else None)
+
+
+async def serve(applications: list[Application]):
+    # Polls every tenant's bot in one event loop until interrupted. The
+    # applications are started by hand, run_polling can only run one
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # not available on Windows, Ctrl+C still ends asyncio.run there
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    with contextlib.suppress(NotImplementedError, AttributeError):
+        loop.add_signal_handler(signal.SIGHUP, reload_dialogs)
+
+    started = []
+    try:
+        await start_services(applications[0])
+        for application in applications:
+            await application.initialize()
+            started.append(application)
+            await start_tenant(application)
+            await application.start()
+            await application.updater.start_polling()
+            logger.info('Bot %s started', application.bot_data['tenant'].name)
+        await stop.wait()
+    finally:
+        for application in reversed(started):
+            if application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+        for tenant in tenants:
+            tenant.database.close()
+
 
 def start_bot():
     parser = argparse.ArgumentParser()
@@ -580,35 +1522,42 @@ def start_bot():
                         help='Use whitelist as a user filter. Ignores config')
     args = parser.parse_args()
 
-    try:
-        user_filter = modes_config['bot_settings']['user_filter']
-    except KeyError:
-        user_filter = None
-
+    # the flags override the setting of every tenant
+    whitelist_filter = None
     if args.blacklist == True:
-        user_filter = False
+        whitelist_filter = False
     if args.whitelist == True:
-        user_filter = True
+        whitelist_filter = True
 
-    is_whitelist = True if user_filter in ('whitelist', True) else False
-    run_bot(whitelist_filter=is_whitelist)
+    run_bot(whitelist_filter=whitelist_filter)
 
 
-def run_bot(whitelist_filter=True) -> None:
-    application = (
+def build_application(whitelist_filter=None, request=None,
+                      rate_limiter=True, tenant=None) -> Application:
+    init_resources()
+    tenant = tenant or tenants[0]
+    if whitelist_filter is None:
+        user_filter = tenant.user_filter or \
+            modes_config['bot_settings'].get('user_filter')
+        whitelist_filter = user_filter in ('whitelist', True)
+
+    builder = (
         ApplicationBuilder()
-        .token(secrets_config.get_token())
+        .token(tenant.secrets.get_token())
         .concurrent_updates(True)
-        .rate_limiter(AIORateLimiter(max_retries=5))
-        .post_init(post_init)
-        .build()
     )
+    if rate_limiter:
+        builder = builder.rate_limiter(AIORateLimiter(max_retries=5))
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+    application.bot_data['tenant'] = tenant
+    application.add_handler(TypeHandler(Update, enter_tenant), group=-1)
 
     # add handlers
     user_filter = filters.ALL
-    print(whitelist_filter)
     if whitelist_filter:
-        allowed_users = secrets_config.get_whitelist()
+        allowed_users = tenant.secrets.get_whitelist()
         if len(allowed_users) > 0:
             usernames = [
                 x for x in allowed_users if isinstance(x, str)]
@@ -617,7 +1566,7 @@ def run_bot(whitelist_filter=True) -> None:
             user_filter = filters.User(
                 username=usernames) | filters.User(user_id=user_ids)
     else:
-        blocked_users = secrets_config.get_blacklist()
+        blocked_users = tenant.secrets.get_blacklist()
         if len(blocked_users) > 0:
             usernames = [
                 x for x in blocked_users if isinstance(x, str)]
@@ -653,14 +1602,42 @@ def run_bot(whitelist_filter=True) -> None:
     application.add_handler(CallbackQueryHandler(
         set_mode_handle, pattern="^orientation"))
 
+    application.add_handler(CommandHandler(
+        "generation_mode", show_generation_modes_handle, filters=user_filter))
+    application.add_handler(CallbackQueryHandler(
+        set_mode_handle, pattern="^generation"))
+    application.add_handler(CallbackQueryHandler(
+        refine_handle, pattern="^refine"))
+
+    application.add_handler(CommandHandler(
+        "history", history_handle, filters=user_filter))
+    application.add_handler(CallbackQueryHandler(
+        history_page_handle, pattern="^history\\|"))
+    application.add_handler(CallbackQueryHandler(
+        history_show_handle, pattern="^history_show\\|"))
+
+
+    application.add_handler(CommandHandler(
+        "traces", traces_handle, filters=user_filter))
+    application.add_handler(CommandHandler(
+        "profile", profile_handle, filters=user_filter))
+    application.add_handler(CommandHandler(
+        "reload", reload_handle, filters=user_filter))
 
     application.add_handler(MessageHandler(
         ~user_filter, restricted_user_handle))
     application.add_error_handler(error_handle)
+    return application
+
+
+def run_bot(whitelist_filter=None) -> None:
+    init_resources()
+    applications = [build_application(whitelist_filter, tenant=tenant)
+                    for tenant in tenants]
 
-    # start the bot
+    # start the bots
     print('Bot started')
-    application.run_polling()
+    asyncio.run(serve(applications))
 
 
 if __name__ == "__main__":
@@ -1,15 +1,11 @@
+import functools
 import logging
 from pathlib import Path
 
 import yaml
 
-from setup_handler import get_handler
-
 logger = logging.getLogger(__name__)
 
-# add handler to logger
-logger.addHandler(get_handler())
-
 
 class LoadConfig:
     def __init__(self, conf_path) -> None:
@@ -39,6 +35,21 @@ class LoadConfig:
             yield data
 
 
+@functools.lru_cache(maxsize=None)
+def _load_config_cached(path: Path) -> LoadConfig:
+    logger.debug('Parsing config %s', path)
+    return LoadConfig(path)
+
+
+def load_config(conf_path) -> LoadConfig:
+    # every config file is parsed once and shared by all callers
+    return _load_config_cached(Path(conf_path).resolve())
+
+
+def reload_configs():
+    _load_config_cached.cache_clear()
+
+
 class SecretsAccess:
     __filenames = {
         'whitelist': 'whitelist.txt',
@@ -1,8 +1,13 @@
+import asyncio
+import contextvars
+import functools
 import logging
 import sqlite3 as sql
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from setup_handler import get_handler
+import metrics
 
 
 class Database:
@@ -15,24 +20,29 @@ class Database:
         'user': 'VARCHAR(70)',
         'user_id': 'INTEGER',
         'trigger_blacklist': 'INTEGER',
+        'profile': "VARCHAR(20) DEFAULT ''",
+        'gen_mode': 'INTEGER DEFAULT 0',
+        'seeds': "VARCHAR(200) DEFAULT ''",
     }
     __relevant_actions = {
         'model': ['start', 'txt2img', 'img2img', 'set_model'],
         'prompt': ['start', 'txt2img', 'img2img'],
-        'oriention': ['start', 'txt2img', 'img2img',
-                      'change_orientation_mode'],
+        'orientation': ['start', 'txt2img', 'img2img',
+                        'change_orientation_mode'],
+        'gen_mode': ['start', 'txt2img', 'change_generation_mode'],
     }
 
-    def __init__(self, path: str | Path, actions_txt_path: str | Path = ''):
+    def __init__(self, path: str | Path, actions_txt_path: str | Path = '',
+                 max_cached_users: int = 10000):
         path_obj = Path(path)
         self.path = path
 
         self.logger = logging.getLogger(__name__)
-        self.logger.addHandler(get_handler())
-        self.logger.setLevel(logging.DEBUG)
 
         if not path_obj.exists():
             self.create_table()
+        else:
+            self.migrate()
 
         self.last_action = 'txt2img'
         self.last_model = 0
@@ -42,11 +52,16 @@ class Database:
         self.is_blocked = False
         self.last_username = ''
         self.possible_actions = []
+        # model picked by each of the users whose settings were read or
+        # written latest, so menus don't need a query
+        self.user_models = OrderedDict()
+        self.max_cached_users = max_cached_users
 
         self.all_actions = set()
         for actions in self.__relevant_actions.values():
             self.all_actions |= set(actions)
         self.all_actions = list(self.all_actions)
+        self.insert_query = self._build_insert_query()
 
         if actions_txt_path != '':
             with open(actions_txt_path, 'r') as f:
@@ -59,12 +74,13 @@ class Database:
         return self
 
     def __exit__(self, type, value, traceback):
-        self.cur.close()
-        if isinstance(value, Exception):
-            self.con.rollback()
-        else:
-            self.con.commit()
-        self.con.close()
+        with metrics.stage_timer('db_commit'):
+            self.cur.close()
+            if isinstance(value, Exception):
+                self.con.rollback()
+            else:
+                self.con.commit()
+            self.con.close()
 
     def create_table(self):
         query = 'CREATE TABLE main('
@@ -79,9 +95,34 @@ class Database:
         self.con.close()
         self.logger.debug('Created table')
 
+    def migrate(self):
+        # add the columns introduced after the database was created
+        con = sql.connect(self.path)
+        existing = {row[1] for row in con.execute('PRAGMA table_info(main)')}
+        for key, val in self.__table_contents.items():
+            if key not in existing:
+                con.execute(f'ALTER TABLE main ADD COLUMN {key} {val}')
+                self.logger.info('Added column %s to main', key)
+        con.commit()
+        con.close()
+
+    def _build_insert_query(self):
+        keys_to_add = list(self.__table_contents.keys())
+        keys_to_add.remove('id')
+
+        questions_len = len(self.__table_contents) - 1
+        questions = '(' + ', '.join(['?' for _ in range(questions_len)]) + ');'
+
+        query = 'INSERT INTO main ('
+        query += ', \n'.join(keys_to_add)
+        query += ')\nVALUES '
+        query += questions
+        return query
+
     def insert(self, action: str, user,
                model: int = -1, orientation: int = -1,
-               prompt: str = '', blocked: bool = False):
+               prompt: str = '', blocked: bool = False, profile: str = '',
+               gen_mode: int = -1, seeds: str = '') -> int:
         if isinstance(user, int):
             self.update_for_user(user)
             username = self.last_username
@@ -90,18 +131,17 @@ class Database:
             username = user.username
             user_id = user.id
 
+        if min(model, orientation, gen_mode) < 0:
+            # settings the caller didn't pass carry over from the last row
+            self.update_for_user(user_id)
+            model = self.last_model if model < 0 else model
+            orientation = self.last_orientation if orientation < 0 \
+                else orientation
+            gen_mode = self.last_gen_mode if gen_mode < 0 else gen_mode
+
         if self.possible_actions:
             assert action in self.possible_actions
-        keys_to_add = list(self.__table_contents.keys())
-        keys_to_add.remove('id')
-
-        questions_len = len(self.__table_contents) - 1
-        questions = '(' + ', '.join(['?' for _ in range(questions_len)]) + ');'
-
-        query = 'INSERT INTO main ('
-        query += ', \n'.join(keys_to_add)
-        query += ')\nVALUES '
-        query += questions
+        query = self.insert_query
         self.last_query = query
 
         args = (
@@ -112,9 +152,15 @@ class Database:
             username,
             user_id,
             int(blocked),
+            profile,
+            gen_mode,
+            seeds,
         )
-        self.cur.execute(query, args)
-        self.logger.debug(self.last_query.replace('?', '{}').format(*args))
+        with metrics.stage_timer('db_write'):
+            self.cur.execute(query, args)
+        self._remember_model(user_id, model)
+        self.logger.debug('Inserted into main: %s', args)
+        return self.cur.lastrowid
 
     def check_user_exists(self, user):
         if isinstance(user, int):
@@ -125,10 +171,10 @@ class Database:
         query = """
             SELECT COUNT(*) FROM main WHERE user_id = ?;
         """
-        self.cur.execute(query, (user_id,))
-
-        out = self.cur.fetchone()
-        return bool(out)
+        with metrics.stage_timer('db_read'):
+            self.cur.execute(query, (user_id,))
+            count = self.cur.fetchone()[0]
+        return count > 0
 
     def update_for_user(self, user, update_only=None):
         self.logger.debug('Call: update_for_user')
@@ -152,31 +198,78 @@ class Database:
         additional = f'AND action IN {actions_str}'
 
         query = f"""
-            SELECT * FROM main
+            SELECT id, action, model, prompt, orientation, user, user_id,
+                   trigger_blacklist, gen_mode
+            FROM main
             WHERE user_id=? {additional}
             ORDER BY id DESC;
         """
-        self.cur.execute(query, (user_id,))
-        out = self.cur.fetchone()
-
-        if out:
-            if not update_only:
-                _, self.last_action, \
-                    self.last_model, self.last_prompt, \
-                    self.last_orientation, _, \
-                    _, self.is_blocked = out
-                self.is_blocked = True if self.is_blocked > 1 else False
-            elif update_only == 'model':
-                self.last_model = out[2]
-            elif update_only == 'gen_mode':
-                self.last_gen_mode = out[3]
-            elif update_only == 'prompt':
-                self.last_prompt = out[4]
-            elif update_only == 'orientation':
-                self.last_orientation = out[5]
-
+        with metrics.stage_timer('db_read'):
+            self.cur.execute(query, (user_id,))
+            out = self.cur.fetchone()
         self.logger.debug(out)
 
+        found = out is not None
+        if not found:
+            # a user without rows gets the defaults, not the settings
+            # read for the previous user
+            out = (None, 'txt2img', 0, '', 0, '', user_id, 0, 0)
+
+        if not update_only:
+            _, self.last_action, \
+                self.last_model, self.last_prompt, \
+                self.last_orientation, self.last_username, \
+                _, self.is_blocked, self.last_gen_mode = out
+            self.is_blocked = True if self.is_blocked > 1 else False
+        elif update_only == 'model':
+            self.last_model = out[2]
+        elif update_only == 'prompt':
+            self.last_prompt = out[3]
+        elif update_only == 'orientation':
+            self.last_orientation = out[4]
+        elif update_only == 'gen_mode':
+            self.last_gen_mode = out[8]
+        if found and update_only in (None, 'model'):
+            self._remember_model(user_id, self.last_model)
+
+    def _remember_model(self, user_id: int, model: int):
+        # only written on the database thread, the loop just reads
+        self.user_models[user_id] = model
+        self.user_models.move_to_end(user_id)
+        if len(self.user_models) > self.max_cached_users:
+            self.user_models.popitem(last=False)
+
+    def user_settings(self, user) -> dict:
+        self.update_for_user(user)
+        return {
+            'action': self.last_action,
+            'model': self.last_model,
+            'prompt': self.last_prompt,
+            'orientation': self.last_orientation,
+            'gen_mode': self.last_gen_mode,
+            'is_blocked': self.is_blocked,
+        }
+
+    def get_row(self, row_id: int) -> dict | None:
+        query = 'SELECT * FROM main WHERE id = ?;'
+        with metrics.stage_timer('db_read'):
+            self.cur.execute(query, (row_id,))
+            out = self.cur.fetchone()
+        if out is None:
+            return None
+        return dict(zip(self.__table_contents, out))
+
+    def recent_models(self, limit=200) -> list[int]:
+        # model positions of the latest picks and generations, newest first
+        query = """
+            SELECT model FROM main
+            WHERE action IN ('set_model', 'txt2img', 'img2img') AND model >= 0
+            ORDER BY id DESC LIMIT ?;
+        """
+        with metrics.stage_timer('db_read'):
+            self.cur.execute(query, (limit,))
+            return [row[0] for row in self.cur.fetchall()]
+
     def select_all(self):
         query = "SELECT * FROM main"
         self.last_query = query
@@ -186,6 +279,129 @@ class Database:
             yield item if item is not None else StopIteration
 
 
+def evict_least_recently_used(con, table: str, limit: float,
+                              size_column: str | None = None) -> list[str]:
+    # Deletes the least recently used rows of a table keyed by hash with a
+    # last_used column, once it holds more than limit: rows, or the sum of
+    # size_column. A tenth more is freed than needed, so eviction doesn't
+    # run on every insert once the table is full. Returns the evicted hashes
+    size = size_column or '1'
+    total = con.execute(f'SELECT COALESCE(SUM({size}), 0) FROM {table};'
+                        ).fetchone()[0]
+    if total <= limit:
+        return []
+    to_free = total - int(limit * 0.9)
+    evicted = []
+    for digest, row_size in con.execute(
+            f'SELECT hash, {size} FROM {table} ORDER BY last_used ASC;'):
+        if to_free <= 0:
+            break
+        evicted.append(digest)
+        to_free -= row_size
+    con.executemany(f'DELETE FROM {table} WHERE hash = ?;',
+                    [(digest,) for digest in evicted])
+    return evicted
+
+
+# The one thread doing a tenant's SQLite work, so SQLite never blocks the
+# event loop. Every database file gets one connection, opened on the thread
+# and kept. Calls queue up and run one after another, each in its own
+# transaction
+class DatabaseThread:
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='database')
+        self._connections = {}
+
+    def connect(self, path) -> sql.Connection:
+        # only called on the thread
+        con = self._connections.get(str(path))
+        if con is None:
+            con = sql.connect(path)
+            # commits append to the log instead of rewriting pages, and
+            # other connections can read meanwhile
+            con.execute('PRAGMA journal_mode=WAL;')
+            con.execute('PRAGMA synchronous=NORMAL;')
+            self._connections[str(path)] = con
+        return con
+
+    def _call(self, path, fn, *args, **kwargs):
+        con = self.connect(path)
+        try:
+            result = fn(con, *args, **kwargs)
+        except Exception:
+            con.rollback()
+            raise
+        else:
+            with metrics.stage_timer('db_commit'):
+                con.commit()
+        return result
+
+    async def run(self, path, fn, *args, **kwargs):
+        # fn gets the connection to path and runs on the database thread,
+        # the statements it makes share a transaction
+        call = functools.partial(self._call, path, fn, *args, **kwargs)
+        # the context carries the current trace into the thread
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, context.run, call)
+
+    def close(self):
+        def close_connections():
+            for con in self._connections.values():
+                con.close()
+            self._connections.clear()
+
+        self._executor.submit(close_connections)
+        self._executor.shutdown(wait=True)
+
+
+# Runs Database calls on the database thread
+class AsyncDatabase:
+    def __init__(self, database: Database, thread: DatabaseThread | None = None):
+        self.database = database
+        self.path = database.path
+        self.thread = thread or DatabaseThread()
+
+        self.logger = logging.getLogger(__name__)
+
+    def _call(self, con, fn, *args, **kwargs):
+        db = self.database
+        db.con = con
+        db.cur = con.cursor()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.cur.close()
+
+    async def run(self, fn, *args, **kwargs):
+        # fn gets the Database, calls made in one fn share a transaction
+        return await self.thread.run(self.path, self._call, fn,
+                                     *args, **kwargs)
+
+    async def insert(self, *args, **kwargs) -> int:
+        return await self.run(Database.insert, *args, **kwargs)
+
+    async def user_settings(self, user) -> dict:
+        return await self.run(Database.user_settings, user)
+
+    async def get_row(self, row_id: int) -> dict | None:
+        return await self.run(Database.get_row, row_id)
+
+    async def user_model(self, user_id: int) -> int:
+        # answered from memory once the user's settings were read or written
+        model = self.database.user_models.get(user_id)
+        if model is None:
+            model = (await self.user_settings(user_id))['model']
+        return model
+
+    def knows_user(self, user_id: int) -> bool:
+        return user_id in self.database.user_models
+
+    def close(self):
+        # the journal and the file_id cache of the tenant share the thread
+        self.thread.close()
+
 if __name__ == '__main__':
     path = './info/db.db'
 
@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import sqlite3 as sql
+import time
+from pathlib import Path
+
+from database_access import DatabaseThread, evict_least_recently_used
+
+
+# Maps image content hashes to Telegram file_ids, so identical images
+# are sent by reference instead of being uploaded again. Lookups and
+# stores run on the database thread, one call for all images of a message
+class FileIdCache:
+    def __init__(self, path: str | Path, max_items: int = 5000,
+                 thread: DatabaseThread | None = None):
+        self.path = Path(path)
+        self.max_items = max_items
+        self.thread = thread or DatabaseThread()
+        # hit times not written yet, at most one per cached image. Lookups
+        # stay read-only, the next store writes them before evicting
+        self._hits = {}
+
+        self.logger = logging.getLogger(__name__)
+
+        self.create_table()
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def create_table(self):
+        with sql.connect(self.path) as con:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS file_ids(
+                    hash VARCHAR(64) PRIMARY KEY,
+                    file_id VARCHAR(200) NOT NULL,
+                    last_used REAL
+                );
+            """)
+
+    async def lookup(self, digests: list[str]) -> dict[str, str]:
+        # file_ids of the digests that are cached
+        def select(con):
+            marks = ', '.join('?' * len(digests))
+            return dict(con.execute(
+                f'SELECT hash, file_id FROM file_ids WHERE hash IN ({marks});',
+                digests).fetchall())
+
+        if not digests:
+            return {}
+        found = await self.thread.run(self.path, select)
+        now = time.time()
+        for digest in found:
+            self._hits[digest] = now
+        return found
+
+    async def store(self, file_ids: dict[str, str]):
+        # digest to file_id of newly uploaded images
+        if not file_ids:
+            return
+        hits, self._hits = self._hits, {}
+        now = time.time()
+
+        def insert(con):
+            con.executemany('UPDATE file_ids SET last_used = ? WHERE hash = ?;',
+                            [(used, digest) for digest, used in hits.items()])
+            con.executemany("""
+                INSERT OR REPLACE INTO file_ids (hash, file_id, last_used)
+                VALUES (?, ?, ?);
+            """, [(digest, file_id, now)
+                  for digest, file_id in file_ids.items()])
+            self._evict(con)
+
+        await self.thread.run(self.path, insert)
+
+    async def discard(self, digests: list[str]):
+        for digest in digests:
+            self._hits.pop(digest, None)
+        await self.thread.run(self.path, lambda con: con.executemany(
+            'DELETE FROM file_ids WHERE hash = ?;',
+            [(digest,) for digest in digests]))
+
+    def _evict(self, con):
+        evicted = evict_least_recently_used(con, 'file_ids', self.max_items)
+        if evicted:
+            self.logger.debug('Evicted %d file_ids', len(evicted))
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import shutil
+import sqlite3 as sql
+import threading
+import time
+from pathlib import Path
+
+from PIL import Image, ImageDraw
+
+from database_access import DatabaseThread, evict_least_recently_used
+
+
+# Keeps generated images after they are sent, so users can look through
+# their results without a new generation. Images are stored under their
+# content hash, identical ones share a file. Every image gets a small
+# thumbnail when it is stored, and the least recently used images are
+# evicted once the store grows over its size limit. Queries run on the
+# database thread, image files are written in a worker thread
+class GenerationStore:
+    def __init__(self, root: str | Path, max_bytes: int = 1024 ** 3,
+                 thumbnail_size: int = 160,
+                 thread: DatabaseThread | None = None):
+        self.root = Path(root)
+        self.path = self.root / 'store.db'
+        self.max_bytes = max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.thread = thread or DatabaseThread()
+        # one put at a time checks for and writes the files of an image
+        self._files_lock = threading.Lock()
+
+        self.logger = logging.getLogger(__name__)
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.create_table()
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def image_path(self, digest: str) -> Path:
+        # two levels, so no directory gets too many files
+        return self.root / 'images' / digest[:2] / f'{digest}.png'
+
+    def thumbnail_path(self, digest: str) -> Path:
+        return self.root / 'thumbnails' / digest[:2] / f'{digest}.jpg'
+
+    def create_table(self):
+        con = sql.connect(self.path)
+        with con:
+            con.executescript("""
+                CREATE TABLE IF NOT EXISTS images(
+                    hash VARCHAR(64) PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    file_id VARCHAR(200),
+                    last_used REAL
+                );
+                CREATE TABLE IF NOT EXISTS results(
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    hash VARCHAR(64) NOT NULL,
+                    action VARCHAR(20),
+                    prompt TEXT,
+                    model_name VARCHAR(100),
+                    seed INTEGER,
+                    params TEXT,
+                    created REAL
+                );
+                CREATE INDEX IF NOT EXISTS results_user
+                    ON results(user_id, id);
+                CREATE INDEX IF NOT EXISTS results_hash ON results(hash);
+                CREATE INDEX IF NOT EXISTS images_last_used
+                    ON images(last_used);
+            """)
+        con.close()
+
+    async def put(self, img_path: str | Path, user_id: int, params: dict,
+                  seed: int | None = None,
+                  file_id: str | None = None) -> int | None:
+        # Moves the image into the store and records it as a result of the
+        # user. Returns the id of the result, None if the image was
+        # evicted while it was stored
+        digest, size = await asyncio.to_thread(self._write, Path(img_path))
+        now = time.time()
+        params = {key: value for key, value in params.items()
+                  if key not in ('file_prefix', 'photo', 'photos')}
+
+        def insert(con):
+            # eviction removes files on this thread, so the check holds
+            # until the transaction ends
+            if not self.image_path(digest).exists():
+                return None
+            con.execute("""
+                INSERT INTO images (hash, size, file_id, last_used)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (hash) DO UPDATE SET last_used = excluded.last_used,
+                    file_id = COALESCE(excluded.file_id, file_id);
+            """, (digest, size, file_id, now))
+            result_id = con.execute("""
+                INSERT INTO results (user_id, hash, action, prompt,
+                                     model_name, seed, params, created)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+            """, (user_id, digest, params.get('action'), params.get('prompt'),
+                  params.get('model_name'), seed, json.dumps(params),
+                  now)).lastrowid
+            self._evict(con)
+            return result_id
+
+        result_id = await self.thread.run(self.path, insert)
+        if result_id is None:
+            self.logger.warning('Image %s was evicted while it was stored',
+                                digest)
+        return result_id
+
+    def _write(self, img_path: Path) -> tuple[str, int]:
+        # the image and its thumbnail under the content hash, the generated
+        # file is dropped if the store has the image already
+        digest = self.digest(img_path.read_bytes())
+        image_path = self.image_path(digest)
+        thumbnail_path = self.thumbnail_path(digest)
+        with self._files_lock:
+            if image_path.exists():
+                img_path.unlink(missing_ok=True)
+            else:
+                image_path.parent.mkdir(parents=True, exist_ok=True)
+                thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+                with Image.open(img_path) as image:
+                    image = image.convert('RGB')
+                    image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+                    image.save(thumbnail_path, 'JPEG', quality=80)
+                # the generated file is not needed anymore, so it is moved
+                # instead of copied. shutil.move copies only across file
+                # systems
+                shutil.move(img_path, image_path)
+            size = image_path.stat().st_size + thumbnail_path.stat().st_size
+        return digest, size
+
+    async def count(self, user_id: int) -> int:
+        return await self.thread.run(self.path, lambda con: con.execute(
+            'SELECT COUNT(*) FROM results WHERE user_id = ?;',
+            (user_id,)).fetchone()[0])
+
+    async def page(self, user_id: int, page: int,
+                   page_size: int) -> list[dict]:
+        # newest results first
+        def select(con):
+            cur = con.cursor()
+            cur.row_factory = sql.Row
+            rows = cur.execute("""
+                SELECT results.*, images.file_id FROM results
+                JOIN images ON images.hash = results.hash
+                WHERE user_id = ? ORDER BY id DESC LIMIT ? OFFSET ?;
+            """, (user_id, page_size, page * page_size)).fetchall()
+            return [dict(row) for row in rows]
+
+        return await self.thread.run(self.path, select)
+
+    async def get(self, result_id: int) -> dict | None:
+        def select(con):
+            cur = con.cursor()
+            cur.row_factory = sql.Row
+            row = cur.execute("""
+                SELECT results.*, images.file_id FROM results
+                JOIN images ON images.hash = results.hash
+                WHERE id = ?;
+            """, (result_id,)).fetchone()
+            if row is None:
+                return None
+            con.execute('UPDATE images SET last_used = ? WHERE hash = ?;',
+                        (time.time(), row['hash']))
+            return dict(row)
+
+        return await self.thread.run(self.path, select)
+
+    async def set_file_id(self, digest: str, file_id: str):
+        await self.thread.run(self.path, lambda con: con.execute(
+            'UPDATE images SET file_id = ? WHERE hash = ?;',
+            (file_id, digest)))
+
+    def contact_sheet(self, rows: list[dict], columns: int = 3) -> bytes:
+        # the thumbnails of a page in one picture, numbered in the order
+        # of the rows
+        cell = self.thumbnail_size
+        n_rows = (len(rows) + columns - 1) // columns
+        sheet = Image.new('RGB', (cell * min(columns, len(rows)),
+                                  cell * n_rows), 'white')
+        draw = ImageDraw.Draw(sheet)
+        for i, row in enumerate(rows):
+            left, top = i % columns * cell, i // columns * cell
+            with Image.open(self.thumbnail_path(row['hash'])) as thumbnail:
+                sheet.paste(thumbnail, (
+                    left + (cell - thumbnail.width) // 2,
+                    top + (cell - thumbnail.height) // 2))
+            draw.rectangle((left, top, left + 18, top + 14), fill='black')
+            draw.text((left + 4, top + 2), str(i + 1), fill='white')
+        out = io.BytesIO()
+        sheet.save(out, 'JPEG', quality=85)
+        return out.getvalue()
+
+    def _evict(self, con):
+        evicted = evict_least_recently_used(con, 'images', self.max_bytes,
+                                            size_column='size')
+        if not evicted:
+            return
+        con.executemany('DELETE FROM results WHERE hash = ?;',
+                        [(digest,) for digest in evicted])
+        for digest in evicted:
+            self.image_path(digest).unlink(missing_ok=True)
+            self.thumbnail_path(digest).unlink(missing_ok=True)
+        self.logger.debug('Evicted %d stored images', len(evicted))
@@ -0,0 +1,160 @@
+import json
+import logging
+import sqlite3 as sql
+import time
+from pathlib import Path
+
+from database_access import DatabaseThread
+
+# Jobs are queued when accepted, running while generated and end up done,
+# failed, canceled or expired
+UNFINISHED = ('queued', 'running')
+
+# columns added after the first release, with their types
+NEW_COLUMNS = {
+    'delivered_count': 'INTEGER DEFAULT 0',
+    'n_images': 'INTEGER',
+}
+
+
+# Accepted generations with everything needed to run them again, so a
+# restart or a crash doesn't lose them. Images are recorded as they are
+# generated and sent, so a resumed job only makes the ones still missing.
+# Writes run on the database thread, shared with the tenant's database
+class JobJournal:
+    def __init__(self, path: str | Path, keep_finished: float = 86400,
+                 thread: DatabaseThread | None = None):
+        self.path = Path(path)
+        # seconds finished jobs stay in the journal
+        self.keep_finished = keep_finished
+        self.thread = thread or DatabaseThread()
+
+        self.logger = logging.getLogger(__name__)
+
+        self.create_table()
+
+    def create_table(self):
+        with sql.connect(self.path) as con:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS jobs(
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    chat_id INTEGER,
+                    message_id INTEGER,
+                    params TEXT,
+                    state VARCHAR(20),
+                    attempts INTEGER DEFAULT 0,
+                    delivered TEXT DEFAULT '[]',
+                    pending TEXT,
+                    created REAL,
+                    updated REAL,
+                    delivered_count INTEGER DEFAULT 0,
+                    n_images INTEGER
+                );
+            """)
+            con.execute('CREATE INDEX IF NOT EXISTS jobs_state '
+                        'ON jobs (state);')
+            existing = {row[1] for row in
+                        con.execute('PRAGMA table_info(jobs)')}
+            for key, val in NEW_COLUMNS.items():
+                if key not in existing:
+                    con.execute(f'ALTER TABLE jobs ADD COLUMN {key} {val}')
+
+    @staticmethod
+    def _to_dict(row) -> dict:
+        job_id, user_id, chat_id, message_id, params, state, attempts, \
+            delivered, pending, created, delivered_count, n_images = row
+        return {
+            'id': job_id,
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'params': json.loads(params),
+            'state': state,
+            'attempts': attempts,
+            # seeds of the images the user already got
+            'delivered': json.loads(delivered),
+            # images generated but not sent yet
+            'pending': json.loads(pending) if pending else None,
+            'created': created,
+            # images the user already got, rescales and albums have no seeds
+            'delivered_count': delivered_count or 0,
+            # images the generation makes with the settings load control
+            # chose, None until its first part is generated
+            'n_images': n_images,
+        }
+
+    async def _run(self, query: str, args=()):
+        return await self.thread.run(
+            self.path, lambda con: con.execute(query, args).lastrowid)
+
+    async def add(self, user_id: int, chat_id: int, message_id: int,
+                  params: dict) -> dict:
+        now = time.time()
+        job_id = await self._run("""
+            INSERT INTO jobs (user_id, chat_id, message_id, params, state,
+                              created, updated)
+            VALUES (?, ?, ?, ?, 'queued', ?, ?);
+        """, (user_id, chat_id, message_id, json.dumps(params), now, now))
+        self.logger.debug('Journaled job %s', job_id)
+        return {'id': job_id, 'user_id': user_id, 'chat_id': chat_id,
+                'message_id': message_id, 'params': params, 'state': 'queued',
+                'attempts': 0, 'delivered': [], 'pending': None,
+                'created': now, 'delivered_count': 0, 'n_images': None}
+
+    async def _update(self, job_id: int, **columns):
+        columns['updated'] = time.time()
+        assignments = ', '.join(f'{key} = ?' for key in columns)
+        await self._run(f'UPDATE jobs SET {assignments} WHERE id = ?;',
+                        (*columns.values(), job_id))
+
+    async def start(self, job: dict):
+        job['attempts'] += 1
+        await self._update(job['id'], state='running',
+                           attempts=job['attempts'])
+
+    async def generated(self, job: dict, paths, seeds: list, profile: str,
+                        n_images: int | None = None):
+        job['pending'] = {'paths': [str(path) for path in paths],
+                          'seeds': seeds, 'profile': profile}
+        columns = {'pending': json.dumps(job['pending'])}
+        # a resumed job makes only the rest, the first count stays
+        if n_images is not None and job['n_images'] is None:
+            job['n_images'] = columns['n_images'] = n_images
+        await self._update(job['id'], **columns)
+
+    async def delivered(self, job: dict, seeds: list, count: int):
+        job['delivered'] = job['delivered'] + seeds
+        job['delivered_count'] += count
+        job['pending'] = None
+        await self._update(job['id'], delivered=json.dumps(job['delivered']),
+                           delivered_count=job['delivered_count'],
+                           pending=None)
+
+    async def finish(self, job: dict, state: str = 'done'):
+        job['state'] = state
+        await self._update(job['id'], state=state)
+
+    async def cancel_for_user(self, user_id: int):
+        await self._run(f"""
+            UPDATE jobs SET state = 'canceled', updated = ?
+            WHERE user_id = ? AND state IN {UNFINISHED};
+        """, (time.time(), user_id))
+
+    async def unfinished(self) -> list[dict]:
+        # oldest first, so resumed jobs keep their order
+        rows = await self.thread.run(self.path, lambda con: con.execute(f"""
+            SELECT id, user_id, chat_id, message_id, params, state,
+                   attempts, delivered, pending, created, delivered_count,
+                   n_images
+            FROM jobs WHERE state IN {UNFINISHED} ORDER BY id;
+        """).fetchall())
+        return [self._to_dict(row) for row in rows]
+
+    async def prune(self):
+        count = await self.thread.run(self.path, lambda con: con.execute(f"""
+            DELETE FROM jobs
+            WHERE state NOT IN {UNFINISHED} AND updated < ?;
+        """, (time.time() - self.keep_finished,)).rowcount)
+        if count:
+            self.logger.debug('Pruned %s finished jobs', count)
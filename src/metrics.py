@@ -0,0 +1,209 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 25, 60, 120)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace(
+        '\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    items = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+    return '{' + items + '}'
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.label_names):
+            raise KeyError(f'{self.name} expects labels {self.label_names}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.label_names, key))
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help_text}',
+                 f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value) -> list[str]:
+        return [f'{self.name}{_format_labels(self._labels(key))} {value}']
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[pos] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, key, value) -> list[str]:
+        counts, total = value
+        labels = self._labels(key)
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket'
+                         f'{_format_labels(labels | {"le": bound})} '
+                         f'{cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket'
+                     f'{_format_labels(labels | {"le": "+Inf"})} '
+                     f'{cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} '
+                     f'{cumulative}')
+        return lines
+
+
+REGISTRY: list[_Metric] = []
+
+STAGE_DURATION = Histogram(
+    'bot_stage_duration_seconds',
+    'Time spent in each stage of handling a request', ['stage'])
+REQUESTS = Counter(
+    'bot_requests_total',
+    'Handled generation requests', ['action', 'model', 'outcome'])
+BACKEND_UP = Gauge(
+    'bot_webui_backend_up',
+    'Whether the WebUI backend answered the last health probe', ['backend'])
+BACKEND_CIRCUIT_OPEN = Gauge(
+    'bot_webui_backend_circuit_open',
+    'Whether the circuit breaker keeps the WebUI backend out', ['backend'])
+BACKEND_QUEUE = Gauge(
+    'bot_webui_queue_depth', 'Jobs waiting for a free WebUI backend',
+    ['lane'])
+GENERATION_PROFILE = Counter(
+    'bot_generation_profile_total',
+    'Generations by the load profile they ran with', ['model', 'profile'])
+LOAD_LEVEL = Gauge(
+    'bot_load_profile_level',
+    'Current load profile per model, 0 is the full profile', ['model'])
+DEDUPLICATED = Counter(
+    'bot_deduplicated_requests_total',
+    'Generation requests that joined an identical in-flight job',
+    ['endpoint'])
+FIRST_IMAGE = Histogram(
+    'bot_time_to_first_image_seconds',
+    'Time from sending a generation to the WebUI to the first image '
+    'reaching the user', ['action'])
+LOOP_LAG = Histogram(
+    'bot_event_loop_lag_seconds',
+    'Delay of the event loop in waking up a sleeping task',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str):
+    with tracing.span(stage), STAGE_DURATION.time(stage=stage):
+        yield
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle_http(reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter):
+    try:
+        request_line = await reader.readline()
+        # drain the headers, the request body is never used
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode(errors='replace').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and \
+                parts[1].split('?')[0] == '/metrics':
+            status = '200 OK'
+            body = render().encode()
+        else:
+            status = '404 Not Found'
+            body = b'Not Found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            'Connection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(host='127.0.0.1', port=9464) -> asyncio.Server:
+    server = await asyncio.start_server(_handle_http, host, port)
+    logger.info('Metrics available at http://%s:%s/metrics', host, port)
+    return server
+
+
+async def monitor_event_loop(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
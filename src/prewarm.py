@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import metrics
+from api_access import StableDiffusionAccess
+from backend_pool import Backend
+from database_access import Database
+
+logger = logging.getLogger(__name__)
+
+
+# Loads the checkpoint most likely to be asked for next onto backends that
+# have been idle for a while, so the first request after a lull doesn't
+# wait for the swap. Demand is estimated from the latest model picks and
+# generations in the database of every tenant plus the requests waiting
+# for a backend
+class CheckpointPrewarmer:
+    def __init__(self, stable_api: StableDiffusionAccess, db_paths: list,
+                 config: dict | None = None):
+        config = config or {}
+        self.stable_api = stable_api
+        self.databases = [Database(path) for path in db_paths]
+        self.model_names = stable_api.model_config['available_models']
+
+        self.check_interval = config.get('check_interval', 5)
+        # seconds a backend must stay idle before it is touched
+        self.idle_delay = config.get('idle_delay', 30)
+        # seconds between two swaps on one backend, reactive ones included
+        self.min_swap_interval = config.get('min_swap_interval', 300)
+        self.max_swaps_per_hour = config.get('max_swaps_per_hour', 6)
+        self.history_size = config.get('history_size', 200)
+        # weight of the n-th latest history row is decay ** n
+        self.decay = config.get('decay', 0.97)
+        self.queue_weight = config.get('queue_weight', 5.0)
+
+        self._swaps = deque()
+
+    def _read_history(self) -> list[list[int]]:
+        histories = []
+        for database in self.databases:
+            with database as db:
+                histories.append(db.recent_models(self.history_size))
+        return histories
+
+    def model_scores(self, histories: list[list[int]]) -> dict[str, float]:
+        scores = dict.fromkeys(self.model_names, 0.0)
+        for history in histories:
+            for rank, model_pos in enumerate(history):
+                if 0 <= model_pos < len(self.model_names):
+                    scores[self.model_names[model_pos]] += self.decay ** rank
+        for model_name in self.stable_api.pool.waiting_models():
+            if model_name in scores:
+                scores[model_name] += self.queue_weight
+        return scores
+
+    def pick_target(self, backend: Backend, scores: dict) -> str | None:
+        # the most wanted model no other backend has loaded yet
+        others = {b.model for b in self.stable_api.pool.backends
+                  if b is not backend and b.runs_diffusion}
+        for model_name in sorted(scores, key=scores.get, reverse=True):
+            if scores[model_name] <= 0:
+                break
+            if model_name in others:
+                continue
+            if backend.checkpoints and model_name not in backend.checkpoints:
+                continue
+            return None if model_name == backend.model else model_name
+        return None
+
+    def _within_limits(self, backend: Backend, now: float) -> bool:
+        while self._swaps and now - self._swaps[0] > 3600:
+            self._swaps.popleft()
+        if len(self._swaps) >= self.max_swaps_per_hour:
+            return False
+        if now - backend.last_swap < self.min_swap_interval:
+            return False
+        return now - backend.idle_since >= self.idle_delay
+
+    async def prewarm(self, backend: Backend, model_name: str):
+        pool = self.stable_api.pool
+        if not pool.try_acquire(backend):
+            return
+        logger.info('Prewarming %s on %s', model_name, backend.url)
+        self._swaps.append(time.monotonic())
+        try:
+            with metrics.stage_timer('prewarm_swap'):
+                await asyncio.to_thread(self.stable_api.change_model,
+                                        model_name, backend)
+        except Exception as e:
+            logger.warning('Prewarming %s on %s failed: %r',
+                           model_name, backend.url, e)
+        finally:
+            pool.release(backend)
+
+    async def check(self):
+        now = time.monotonic()
+        candidates = [b for b in self.stable_api.pool.backends
+                      if not b.busy and b.runs_diffusion
+                      and self._within_limits(b, now)]
+        if not candidates:
+            return
+
+        scores = self.model_scores(
+            await asyncio.to_thread(self._read_history))
+        for backend in candidates:
+            model_name = self.pick_target(backend, scores)
+            if model_name is not None:
+                await self.prewarm(backend, model_name)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check()
+            except Exception:
+                logger.exception('Prewarm check failed')
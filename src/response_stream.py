@@ -0,0 +1,208 @@
+import base64
+import json
+import struct
+import zlib
+from pathlib import Path
+
+# Incremental reader for WebUI responses. Base64 images are decoded into
+# files while the body is still arriving, so a response never sits in
+# memory whole. Everything else in the body (info, parameters) is small
+# and gets parsed with json once the stream ends
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_IEND = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+_WHITESPACE = b' \t\r\n'
+
+
+def png_text_chunk(keyword: str, text: str) -> bytes:
+    try:
+        chunk_type = b'tEXt'
+        data = keyword.encode('latin-1') + b'\x00' + text.encode('latin-1')
+    except UnicodeEncodeError:
+        # uncompressed international text, as PIL writes it
+        chunk_type = b'iTXt'
+        data = keyword.encode('latin-1') + b'\x00\x00\x00\x00\x00' + \
+            text.encode('utf-8')
+    crc = zlib.crc32(chunk_type + data)
+    return struct.pack('>I', len(data)) + chunk_type + data + \
+        struct.pack('>I', crc)
+
+
+class Base64FileWriter:
+    # Decodes base64 text into a file as it arrives. The last 12 decoded
+    # bytes are held back, so a text chunk can still go in before IEND
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, 'wb')
+        self._pending = b''
+        self._tail = b''
+        self._started = False
+
+    def write(self, text: bytes):
+        # the only escape JSON allows in base64 is \/
+        text = self._pending + text.replace(b'\\', b'')
+        if not self._started:
+            if len(text) < 5:
+                self._pending = text
+                return
+            if text.startswith(b'data:'):
+                if b',' not in text:
+                    self._pending = text
+                    return
+                text = text.split(b',', 1)[1]
+            self._started = True
+
+        usable = len(text) - len(text) % 4
+        self._pending = text[usable:]
+        if usable:
+            self._emit(base64.b64decode(text[:usable]))
+
+    def _emit(self, data: bytes):
+        data = self._tail + data
+        self._file.write(data[:-12])
+        self._tail = data[-12:]
+
+    def close(self):
+        if self._pending:
+            self._emit(base64.b64decode(self._pending))
+            self._pending = b''
+        self._file.close()
+
+    def discard(self):
+        # for a body that broke off, drops whatever was written so far
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+    def finish(self, text_chunks: bytes = b'') -> bool:
+        # appends the text chunks before IEND, False if the image isn't a PNG
+        with open(self.path, 'rb') as f:
+            is_png = f.read(8) == PNG_SIGNATURE
+        if not is_png or self._tail != PNG_IEND:
+            with open(self.path, 'ab') as f:
+                f.write(self._tail)
+            return False
+        with open(self.path, 'ab') as f:
+            f.write(text_chunks + self._tail)
+        return True
+
+
+class ImageStreamParser:
+    # Feed it the body chunk by chunk. Strings under image_keys, a list of
+    # them or a single one, are written to the files open_image(index)
+    # returns and replaced with empty values in the parsed result
+    def __init__(self, open_image, image_keys=('images', 'image')):
+        self.open_image = open_image
+        self.image_keys = {key.encode() for key in image_keys}
+        self.writers = []
+
+        self._rest = bytearray()
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expect_key = False
+        self._key_start = None
+        self._last_key = None
+        self._value_of = None
+        self._mode = 'json'
+        self._single = False
+
+    def feed(self, data: bytes):
+        i, n = 0, len(data)
+        while i < n:
+            if self._mode == 'image':
+                i = self._feed_image(data, i)
+            elif self._mode == 'image_list':
+                i = self._feed_image_list(data, i)
+            elif self._in_string:
+                i = self._feed_string(data, i)
+            else:
+                i = self._feed_structure(data, i)
+
+    def _feed_structure(self, data, i):
+        char = data[i:i + 1]
+        if char in _WHITESPACE:
+            self._rest += char
+            return i + 1
+
+        if self._value_of is not None:
+            self._value_of = None
+            if char == b'[':
+                self._rest += b'[]'
+                self._mode = 'image_list'
+                return i + 1
+            if char == b'"':
+                self._rest += b'""'
+                self._single = True
+                self._start_image()
+                return i + 1
+
+        self._rest += char
+        if char == b'"':
+            self._in_string = True
+            if self._expect_key:
+                self._key_start = len(self._rest)
+                self._expect_key = False
+        elif char in (b'{', b'['):
+            self._depth += 1
+            self._expect_key = char == b'{' and self._depth == 1
+        elif char in (b'}', b']'):
+            self._depth -= 1
+        elif char == b':' and self._depth == 1 and \
+                self._last_key in self.image_keys:
+            self._value_of = self._last_key
+        elif char == b',' and self._depth == 1:
+            self._last_key = None
+            self._expect_key = True
+        return i + 1
+
+    def _feed_string(self, data, i):
+        if self._escape:
+            self._escape = False
+            self._rest += data[i:i + 1]
+            return i + 1
+        quote = data.find(b'"', i)
+        backslash = data.find(b'\\', i)
+        if quote == -1 and backslash == -1:
+            self._rest += data[i:]
+            return len(data)
+        if backslash != -1 and (quote == -1 or backslash < quote):
+            self._rest += data[i:backslash + 1]
+            self._escape = True
+            return backslash + 1
+
+        self._rest += data[i:quote + 1]
+        self._in_string = False
+        if self._key_start is not None:
+            self._last_key = bytes(self._rest[self._key_start:-1])
+            self._key_start = None
+        return quote + 1
+
+    def _start_image(self):
+        self.writers.append(self.open_image(len(self.writers)))
+        self._mode = 'image'
+
+    def _feed_image(self, data, i):
+        quote = data.find(b'"', i)
+        if quote == -1:
+            self.writers[-1].write(data[i:])
+            return len(data)
+        self.writers[-1].write(data[i:quote])
+        self.writers[-1].close()
+        if self._single:
+            self._single = False
+            self._mode = 'json'
+        else:
+            self._mode = 'image_list'
+        return quote + 1
+
+    def _feed_image_list(self, data, i):
+        char = data[i:i + 1]
+        if char == b'"':
+            self._start_image()
+        elif char == b']':
+            self._mode = 'json'
+        return i + 1
+
+    def result(self) -> dict:
+        return json.loads(bytes(self._rest))
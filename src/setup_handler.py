@@ -1,18 +1,93 @@
+import atexit
+import json
 import logging
 import logging.handlers
+import queue
 
+TEXT_FORMAT = "%(asctime)s in %(name)s [%(trace_id)s]: %(levelname)s MESSAGE:'%(message)s"
 
-def get_handler():
+_listener = None
+_queue_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'trace_id': getattr(record, 'trace_id', '-'),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exc_info'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+class _LazyQueueHandler(logging.handlers.QueueHandler):
+    # The stock QueueHandler formats every record in the calling thread.
+    # Here only the traceback is rendered up front, since it references
+    # live frames; message formatting happens on the writer thread
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def get_handler(path='log.log', max_bytes=3*1024*1024, backup_count=3,
+                json_format=False):
     # create rotating file handler with 3 files, each limited to 3 MB
     handler = logging.handlers.RotatingFileHandler(
-        'log.log', maxBytes=3*1024*1024, backupCount=3)
-    handler.setLevel(logging.DEBUG)
+        path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
 
-# create formatter
-    formatter = logging.Formatter(
-        "%(asctime)s in %(name)s: %(levelname)s MESSAGE:'%(message)s")
+    # create formatter
+    if json_format:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, defaults={'trace_id': '-'})
 
-# add formatter to handler
+    # add formatter to handler
     handler.setFormatter(formatter)
 
     return handler
+
+
+def setup_logging(config: dict | None = None):
+    # Attaches a single queue handler to the root logger. One background
+    # thread owns the rotating file, so modules only push records
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    config = config or {}
+
+    file_handler = get_handler(
+        path=config.get('path', 'log.log'),
+        max_bytes=config.get('max_bytes', 3*1024*1024),
+        backup_count=config.get('backup_count', 3),
+        json_format=config.get('format', 'text') == 'json')
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(
+        log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+    _queue_handler = _LazyQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(config.get('level', 'INFO'))
+    for name, level in (config.get('levels') or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+
+def stop_logging():
+    global _listener, _queue_handler
+    if _listener is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _listener.stop()
+        _listener = None
+        _queue_handler = None
@@ -0,0 +1,120 @@
+import contextvars
+from pathlib import Path
+
+from config import SecretsAccess, load_config
+
+# The bot handling the current update. Set once per update, so every
+# coroutine and task started for it sees the same tenant
+_current_tenant = contextvars.ContextVar('current_tenant', default=None)
+# language_code of the user sending the update, picks the dialogs
+_current_language = contextvars.ContextVar('current_language', default='')
+
+
+# One Telegram bot served by this process, with its own token, user lists,
+# dialogs and databases. All tenants share the WebUI backends
+class Tenant:
+    def __init__(self, name: str, secrets_dir: str | Path = './info',
+                 dialogs: str | Path = './configs/dialogs.yml',
+                 data_dir: str | Path | None = None, user_filter=None,
+                 weight: float = 1.0):
+        self.name = name
+        self.secrets = SecretsAccess(secrets_dir)
+        self.dialogs_path = Path(dialogs)
+        self.load_dialogs()
+        # the databases live next to the secrets unless set otherwise
+        self.data_dir = Path(data_dir or secrets_dir)
+        # whitelist or blacklist, None for bot_settings.user_filter
+        self.user_filter = user_filter
+        # share of the backends while several tenants have jobs waiting
+        self.weight = weight
+
+        # opened by the bot on startup
+        self.database = None
+        self.file_id_cache = None
+        self.job_journal = None
+        # None unless generation_store is enabled
+        self.generation_store = None
+
+        self.user_semaphores = {}
+        self.user_tasks = {}
+        self.albums = {}
+
+    def load_dialogs(self):
+        # dialogs.yml answers users of any language, dialogs_ru.yml next
+        # to it those whose Telegram is set to Russian, and so on
+        self.dialog_bundles = {'': load_config(self.dialogs_path)}
+        prefix = f'{self.dialogs_path.stem}_'
+        for path in sorted(self.dialogs_path.parent.glob(f'{prefix}*.yml')):
+            self.dialog_bundles[path.stem[len(prefix):]] = load_config(path)
+
+    @property
+    def dialogs(self):
+        return self.dialog_bundles.get(_current_language.get(),
+                                       self.dialog_bundles[''])
+
+    def __repr__(self):
+        return f'Tenant({self.name})'
+
+
+def load_tenants(config_path: str | Path) -> list[Tenant]:
+    # without a tenants file the process serves the single bot in ./info
+    if not Path(config_path).exists():
+        return [Tenant('default')]
+    items = load_config(config_path)['tenants']
+    names = [item['name'] for item in items]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Tenant names must be unique: {names}')
+    return [Tenant(**item) for item in items]
+
+
+def enter(tenant: Tenant):
+    _current_tenant.set(tenant)
+
+
+def set_language(language_code: str | None):
+    # en-US and en both pick dialogs_en.yml
+    _current_language.set((language_code or '').split('-')[0].lower())
+
+
+def current_tenant() -> Tenant:
+    tenant = _current_tenant.get()
+    if tenant is None:
+        raise LookupError('No tenant is set for this task')
+    return tenant
+
+
+def current_tenant_name() -> str:
+    tenant = _current_tenant.get()
+    return tenant.name if tenant is not None else ''
+
+
+# Module level stand-in for an attribute of the current tenant, so code
+# written for a single bot keeps using its globals and gets the right
+# tenant's object
+class TenantLocal:
+    def __init__(self, attribute: str):
+        self._attribute = attribute
+
+    def _target(self):
+        return getattr(current_tenant(), self._attribute)
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+
+    def __delitem__(self, key):
+        del self._target()[key]
+
+    def __contains__(self, key):
+        return key in self._target()
+
+    def __bool__(self):
+        return bool(self._target())
+
+    def __repr__(self):
+        return f'TenantLocal({self._attribute})'
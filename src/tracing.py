@@ -0,0 +1,239 @@
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import itertools
+import json
+import logging
+import pstats
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+# Per-update trace context. The current trace lives in a context variable,
+# so it follows the handler into the tasks it creates and into
+# asyncio.to_thread calls without being passed around explicitly
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_current_span = contextvars.ContextVar('current_span', default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    def __init__(self, name, parent_id=None, attrs=None):
+        self.span_id = next(_span_ids)
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs or {}
+        self.thread = threading.current_thread().name
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'thread': self.thread,
+            'attrs': self.attrs,
+        }
+
+
+class Trace:
+    def __init__(self, trace_id, name, attrs=None):
+        self.trace_id = str(trace_id)
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.time()
+        self.end = None
+        self.spans = []
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attrs': self.attrs,
+            'spans': [s.to_dict() for s in self.spans],
+        }
+
+    def to_chrome_events(self, pid=1):
+        tid = self.trace_id
+        events = [{
+            'name': self.name, 'cat': 'update', 'ph': 'X', 'pid': pid,
+            'tid': tid, 'ts': self.start * 1e6, 'dur': self.duration * 1e6,
+            'args': self.attrs,
+        }]
+        for s in self.spans:
+            events.append({
+                'name': s.name, 'cat': 'stage', 'ph': 'X', 'pid': pid,
+                'tid': tid, 'ts': s.start * 1e6, 'dur': s.duration * 1e6,
+                'args': s.attrs | {'thread': s.thread},
+            })
+        return events
+
+
+class Tracer:
+    def __init__(self, keep_last=200):
+        self.finished = deque(maxlen=keep_last)
+        self.slow_threshold = None
+        self.slow_log_path = None
+        # slow traces are appended from executor threads, one at a time
+        self._slow_log_lock = threading.Lock()
+
+    def configure(self, keep_last=200, slow_threshold=None,
+                  slow_log_path='./traces/slow.jsonl'):
+        self.finished = deque(self.finished, maxlen=keep_last)
+        self.slow_threshold = slow_threshold
+        self.slow_log_path = Path(slow_log_path)
+
+    def finish(self, trace: Trace):
+        trace.end = time.time()
+        self.finished.append(trace)
+        if self.slow_threshold is None or \
+                trace.duration < self.slow_threshold:
+            return
+        record = trace.to_dict()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_slow(record)
+        else:
+            # the slow path being measured doesn't wait for the disk
+            loop.run_in_executor(None, self._write_slow, record)
+
+    def _write_slow(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._slow_log_lock:
+            self.slow_log_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.slow_log_path, 'a') as f:
+                f.write(line)
+
+    def dump(self, out_dir='./traces', last=None) -> tuple[Path, Path]:
+        traces = list(self.finished)
+        if last:
+            traces = traces[-last:]
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+
+        json_path = out_dir / f'traces_{stamp}.json'
+        json_path.write_text(json.dumps(
+            [t.to_dict() for t in traces], ensure_ascii=False, indent=1))
+
+        chrome_path = out_dir / f'traces_{stamp}.chrome.json'
+        events = [e for t in traces for e in t.to_chrome_events()]
+        chrome_path.write_text(json.dumps({'traceEvents': events},
+                                          ensure_ascii=False))
+        return json_path, chrome_path
+
+
+# Profiles the event loop thread for the next N traced requests
+class Profiler:
+    def __init__(self):
+        self._profile = None
+        self._remaining = 0
+        self._started_at = 0.0
+        self.out_dir = Path('./profiles')
+        self._lock = threading.Lock()
+
+    def start(self, n_requests: int, out_dir='./profiles'):
+        with self._lock:
+            if self._profile is not None:
+                raise RuntimeError('Profiling is already running')
+            self.out_dir = Path(out_dir)
+            self._remaining = n_requests
+            self._started_at = time.time()
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def request_finished(self, trace: Trace) -> Path | None:
+        with self._lock:
+            # requests already running when profiling started don't count
+            if self._profile is None or trace.start < self._started_at:
+                return None
+            self._remaining -= 1
+            if self._remaining > 0:
+                return None
+            profile, self._profile = self._profile, None
+        profile.disable()
+        return self._write(profile)
+
+    def _write(self, profile) -> Path:
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = self.out_dir / f'profile_{stamp}.prof'
+        profile.dump_stats(path)
+        with open(path.with_suffix('.txt'), 'w') as f:
+            stats = pstats.Stats(profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(60)
+        logging.getLogger(__name__).info('Profile written to %s', path)
+        return path
+
+
+TRACER = Tracer()
+PROFILER = Profiler()
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+def current_trace_id() -> str:
+    trace = _current_trace.get()
+    return trace.trace_id if trace else '-'
+
+
+@contextlib.contextmanager
+def start_trace(trace_id, name, **attrs):
+    trace = Trace(trace_id, name, attrs)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        TRACER.finish(trace)
+        PROFILER.request_finished(trace)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    parent = _current_span.get()
+    new_span = Span(name, parent.span_id if parent else None, attrs)
+    trace.spans.append(new_span)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    finally:
+        new_span.end = time.time()
+        _current_span.reset(token)
+
+
+_record_factory = logging.getLogRecordFactory()
+
+
+def _trace_record_factory(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.trace_id = current_trace_id()
+    return record
+
+
+logging.setLogRecordFactory(_trace_record_factory)
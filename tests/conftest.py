@@ -0,0 +1,23 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# the bot modules, and the fake WebUI and Telegram of the benchmarks
+for path in (ROOT / 'src', ROOT / 'benchmarks'):
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # monotonic clock of the backend_pool module, moved by hand
+    import backend_pool
+
+    fake = SimpleNamespace(now=1000.0)
+    fake.monotonic = lambda: fake.now
+    monkeypatch.setattr(backend_pool, 'time', fake)
+    return fake
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+
+from backend_pool import BackendPool, BackendUnavailable, CircuitBreaker
+
+
+def fail(breaker, times):
+    return [breaker.failure() for _ in range(times)]
+
+
+def test_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, open_seconds=10)
+    assert fail(breaker, 2) == [False, False]
+    assert breaker.state == 'closed' and breaker.allows()
+    assert breaker.failure()
+    assert breaker.state == 'open' and not breaker.allows()
+
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3)
+    fail(breaker, 2)
+    assert not breaker.success()
+    assert fail(breaker, 2) == [False, False]
+    assert breaker.state == 'closed'
+
+
+def test_half_open_after_open_seconds(clock):
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=10)
+    breaker.failure()
+    clock.now += 9.9
+    assert breaker.state == 'open'
+    clock.now += 0.1
+    assert breaker.state == 'half_open' and breaker.allows()
+    assert breaker.success()
+    assert breaker.state == 'closed'
+
+
+def test_failures_while_open_dont_extend(clock):
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=10)
+    breaker.failure()
+    open_until = breaker.open_until
+    assert not breaker.failure()
+    assert breaker.open_until == open_until
+
+
+def test_backoff_doubles_up_to_max(clock):
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=10,
+                             max_open_seconds=35)
+    durations = []
+    for _ in range(4):
+        # every failed trial job opens the circuit again
+        assert breaker.failure()
+        durations.append(breaker.open_until - clock.now)
+        clock.now = breaker.open_until
+        assert breaker.state == 'half_open'
+    assert durations == [10, 20, 35, 35]
+    breaker.success()
+    breaker.failure()
+    assert breaker.open_until - clock.now == 10
+
+
+def test_probe_only_ends_the_open_wait(clock):
+    breaker = CircuitBreaker(failure_threshold=1, open_seconds=10)
+    assert not breaker.probe_ok()
+    breaker.failure()
+    assert breaker.probe_ok()
+    assert breaker.state == 'half_open'
+    # a wedged WebUI answers probes, its trial job fails again
+    assert breaker.failure()
+    assert breaker.open_until - clock.now == 20
+
+
+def test_open_circuit_fails_waiters(clock):
+    async def main():
+        pool = BackendPool(['http://a'], {'failure_threshold': 2})
+        backend = await pool.acquire('model')
+        waiter = asyncio.create_task(pool.acquire('model'))
+        await asyncio.sleep(0)
+        pool.record_failure(backend)
+        assert not waiter.done()
+        pool.record_failure(backend)
+        with pytest.raises(BackendUnavailable):
+            await waiter
+        pool.release(backend)
+        with pytest.raises(BackendUnavailable):
+            await pool.acquire('model')
+
+    asyncio.run(main())
+
+
+def test_probe_hands_recovered_backend_to_waiter(clock):
+    async def main():
+        pool = BackendPool(['http://a', 'http://b'], {'failure_threshold': 1})
+        broken, other = pool.backends
+        pool.record_failure(broken)
+        held = await pool.acquire('model')
+        assert held is other
+        waiter = asyncio.create_task(pool.acquire('model'))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        pool.record_probe(broken, True)
+        assert await waiter is broken
+        assert broken.breaker.state == 'half_open'
+        pool.record_success(broken)
+        assert broken.breaker.state == 'closed'
+        pool.release(broken)
+        pool.release(other)
+
+    asyncio.run(main())
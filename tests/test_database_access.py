@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+from database_access import AsyncDatabase, Database
+
+
+def test_new_user_gets_defaults(tmp_path):
+    async def main():
+        database = AsyncDatabase(Database(tmp_path / 'db.db'))
+        first = SimpleNamespace(id=1, username='first')
+        await database.insert('txt2img', first, model=3, orientation=2,
+                              prompt='a cat', gen_mode=1)
+        assert (await database.user_settings(first))['prompt'] == 'a cat'
+        settings = await database.user_settings(2)
+        model = await database.user_model(2)
+        known = await database.run(Database.check_user_exists, 2)
+        database.close()
+        return settings, model, known
+
+    settings, model, known = asyncio.run(main())
+    assert settings == {'action': 'txt2img', 'model': 0, 'prompt': '',
+                        'orientation': 0, 'gen_mode': 0, 'is_blocked': False}
+    assert model == 0
+    assert not known
+
+
+def test_settings_carry_over_from_own_rows(tmp_path):
+    async def main():
+        database = AsyncDatabase(Database(tmp_path / 'db.db'))
+        await database.insert('txt2img', SimpleNamespace(id=1, username='a'),
+                              model=3, orientation=2, gen_mode=1)
+        # the next user's first row doesn't take over the first user's
+        await database.insert('start', 2, model=0, orientation=0)
+        await database.insert('set_model', 1, model=4)
+        rows = [await database.get_row(row_id) for row_id in (2, 3)]
+        known = await database.run(Database.check_user_exists, 2)
+        database.close()
+        return rows, known
+
+    (start, set_model), known = asyncio.run(main())
+    assert known
+    assert (start['user_id'], start['gen_mode'], start['user']) == (2, 0, '')
+    assert (set_model['model'], set_model['orientation'],
+            set_model['gen_mode'], set_model['user']) == (4, 2, 1, 'a')
+
+
+def test_cached_models_are_capped(tmp_path):
+    async def main():
+        database = AsyncDatabase(Database(tmp_path / 'db.db',
+                                          max_cached_users=2))
+        for user_id, model in ((1, 1), (2, 2), (3, 3)):
+            await database.insert('set_model', user_id, model=model,
+                                  orientation=0, gen_mode=0)
+        cached = dict(database.database.user_models)
+        # an evicted user is read from the database again
+        model = await database.user_model(1)
+        database.close()
+        return cached, model
+
+    cached, model = asyncio.run(main())
+    assert cached == {2: 2, 3: 3}
+    assert model == 1
@@ -0,0 +1,89 @@
+import asyncio
+from types import SimpleNamespace
+
+import tenants
+from backend_pool import BackendPool
+
+
+async def queue(pool, tenant, label=None, lane='txt2img'):
+    # a waiter of the tenant, returns once the pool put it in the queue
+    async def acquire():
+        tenants.enter(SimpleNamespace(name=tenant))
+        return label or tenant, await pool.acquire('model', lane)
+
+    task = asyncio.create_task(acquire())
+    await asyncio.sleep(0)
+    return task
+
+
+async def serve(pool, clock, held, waiters, seconds=1.0):
+    # runs every job for the given backend time, in the order the pool
+    # hands the backend over, and returns that order
+    order = []
+    while waiters:
+        clock.now += seconds
+        pool.release(held)
+        await asyncio.sleep(0)
+        done = [task for task in waiters if task.done()]
+        assert len(done) == 1
+        waiters.remove(done[0])
+        label, held = done[0].result()
+        order.append(label)
+    pool.release(held)
+    return order
+
+
+def test_least_used_tenant_goes_first(clock):
+    async def main():
+        pool = BackendPool(['http://a'])
+        held = await queue(pool, 'a')
+        held = (await held)[1]
+        waiters = [await queue(pool, 'a', 'a1'), await queue(pool, 'a', 'a2'),
+                   await queue(pool, 'b', 'b1')]
+        return await serve(pool, clock, held, waiters, seconds=10)
+
+    # b joined last but hasn't used the backend yet, a is FIFO
+    assert asyncio.run(main()) == ['b1', 'a1', 'a2']
+
+
+def test_weights_split_backend_time(clock):
+    async def main():
+        pool = BackendPool(['http://a'], weights={'big': 3, 'small': 1})
+        held = (await (await queue(pool, 'big')))[1]
+        waiters = []
+        for _ in range(12):
+            waiters.append(await queue(pool, 'big'))
+            waiters.append(await queue(pool, 'small'))
+        return await serve(pool, clock, held, waiters)
+
+    # the first job of big held the backend before anyone waited
+    first = ['big'] + asyncio.run(main())[:15]
+    assert first.count('big') == 12 and first.count('small') == 4
+
+
+def test_idle_tenant_starts_level(clock):
+    async def main():
+        pool = BackendPool(['http://a'])
+        # a has used the backend alone for a long time
+        held = (await (await queue(pool, 'a')))[1]
+        clock.now += 100
+        pool.release(held)
+        held = (await (await queue(pool, 'a')))[1]
+        waiters = [await queue(pool, 'a') for _ in range(4)]
+        waiters += [await queue(pool, 'b') for _ in range(4)]
+        return await serve(pool, clock, held, waiters)
+
+    # b doesn't get a hundred seconds of backend time in a row
+    assert asyncio.run(main()) == ['b', 'a'] * 4
+
+
+def test_lane_priority_comes_before_usage(clock):
+    async def main():
+        pool = BackendPool(['http://a'], lanes_config={
+            'rescale': {'priority': -1}})
+        held = (await (await queue(pool, 'a')))[1]
+        waiters = [await queue(pool, 'b', 'b txt2img'),
+                   await queue(pool, 'a', 'a rescale', lane='rescale')]
+        return await serve(pool, clock, held, waiters, seconds=10)
+
+    assert asyncio.run(main()) == ['a rescale', 'b txt2img']
@@ -0,0 +1,24 @@
+import asyncio
+
+from file_id_cache import FileIdCache
+
+
+def test_least_recently_used_file_ids_are_evicted(tmp_path):
+    async def main():
+        cache = FileIdCache(tmp_path / 'file_ids.db', max_items=10)
+        for i in range(10):
+            await cache.store({f'hash{i}': f'file{i}'})
+        # the hit is written with the next store, hash0 is kept
+        assert await cache.lookup(['hash0', 'missing']) == {'hash0': 'file0'}
+        await cache.store({'hash10': 'file10'})
+        left = await cache.lookup([f'hash{i}' for i in range(11)])
+        await cache.discard(['hash0'])
+        after_discard = await cache.lookup(['hash0'])
+        cache.thread.close()
+        return left, after_discard
+
+    left, after_discard = asyncio.run(main())
+    # eleven over a limit of ten evict down to nine
+    assert sorted(left) == ['hash0', 'hash10', 'hash3', 'hash4', 'hash5',
+                            'hash6', 'hash7', 'hash8', 'hash9']
+    assert after_discard == {}
@@ -0,0 +1,68 @@
+import asyncio
+import io
+
+from PIL import Image
+
+from generation_store import GenerationStore
+
+
+def write_image(path, color, size=64):
+    out = io.BytesIO()
+    Image.new('RGB', (size, size), color).save(out, format='PNG')
+    path.write_bytes(out.getvalue())
+    return path
+
+
+def files(store):
+    return sorted(path.name for path in store.root.rglob('*.*')
+                  if path.suffix in ('.png', '.jpg'))
+
+
+def test_identical_images_share_files(tmp_path):
+    async def main():
+        store = GenerationStore(tmp_path / 'store')
+        paths = [write_image(tmp_path / f'{i}.png', 'red') for i in range(4)]
+        # puts of one image running at once write its files once
+        ids = await asyncio.gather(*[
+            store.put(path, 7, {'action': 'txt2img', 'prompt': 'a cat',
+                                'file_prefix': 'job'}, seed=i)
+            for i, path in enumerate(paths)])
+        rows = await store.page(7, 0, 10)
+        await store.set_file_id(rows[0]['hash'], 'file-1')
+        row = await store.get(ids[0])
+        count = await store.count(7)
+        store.thread.close()
+        return store, ids, rows, row, count, paths
+
+    store, ids, rows, row, count, paths = asyncio.run(main())
+    assert count == 4 and len(set(ids)) == 4
+    assert sorted(row['seed'] for row in rows) == [0, 1, 2, 3]
+    assert row['file_id'] == 'file-1' and row['prompt'] == 'a cat'
+    assert 'file_prefix' not in row['params']
+    assert len(files(store)) == 2
+    assert not any(path.exists() for path in paths)
+
+
+def test_least_recently_used_images_are_evicted(tmp_path):
+    async def main():
+        store = GenerationStore(tmp_path / 'store')
+        colors = ['red', 'green', 'blue']
+        ids = [await store.put(write_image(tmp_path / f'{color}.png', color),
+                               7, {'action': 'txt2img'})
+               for color in colors]
+        # red was looked at last, green and blue are the oldest now
+        await store.get(ids[0])
+        sizes = await store.thread.run(store.path, lambda con: con.execute(
+            'SELECT SUM(size) FROM images;').fetchone()[0])
+        # one more image goes over the limit, eviction frees a tenth more
+        store.max_bytes = sizes
+        await store.put(write_image(tmp_path / 'white.png', 'white'),
+                        7, {'action': 'txt2img'})
+        left = [await store.get(result_id) for result_id in ids]
+        store.thread.close()
+        return store, left
+
+    store, (red, green, blue) = asyncio.run(main())
+    assert green is None and blue is None
+    assert red is not None
+    assert len(files(store)) == 4
@@ -0,0 +1,119 @@
+import asyncio
+import sqlite3 as sql
+
+from job_journal import JobJournal
+
+PARAMS = {'model': 0, 'orientation': 0, 'gen_mode': 0,
+          'model_name': 'stable-diffusion', 'image_size': '512x512',
+          'file_prefix': 'job'}
+
+
+def test_counts_survive_a_restart(tmp_path):
+    async def main():
+        journal = JobJournal(tmp_path / 'jobs.db')
+        job = await journal.add(7, 7, 1, PARAMS | {'action': 'txt2img'})
+        await journal.start(job)
+        await journal.generated(job, [tmp_path / 'a.png'], [11], 'light', 4)
+        await journal.delivered(job, [11], 1)
+        # the part of a resumed job doesn't change the first count
+        await journal.generated(job, [tmp_path / 'b.png'], [12], 'full', 3)
+        journal.thread.close()
+
+        restarted = JobJournal(tmp_path / 'jobs.db')
+        jobs = await restarted.unfinished()
+        restarted.thread.close()
+        return jobs
+
+    job, = asyncio.run(main())
+    assert job['state'] == 'running' and job['attempts'] == 1
+    assert job['delivered'] == [11] and job['delivered_count'] == 1
+    assert job['n_images'] == 4
+    assert job['pending'] == {'paths': [str(tmp_path / 'b.png')],
+                              'seeds': [12], 'profile': 'full'}
+
+
+def test_finished_jobs_are_not_resumed(tmp_path):
+    async def main():
+        journal = JobJournal(tmp_path / 'jobs.db', keep_finished=0)
+        done = await journal.add(7, 7, 1, PARAMS)
+        await journal.finish(done)
+        await journal.add(8, 8, 2, PARAMS)
+        await journal.add(8, 8, 3, PARAMS)
+        await journal.cancel_for_user(8)
+        left = await journal.add(9, 9, 4, PARAMS)
+        await journal.prune()
+        jobs = await journal.unfinished()
+        count = await journal.thread.run(journal.path, lambda con: con.execute(
+            'SELECT COUNT(*) FROM jobs;').fetchone()[0])
+        journal.thread.close()
+        return left, jobs, count
+
+    left, jobs, count = asyncio.run(main())
+    assert [job['id'] for job in jobs] == [left['id']]
+    assert count == 1
+
+
+def test_old_journal_gets_new_columns(tmp_path):
+    with sql.connect(tmp_path / 'jobs.db') as con:
+        con.execute("""
+            CREATE TABLE jobs(
+                id INTEGER PRIMARY KEY, user_id INTEGER, chat_id INTEGER,
+                message_id INTEGER, params TEXT, state VARCHAR(20),
+                attempts INTEGER DEFAULT 0, delivered TEXT DEFAULT '[]',
+                pending TEXT, created REAL, updated REAL);
+        """)
+        con.execute("""
+            INSERT INTO jobs (user_id, chat_id, message_id, params, state)
+            VALUES (7, 7, 1, '{}', 'queued');
+        """)
+
+    journal = JobJournal(tmp_path / 'jobs.db')
+    job, = asyncio.run(journal.unfinished())
+    journal.thread.close()
+    assert job['delivered_count'] == 0 and job['n_images'] is None
+
+
+def test_resume_makes_only_missing_images(tmp_path):
+    import bot
+    import load_test
+    from fake_webui import FakeWebUI, render_png
+    from load_test import MockTelegramTransport
+
+    async def main(server):
+        load_test.setup_bot(tmp_path, [server.url], 0)
+        transport = MockTelegramTransport()
+        application = bot.build_application(
+            whitelist_filter=False, request=transport, rate_limiter=False)
+        await application.initialize()
+        journal = bot.job_journal
+
+        # a rescale that was sent, and a txt2img with one of two images sent
+        rescale = await journal.add(7, 7, 1, PARAMS | {
+            'action': 'rescale', 'prompt': '', 'photo': 'photo'})
+        await journal.start(rescale)
+        await journal.delivered(rescale, [], 1)
+        txt2img = await journal.add(8, 8, 2, PARAMS | {
+            'action': 'txt2img', 'prompt': 'a cat'})
+        await journal.start(txt2img)
+        image = tmp_path / 'sent.png'
+        image.write_bytes(render_png(64, 64))
+        await journal.generated(txt2img, [image], [5], 'light', 2)
+        await journal.delivered(txt2img, [5], 1)
+
+        await bot.start_resume(application)
+        await application.bot_data['resume_task']
+        jobs = await journal.thread.run(journal.path, lambda con: con.execute(
+            'SELECT state, delivered_count, n_images FROM jobs ORDER BY id;'
+        ).fetchall())
+        await application.shutdown()
+        journal.thread.close()
+        return transport, jobs
+
+    with FakeWebUI() as server:
+        transport, jobs = asyncio.run(main(server))
+        requests = dict(server.requests)
+
+    assert jobs == [('done', 1, None), ('done', 2, 2)]
+    assert requests.get('/sdapi/v1/txt2img') == 1
+    assert not any('extra' in path for path in requests)
+    assert transport.calls['sendPhoto'] == 1
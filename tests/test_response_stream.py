@@ -0,0 +1,165 @@
+import base64
+import io
+import json
+
+import pytest
+from PIL import Image
+
+from response_stream import Base64FileWriter, ImageStreamParser, png_text_chunk
+
+
+def image_bytes(color, format='PNG'):
+    out = io.BytesIO()
+    Image.new('RGB', (4, 4), color).save(out, format=format)
+    return out.getvalue()
+
+
+def b64(data, prefix=''):
+    return prefix + base64.b64encode(data).decode()
+
+
+def parse(body: bytes, tmp_path, splits=()):
+    parser = ImageStreamParser(
+        lambda number: Base64FileWriter(tmp_path / f'{number}.png'))
+    start = 0
+    for split in (*splits, len(body)):
+        parser.feed(body[start:split])
+        start = split
+    return parser
+
+
+def every_split(body):
+    # the body in two chunks, split at every byte boundary
+    for split in range(len(body) + 1):
+        yield (split,)
+
+
+PNG_RED = image_bytes('red')
+PNG_BLUE = image_bytes('blue')
+
+
+def test_images_list_split_at_every_byte(tmp_path):
+    body = json.dumps({
+        'images': [b64(PNG_RED), b64(PNG_BLUE, 'data:image/png;base64,')],
+        'parameters': {'prompt': 'a "quoted" cat'},
+        'info': json.dumps({'all_seeds': [1, 2]}),
+    }).encode()
+    for splits in every_split(body):
+        parser = parse(body, tmp_path, splits)
+        for writer in parser.writers:
+            assert writer.finish()
+        result = parser.result()
+        assert result['images'] == []
+        assert result['parameters'] == {'prompt': 'a "quoted" cat'}
+        assert json.loads(result['info'])['all_seeds'] == [1, 2]
+        assert (tmp_path / '0.png').read_bytes() == PNG_RED
+        assert (tmp_path / '1.png').read_bytes() == PNG_BLUE
+
+
+def test_byte_by_byte(tmp_path):
+    body = json.dumps({'images': [b64(PNG_RED)], 'info': '{}'}).encode()
+    parser = parse(body, tmp_path, range(1, len(body)))
+    parser.writers[0].finish()
+    assert (tmp_path / '0.png').read_bytes() == PNG_RED
+
+
+def test_escaped_slashes(tmp_path):
+    # some JSON encoders write / as \/
+    image = b64(PNG_RED, 'data:image/png;base64,')
+    assert '/' in image
+    body = ('{"images": ["' + image.replace('/', '\\/') +
+            '"], "info": "{\\"note\\": \\"a\\/b\\"}"}').encode()
+    for splits in every_split(body):
+        parser = parse(body, tmp_path, splits)
+        parser.writers[0].finish()
+        assert (tmp_path / '0.png').read_bytes() == PNG_RED
+        assert json.loads(parser.result()['info']) == {'note': 'a/b'}
+
+
+def test_single_image_key(tmp_path):
+    # extra-single-image answers with one string under image
+    body = json.dumps({'html_info': '<p>done</p>',
+                       'image': b64(PNG_BLUE)}).encode()
+    for splits in every_split(body):
+        parser = parse(body, tmp_path, splits)
+        assert len(parser.writers) == 1
+        parser.writers[0].finish()
+        assert parser.result() == {'html_info': '<p>done</p>', 'image': ''}
+        assert (tmp_path / '0.png').read_bytes() == PNG_BLUE
+
+
+def test_image_keys_only_at_top_level(tmp_path):
+    body = json.dumps({'parameters': {'image': 'not base64', 'images': []},
+                       'images': [b64(PNG_RED)]}).encode()
+    parser = parse(body, tmp_path)
+    assert len(parser.writers) == 1
+    assert parser.result()['parameters'] == {'image': 'not base64',
+                                             'images': []}
+
+
+def test_null_images(tmp_path):
+    body = b'{"images": null, "info": "{}"}'
+    for splits in every_split(body):
+        parser = parse(body, tmp_path, splits)
+        assert parser.writers == []
+        assert parser.result() == {'images': None, 'info': '{}'}
+
+
+def test_text_chunk_goes_before_iend(tmp_path):
+    body = json.dumps({'images': [b64(PNG_RED)]}).encode()
+    parser = parse(body, tmp_path)
+    assert parser.writers[0].finish(png_text_chunk('parameters', 'a cat'))
+    with Image.open(tmp_path / '0.png') as image:
+        assert image.text['parameters'] == 'a cat'
+        assert image.getpixel((0, 0)) == (255, 0, 0)
+
+
+def test_non_png_is_written_as_is(tmp_path):
+    # the caller converts these, finish only reports them
+    jpeg = image_bytes('green', 'JPEG')
+    body = json.dumps({'images': [b64(jpeg, 'data:image/jpeg;base64,')]}
+                      ).encode()
+    parser = parse(body, tmp_path)
+    assert not parser.writers[0].finish(png_text_chunk('parameters', 'x'))
+    assert (tmp_path / '0.png').read_bytes() == jpeg
+
+
+def test_body_cut_mid_image(tmp_path):
+    body = json.dumps({'images': [b64(PNG_RED), b64(PNG_BLUE)],
+                       'info': '{}'}).encode()
+    parser = parse(body[:len(body) // 2], tmp_path)
+    with pytest.raises(json.JSONDecodeError):
+        parser.result()
+    # the writer of the cut image is still open, discard cleans it up
+    assert len(parser.writers) == 2
+    for writer in parser.writers:
+        writer.discard()
+    assert list(tmp_path.iterdir()) == []
+
+
+class BrokenResponse:
+    # a response whose connection drops after the first chunk
+    def __init__(self, first_chunk: bytes):
+        self.first_chunk = first_chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.first_chunk
+        raise ConnectionError('connection reset')
+
+
+def test_save_images_error_mid_stream(tmp_path):
+    from api_access import StableDiffusionAccess
+
+    # no config or backends are needed to save a response
+    stable_api = object.__new__(StableDiffusionAccess)
+    stable_api.temp_dir = tmp_path
+    body = json.dumps({'images': [b64(PNG_RED), b64(PNG_BLUE)]}).encode()
+    with pytest.raises(ConnectionError):
+        stable_api._save_images(BrokenResponse(body[:len(body) // 2]), 'job')
+    assert list(tmp_path.iterdir()) == []
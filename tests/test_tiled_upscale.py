@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from PIL import Image
+
+from api_access import Singleton, StableDiffusionAccess
+from config import LoadConfig
+from conftest import ROOT
+
+
+@pytest.fixture
+def stable_api(tmp_path):
+    Singleton._instances.pop(StableDiffusionAccess, None)
+    stable_api = StableDiffusionAccess(
+        temp_dir=tmp_path,
+        model_config_obj=LoadConfig(ROOT / 'configs' / 'models.yml'),
+        backends_config=['http://a', 'http://b'])
+    yield stable_api
+    Singleton._instances.pop(StableDiffusionAccess, None)
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return {'images': [item['data'] for item in self.payload['imageList']],
+                'html_info': ''}
+
+
+async def upscale(stable_api, tmp_path, post):
+    # a 4x3 grid of tiles in batches of two, at scale 1
+    img_path = tmp_path / 'in.png'
+    Image.new('RGB', (400, 300), 'red').save(img_path)
+    stable_api._post = post
+    return await stable_api._upscale_tiled(
+        img_path, {}, 1, 'job', tile_size=120, overlap=20, batch_size=2)
+
+
+def test_batches_in_flight_are_bounded(stable_api, tmp_path):
+    started = []
+    while_first = []
+
+    async def post(backend, endpoint, payload):
+        name = payload['imageList'][0]['name']
+        started.append(name)
+        if name == 'tile_0.png':
+            # the other backend is free, but later batches would only
+            # wait in memory for the first one
+            await asyncio.sleep(0.1)
+            while_first.extend(started)
+        return FakeResponse(payload)
+
+    file_path = asyncio.run(upscale(stable_api, tmp_path, post))
+    with Image.open(file_path) as image:
+        assert image.size == (400, 300)
+        assert image.getpixel((200, 150)) == (255, 0, 0)
+    assert sorted(while_first) == ['tile_0.png', 'tile_2.png']
+    assert len(started) == 6
+    assert not any(backend.busy for backend in stable_api.pool.backends)
+
+
+def test_failed_batch_cancels_the_others(stable_api, tmp_path):
+    cancelled = []
+
+    async def post(backend, endpoint, payload):
+        if payload['imageList'][0]['name'] == 'tile_0.png':
+            await asyncio.sleep(0.01)
+            raise ConnectionError('backend went away')
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(payload['imageList'][0]['name'])
+            raise
+
+    async def main():
+        with pytest.raises(ConnectionError):
+            await upscale(stable_api, tmp_path, post)
+        # the second backend was upscaling tiles 2 and 3
+        assert cancelled == ['tile_2.png']
+        assert not any(backend.busy for backend in stable_api.pool.backends)
+
+    asyncio.run(main())
@@ -0,0 +1,43 @@
+import asyncio
+import json
+import threading
+
+from tracing import Trace, Tracer
+
+
+def test_slow_traces_are_written_off_the_loop(tmp_path, monkeypatch):
+    tracer = Tracer()
+    tracer.configure(slow_threshold=0.0,
+                     slow_log_path=tmp_path / 'traces' / 'slow.jsonl')
+    write_slow = tracer._write_slow
+    threads = []
+
+    def spy(record):
+        threads.append(threading.current_thread())
+        write_slow(record)
+
+    monkeypatch.setattr(tracer, '_write_slow', spy)
+
+    async def main():
+        for trace_id in range(3):
+            tracer.finish(Trace(trace_id, 'update'))
+        # asyncio.run waits for the executor before it returns
+
+    asyncio.run(main())
+    tracer.finish(Trace('outside', 'update'))
+
+    lines = (tmp_path / 'traces' / 'slow.jsonl').read_text().splitlines()
+    assert sorted(json.loads(line)['trace_id'] for line in lines) == \
+        ['0', '1', '2', 'outside']
+    main_thread = threading.main_thread()
+    assert [thread is main_thread for thread in threads] == \
+        [False, False, False, True]
+
+
+def test_fast_traces_are_not_written(tmp_path):
+    tracer = Tracer()
+    tracer.configure(slow_threshold=60,
+                     slow_log_path=tmp_path / 'slow.jsonl')
+    tracer.finish(Trace(1, 'update'))
+    assert len(tracer.finished) == 1
+    assert not (tmp_path / 'slow.jsonl').exists()